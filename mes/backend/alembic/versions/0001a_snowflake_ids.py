@@ -0,0 +1,83 @@
+"""snowflake ids and call history columns
+
+Изменения моделей, сделанные до перехода на миграции: id сообщений и
+звонков - snowflake (snowflake.py, около 2^52), им нужен BIGINT; вместе с
+ними BIGINT становятся ссылки на messages.id (reply_to, реакции,
+прочтения). Автоинкремент снимается - id выдает приложение. Плюс
+calls.answered_at и индексы истории звонков и списка чатов пользователя.
+Должна идти до 0002: секцию можно подключить только с тем же типом id.
+
+Revision ID: 0001a
+Revises: 0001
+Create Date: 2026-10-19 22:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0001a'
+down_revision: Union[str, None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Ссылки на messages.id: (таблица, колонка, ondelete)
+MESSAGE_REFERENCES = (
+    ('message_reactions', 'message_id', 'CASCADE'),
+    ('message_reads', 'message_id', 'CASCADE'),
+    ('messages', 'reply_to', None),
+)
+
+
+def _alter_ids(type_, existing_type) -> None:
+    if op.get_bind().dialect.name != "postgresql":
+        # SQLite: batch пересоздает таблицы, внешние ключи переносятся как есть
+        for table, column, _ in MESSAGE_REFERENCES[:2]:
+            with op.batch_alter_table(table) as batch_op:
+                batch_op.alter_column(column, existing_type=existing_type, type_=type_, existing_nullable=False)
+        with op.batch_alter_table('messages') as batch_op:
+            batch_op.alter_column('id', existing_type=existing_type, type_=type_, autoincrement=False, existing_nullable=False)
+            batch_op.alter_column('reply_to', existing_type=existing_type, type_=type_, existing_nullable=True)
+        with op.batch_alter_table('calls') as batch_op:
+            batch_op.alter_column('id', existing_type=existing_type, type_=type_, autoincrement=False, existing_nullable=False)
+        return
+
+    for table, column, _ in MESSAGE_REFERENCES:
+        op.drop_constraint(f'{table}_{column}_fkey', table, type_='foreignkey')
+    for table, column, _ in MESSAGE_REFERENCES:
+        op.alter_column(table, column, type_=type_)
+    for table in ('messages', 'calls'):
+        op.alter_column(table, 'id', type_=type_)
+    for table, column, ondelete in MESSAGE_REFERENCES:
+        op.create_foreign_key(f'{table}_{column}_fkey', table, 'messages', [column], ['id'], ondelete=ondelete)
+
+
+def upgrade() -> None:
+    _alter_ids(sa.BigInteger(), sa.Integer())
+    if op.get_bind().dialect.name == "postgresql":
+        for table in ('messages', 'calls'):
+            op.alter_column(table, 'id', server_default=None)
+            op.execute(f"DROP SEQUENCE IF EXISTS {table}_id_seq")
+
+    op.add_column('calls', sa.Column('answered_at', sa.DateTime(timezone=True), nullable=True))
+    op.create_index('ix_calls_chat_id_id', 'calls', ['chat_id', 'id'], unique=False)
+    op.create_index('ix_chat_participants_user_chat', 'chat_participants', ['user_id', 'chat_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_chat_participants_user_chat', table_name='chat_participants')
+    op.drop_index('ix_calls_chat_id_id', table_name='calls')
+    with op.batch_alter_table('calls') as batch_op:
+        batch_op.drop_column('answered_at')
+
+    # Snowflake id в INTEGER не помещаются: откат возможен только для баз,
+    # где их еще нет
+    _alter_ids(sa.Integer(), sa.BigInteger())
+    if op.get_bind().dialect.name == "postgresql":
+        for table in ('messages', 'calls'):
+            op.execute(f"CREATE SEQUENCE {table}_id_seq OWNED BY {table}.id")
+            op.execute(f"SELECT setval('{table}_id_seq', COALESCE(MAX(id), 0) + 1, false) FROM {table}")
+            op.alter_column(table, 'id', server_default=sa.text(f"nextval('{table}_id_seq'::regclass)"))
@@ -0,0 +1,120 @@
+"""partition messages by id range
+
+messages в PostgreSQL становится секционированной по диапазонам id. Id -
+snowflake с меткой времени, поэтому диапазон id = интервал времени и PK
+остается (id). Существующая таблица целиком подключается первой секцией
+messages_legacy (до начала следующего месяца); помесячные секции дальше
+создает и архивирует message_partitions.py. Внешние ключи на messages.id
+(реакции, прочтения, reply_to) удаляются: иначе секцию нельзя отсоединить.
+
+Revision ID: 0002
+Revises: 0001a
+Create Date: 2026-10-19 18:00:00
+
+"""
+from datetime import datetime, timezone
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from snowflake import snowflake_from_datetime
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, None] = '0001a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# SQLite не называет внешние ключи - batch-режиму нужны имена для drop_constraint
+SQLITE_NAMING = {"fk": "fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s"}
+
+
+def _next_month_start() -> datetime:
+    now = datetime.now(timezone.utc)
+    if now.month == 12:
+        return datetime(now.year + 1, 1, 1, tzinfo=timezone.utc)
+    return datetime(now.year, now.month + 1, 1, tzinfo=timezone.utc)
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name != "postgresql":
+        # SQLite (разработка): без секций, только ключи и индекс как в моделях
+        with op.batch_alter_table('message_reactions', naming_convention=SQLITE_NAMING) as batch_op:
+            batch_op.drop_constraint('fk_message_reactions_message_id_messages', type_='foreignkey')
+        with op.batch_alter_table('message_reads', naming_convention=SQLITE_NAMING) as batch_op:
+            batch_op.drop_constraint('fk_message_reads_message_id_messages', type_='foreignkey')
+        with op.batch_alter_table('messages', naming_convention=SQLITE_NAMING) as batch_op:
+            batch_op.drop_constraint('fk_messages_reply_to_messages', type_='foreignkey')
+            batch_op.create_index('ix_messages_chat_id_id', ['chat_id', 'id'], unique=False)
+        return
+
+    op.drop_constraint('message_reactions_message_id_fkey', 'message_reactions', type_='foreignkey')
+    op.drop_constraint('message_reads_message_id_fkey', 'message_reads', type_='foreignkey')
+    op.drop_constraint('messages_reply_to_fkey', 'messages', type_='foreignkey')
+
+    # Старая таблица станет секцией: освободить имена для секционированной
+    op.rename_table('messages', 'messages_legacy')
+    op.execute("ALTER TABLE messages_legacy RENAME CONSTRAINT messages_pkey TO messages_legacy_pkey")
+    op.execute("ALTER TABLE messages_legacy RENAME CONSTRAINT messages_chat_id_fkey TO messages_legacy_chat_id_fkey")
+    op.execute("ALTER TABLE messages_legacy RENAME CONSTRAINT messages_sender_id_fkey TO messages_legacy_sender_id_fkey")
+    op.execute("ALTER INDEX ix_messages_id RENAME TO ix_messages_legacy_id")
+
+    op.create_table('messages',
+    sa.Column('id', sa.BigInteger(), autoincrement=False, nullable=False),
+    sa.Column('chat_id', sa.Integer(), nullable=False),
+    sa.Column('sender_id', sa.Integer(), nullable=False),
+    sa.Column('content', sa.Text(), nullable=True),
+    sa.Column('message_type', sa.String(), nullable=True),
+    sa.Column('file_url', sa.String(), nullable=True),
+    sa.Column('reply_to', sa.BigInteger(), nullable=True),
+    sa.Column('is_edited', sa.Boolean(), nullable=True),
+    sa.Column('is_deleted', sa.Boolean(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['chat_id'], ['chats.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['sender_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    postgresql_partition_by='RANGE (id)'
+    )
+    boundary = snowflake_from_datetime(_next_month_start())
+    op.execute(f"ALTER TABLE messages ATTACH PARTITION messages_legacy FOR VALUES FROM (MINVALUE) TO ({boundary})")
+    # Индексы секционированной таблицы: существующий ix_messages_legacy_id подключается,
+    # (chat_id, id) строится на каждой секции
+    op.create_index('ix_messages_id', 'messages', ['id'], unique=False)
+    op.create_index('ix_messages_chat_id_id', 'messages', ['chat_id', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != "postgresql":
+        with op.batch_alter_table('messages', naming_convention=SQLITE_NAMING) as batch_op:
+            batch_op.drop_index('ix_messages_chat_id_id')
+            batch_op.create_foreign_key('fk_messages_reply_to_messages', 'messages', ['reply_to'], ['id'])
+        with op.batch_alter_table('message_reads', naming_convention=SQLITE_NAMING) as batch_op:
+            batch_op.create_foreign_key(
+                'fk_message_reads_message_id_messages', 'messages', ['message_id'], ['id'], ondelete='CASCADE'
+            )
+        with op.batch_alter_table('message_reactions', naming_convention=SQLITE_NAMING) as batch_op:
+            batch_op.create_foreign_key(
+                'fk_message_reactions_message_id_messages', 'messages', ['message_id'], ['id'], ondelete='CASCADE'
+            )
+        return
+
+    # Обратно в одну таблицу. Сообщения из архивных файлов не возвращаются,
+    # ссылки на них удаляются, чтобы можно было восстановить внешние ключи
+    op.execute("CREATE TABLE messages_plain (LIKE messages INCLUDING DEFAULTS)")
+    op.execute("INSERT INTO messages_plain SELECT * FROM messages")
+    op.drop_table('messages')
+    op.rename_table('messages_plain', 'messages')
+    op.create_primary_key('messages_pkey', 'messages', ['id'])
+    op.create_index('ix_messages_id', 'messages', ['id'], unique=False)
+    op.create_foreign_key('messages_chat_id_fkey', 'messages', 'chats', ['chat_id'], ['id'], ondelete='CASCADE')
+    op.create_foreign_key('messages_sender_id_fkey', 'messages', 'users', ['sender_id'], ['id'], ondelete='CASCADE')
+    op.execute("UPDATE messages SET reply_to = NULL WHERE reply_to NOT IN (SELECT id FROM messages)")
+    op.create_foreign_key('messages_reply_to_fkey', 'messages', 'messages', ['reply_to'], ['id'])
+    for table in ('message_reactions', 'message_reads'):
+        op.execute(f"DELETE FROM {table} WHERE message_id NOT IN (SELECT id FROM messages)")
+        op.create_foreign_key(
+            f'{table}_message_id_fkey', table, 'messages', ['message_id'], ['id'], ondelete='CASCADE'
+        )
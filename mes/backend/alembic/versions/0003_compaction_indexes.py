@@ -0,0 +1,38 @@
+"""partial indexes for compaction
+
+Компактор (compaction.py) ищет удаленные сообщения и ссылки на файлы
+media/. Частичные индексы содержат только такие строки и остаются
+маленькими; на секционированной messages они создаются на каждой секции.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19 20:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0003'
+down_revision: Union[str, None] = '0002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        'ix_messages_deleted', 'messages', ['id'], unique=False,
+        postgresql_where=sa.text('is_deleted IS true'), sqlite_where=sa.text('is_deleted IS 1')
+    )
+    op.create_index(
+        'ix_messages_file_url', 'messages', ['file_url'], unique=False,
+        postgresql_where=sa.text('file_url IS NOT NULL'), sqlite_where=sa.text('file_url IS NOT NULL')
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_messages_file_url', table_name='messages')
+    op.drop_index('ix_messages_deleted', table_name='messages')
@@ -0,0 +1,51 @@
+"""reaction counts
+
+messages.reaction_counts - счетчики реакций по emoji (см. reactions.py),
+заполняются для существующих сообщений. Уникальный индекс message_reactions
+(message_id, user_id, emoji): повторы одной реакции удаляются перед созданием.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-19 22:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0004'
+down_revision: Union[str, None] = '0003'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("""
+        DELETE FROM message_reactions WHERE id NOT IN (
+            SELECT min(id) FROM message_reactions GROUP BY message_id, user_id, emoji
+        )
+    """)
+    op.create_index(
+        'ix_message_reactions_message_user_emoji', 'message_reactions',
+        ['message_id', 'user_id', 'emoji'], unique=True
+    )
+    op.add_column('messages', sa.Column('reaction_counts', sa.JSON(), nullable=True))
+
+    json_object_agg = "json_object_agg" if op.get_bind().dialect.name == "postgresql" else "json_group_object"
+    op.execute(f"""
+        UPDATE messages SET reaction_counts = (
+            SELECT {json_object_agg}(emoji, n) FROM (
+                SELECT r.emoji, count(*) AS n FROM message_reactions r
+                WHERE r.message_id = messages.id GROUP BY r.emoji
+            ) AS counts
+        )
+        WHERE id IN (SELECT message_id FROM message_reactions)
+    """)
+
+
+def downgrade() -> None:
+    op.drop_column('messages', 'reaction_counts')
+    op.drop_index('ix_message_reactions_message_user_emoji', table_name='message_reactions')
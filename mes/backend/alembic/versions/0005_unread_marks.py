@@ -0,0 +1,42 @@
+"""unread marks
+
+chat_participants.last_read_message_id - отметка прочтения, от которой
+считаются непрочитанные (см. unread.py). Для существующих участников это
+последнее из прочитанных ими или отправленных ими сообщений чата.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-20 10:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0005'
+down_revision: Union[str, None] = '0004'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('chat_participants', sa.Column('last_read_message_id', sa.BigInteger(), nullable=True))
+    op.execute("""
+        UPDATE chat_participants SET last_read_message_id = (
+            SELECT max(id) FROM (
+                SELECT r.message_id AS id FROM message_reads r
+                JOIN messages m ON m.id = r.message_id
+                WHERE r.user_id = chat_participants.user_id AND m.chat_id = chat_participants.chat_id
+                UNION ALL
+                SELECT m.id FROM messages m
+                WHERE m.sender_id = chat_participants.user_id AND m.chat_id = chat_participants.chat_id
+            ) AS marks
+        )
+    """)
+
+
+def downgrade() -> None:
+    op.drop_column('chat_participants', 'last_read_message_id')
@@ -2,7 +2,7 @@ from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 import secrets
@@ -10,6 +10,7 @@ from database import get_db
 from models import User
 from schemas import TokenData
 from config import settings
+from response_cache import response_cache
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/login")
@@ -40,15 +41,15 @@ def create_refresh_token(data: dict):
 def generate_verification_token() -> str:
     return secrets.token_urlsafe(32)
 
-async def get_current_user(
-    token: str = Depends(oauth2_scheme),
-    db: Session = Depends(get_db)
-) -> User:
-    credentials_exception = HTTPException(
+def _credentials_error() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+def _token_user_id(token: str) -> int:
+    credentials_exception = _credentials_error()
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
         user_id: int = payload.get("sub")
@@ -57,10 +58,19 @@ async def get_current_user(
         token_data = TokenData(user_id=user_id)
     except JWTError:
         raise credentials_exception
-    
-    user = db.query(User).filter(User.id == token_data.user_id).first()
+    return token_data.user_id
+
+async def get_current_user(
+    request: Request,
+    token: str = Depends(oauth2_scheme),
+    db: Session = Depends(get_db)
+) -> User:
+    user_id = _token_user_id(token)
+    user = db.query(User).filter(User.id == user_id).first()
     if user is None:
-        raise credentials_exception
+        raise _credentials_error()
+    # Для read-your-writes: кто выполнил изменяющий запрос (см. replicas.py)
+    request.state.user_id = user.id
     return user
 
 async def get_current_active_user(current_user: User = Depends(get_current_user)) -> User:
@@ -68,3 +78,17 @@ async def get_current_active_user(current_user: User = Depends(get_current_user)
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
 
+async def get_current_profile(request: Request, token: str = Depends(oauth2_scheme)) -> dict:
+    """Профиль текущего пользователя из кэша (response_cache.py) вместо запроса к БД.
+
+    Для read-only эндпоинтов, которым не нужен ORM-объект пользователя.
+    """
+    user_id = _token_user_id(token)
+    profile = await response_cache.get("user", user_id)
+    if profile is None:
+        raise _credentials_error()
+    if not profile["is_active"]:
+        raise HTTPException(status_code=400, detail="Inactive user")
+    request.state.user_id = user_id
+    return profile
+
@@ -0,0 +1 @@
+# Бенчмарки backend (запуск: python -m benchmarks.<имя> из каталога backend)
@@ -0,0 +1,134 @@
+"""Холодный старт воркера: импорт приложения и startup в lifespan.
+
+Запуск из каталога backend:
+
+    python -m benchmarks.cold_start [--runs 5] [--budget-ms 1000] [--importtime]
+
+Каждый прогон - новый процесс Python: import main, затем вход в lifespan
+(проверка БД, Redis, фоновые сервисы) на временной SQLite и fakeredis,
+если не заданы --database-url / --redis-url. Если медиана импорт + lifespan
+больше бюджета (по умолчанию STARTUP_BUDGET_MS), код выхода 1.
+--importtime дополнительно показывает самые дорогие модули (python -X importtime).
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+CHILD = """
+import time
+started = time.perf_counter()
+import asyncio, json, os
+if os.environ.get("COLD_START_FAKEREDIS"):
+    import fakeredis.aioredis, metrics
+    pool = fakeredis.aioredis.FakeRedis(decode_responses=True).connection_pool
+    metrics.InstrumentedRedis.from_url = classmethod(lambda cls, *a, **k: cls(connection_pool=pool, decode_responses=True))
+import main
+imported = time.perf_counter()
+
+async def boot():
+    async with main.app.router.lifespan_context(main.app):
+        return time.perf_counter()
+
+ready = asyncio.run(boot())
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "lifespan_ms": (ready - imported) * 1000,
+    "total_ms": (ready - started) * 1000,
+}))
+"""
+
+
+def _default_budget() -> int:
+    from config import Settings
+
+    return Settings.model_fields["STARTUP_BUDGET_MS"].default
+
+
+def _child_env(args, workdir: str) -> dict:
+    env = dict(os.environ)
+    env["DATABASE_URL"] = args.database_url or f"sqlite:///{workdir}/cold_start.db"
+    env["REDIS_URL"] = args.redis_url or "redis://localhost:6379/0"
+    env.setdefault("SECRET_KEY", "cold-start-benchmark")
+    env["PYTHONPATH"] = str(BACKEND_DIR) + os.pathsep + env.get("PYTHONPATH", "")
+    if not args.redis_url:
+        env["COLD_START_FAKEREDIS"] = "1"
+    return env
+
+
+def run_once(env: dict, workdir: str) -> dict:
+    started = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD], env=env, cwd=workdir, capture_output=True, text=True, check=True
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    # Процесс целиком: запуск интерпретатора, импорт, lifespan и остановка
+    result["process_ms"] = (time.perf_counter() - started) * 1000
+    return result
+
+
+def top_imports(env: dict, workdir: str, limit: int = 15) -> list:
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        env=env, cwd=workdir, capture_output=True, text=True, check=True
+    ).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        rows.append((int(self_us), int(cumulative_us), name))
+    return sorted(rows, reverse=True)[:limit]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=None)
+    parser.add_argument("--database-url", default=None)
+    parser.add_argument("--redis-url", default=None)
+    parser.add_argument("--importtime", action="store_true", help="показать самые дорогие импорты")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args(argv)
+    budget = args.budget_ms if args.budget_ms is not None else _default_budget()
+
+    workdir = tempfile.mkdtemp(prefix="cold_start_")
+    env = _child_env(args, workdir)
+    # Первый прогон прогревает .pyc и дисковый кэш и в статистику не идет
+    run_once(env, workdir)
+    runs = [run_once(env, workdir) for _ in range(args.runs)]
+
+    summary = {
+        key: {
+            "median": round(statistics.median(run[key] for run in runs), 1),
+            "max": round(max(run[key] for run in runs), 1),
+        }
+        for key in ("import_ms", "lifespan_ms", "total_ms", "process_ms")
+    }
+    over_budget = summary["total_ms"]["median"] > budget
+
+    if args.json:
+        print(json.dumps({"budget_ms": budget, "summary": summary, "runs": runs}, indent=2))
+    else:
+        print(f"{'phase':<12} {'median ms':>10} {'max ms':>10}")
+        for key, values in summary.items():
+            print(f"{key[:-3]:<12} {values['median']:>10} {values['max']:>10}")
+        print(f"budget {budget:.0f} ms: {'EXCEEDED' if over_budget else 'ok'}")
+
+    if args.importtime:
+        print(f"\n{'self ms':>8} {'cumul ms':>9}  module")
+        for self_us, cumulative_us, name in top_imports(env, workdir):
+            print(f"{self_us / 1000:>8.1f} {cumulative_us / 1000:>9.1f}  {name}")
+
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
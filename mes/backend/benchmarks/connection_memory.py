@@ -0,0 +1,160 @@
+"""Память на соединение в реестре WebSocket и стоимость подключения/отключения.
+
+Запуск из каталога backend:
+
+    python -m benchmarks.connection_memory [--connections 100000] [--per-user 1] [--json]
+
+Сокеты и id пользователей создаются до начала замера, поэтому в отчет
+попадает только то, что узел хранит сверх самих сокетов: "registry" -
+записи Connection в ConnectionRegistry (connections.py), "dicts" - прежняя
+схема из четырех словарей (списки сокетов по пользователю, last_seen,
+codecs, batchers) для сравнения. Память - tracemalloc после регистрации
+всех соединений; add/remove - мкс на операцию; snapshot - первый обход
+всех соединений после изменений (построение снимков шардов) и повторный.
+"""
+import argparse
+import gc
+import json
+import os
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+# Настройки читаются при импорте; внешние сервисы не нужны
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+os.environ.setdefault("SECRET_KEY", "connection-memory-benchmark")
+
+
+class _FakeWebSocket:
+    __slots__ = ("__weakref__",)
+
+
+def _registry_layout(shards: int):
+    from connections import Connection, ConnectionRegistry
+    from ws_protocol import JSON_CODEC
+
+    registry = ConnectionRegistry(shards)
+
+    def add(websocket, user_id: int):
+        registry.add(Connection(websocket, user_id, JSON_CODEC))
+
+    def remove(websocket, user_id: int):
+        registry.remove(websocket)
+
+    def iterate() -> int:
+        return sum(1 for _ in registry.snapshot())
+
+    return add, remove, iterate
+
+
+def _dicts_layout(shards: int):
+    from ws_protocol import JSON_CODEC
+
+    active_connections: Dict[int, List[object]] = {}
+    last_seen: Dict[object, float] = {}
+    codecs: Dict[object, object] = {}
+
+    def add(websocket, user_id: int):
+        codecs[websocket] = JSON_CODEC
+        active_connections.setdefault(user_id, []).append(websocket)
+        last_seen[websocket] = time.monotonic()
+
+    def remove(websocket, user_id: int):
+        last_seen.pop(websocket, None)
+        codecs.pop(websocket, None)
+        connections = active_connections[user_id]
+        connections.remove(websocket)
+        if not connections:
+            del active_connections[user_id]
+
+    def iterate() -> int:
+        return sum(len(list(connections)) for connections in list(active_connections.values()))
+
+    return add, remove, iterate
+
+
+LAYOUTS: Dict[str, Callable] = {"registry": _registry_layout, "dicts": _dicts_layout}
+
+
+def run(layout: str, connections: int, per_user: int, shards: int) -> dict:
+    sockets = [_FakeWebSocket() for _ in range(connections)]
+    user_ids = [index // per_user + 1 for index in range(connections)]
+    add, remove, iterate = LAYOUTS[layout](shards)
+
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    for websocket, user_id in zip(sockets, user_ids):
+        add(websocket, user_id)
+    add_us = (time.perf_counter() - start) / connections * 1e6
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    iterate()
+    first_iterate_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    iterate()
+    iterate_ms = (time.perf_counter() - start) * 1000
+
+    # Отключение в случайном порядке, как в жизни
+    order = list(range(connections))
+    order.sort(key=lambda index: hash((index, 7919)))
+    start = time.perf_counter()
+    for index in order:
+        remove(sockets[index], user_ids[index])
+    remove_us = (time.perf_counter() - start) / connections * 1e6
+
+    return {
+        "layout": layout,
+        "connections": connections,
+        "per_user": per_user,
+        "bytes_per_connection": round(used / connections, 1),
+        "total_mb": round(used / 2 ** 20, 2),
+        "add_us": round(add_us, 3),
+        "remove_us": round(remove_us, 3),
+        "snapshot_first_ms": round(first_iterate_ms, 2),
+        "snapshot_ms": round(iterate_ms, 2),
+    }
+
+
+def _print_table(results: list):
+    header = (
+        f"{'layout':<9} {'conns':>8} {'per user':>8} {'B/conn':>8} {'MB':>7} "
+        f"{'add us':>7} {'remove us':>9} {'iter 1st ms':>11} {'iter ms':>8}"
+    )
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['layout']:<9} {r['connections']:>8} {r['per_user']:>8} {r['bytes_per_connection']:>8} "
+            f"{r['total_mb']:>7} {r['add_us']:>7} {r['remove_us']:>9} "
+            f"{r['snapshot_first_ms']:>11} {r['snapshot_ms']:>8}"
+        )
+
+
+def main():
+    from config import settings
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=100000)
+    parser.add_argument("--per-user", type=int, default=1, help="соединений на пользователя (устройства, вкладки)")
+    parser.add_argument("--shards", type=int, default=settings.WS_REGISTRY_SHARDS)
+    parser.add_argument("--json", action="store_true", help="вывести результаты в JSON")
+    args = parser.parse_args()
+
+    results = [
+        run(layout, args.connections, max(args.per_user, 1), args.shards)
+        for layout in LAYOUTS
+    ]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        _print_table(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+"""Микробенчмарки горячих примитивов с сохраненным baseline.
+
+Запуск из каталога backend:
+
+    python -m benchmarks.micro                    # сравнить с baseline
+    python -m benchmarks.micro --save             # записать новый baseline
+    python -m benchmarks.micro -k send_to_chat    # только часть бенчмарков
+    python -m benchmarks.micro --threshold 0.15 --json
+
+Каждый бенчмарк калибруется так, чтобы раунд шел не меньше --min-time,
+затем выполняется --rounds раундов; в отчет идут минимум и медиана времени
+на операцию. Регрессия - минимум хуже baseline больше чем на --threshold
+(по умолчанию 25%); тогда код выхода 1. Baseline привязан к машине: после
+смены железа или версии Python его нужно перезаписать через --save.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, List
+
+# Настройки читаются при импорте приложения; для бенчмарков внешние сервисы не нужны
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+os.environ.setdefault("SECRET_KEY", "micro-benchmark")
+
+BASELINE_PATH = Path(__file__).parent / "baselines" / "micro.json"
+DEFAULT_THRESHOLD = 0.25
+
+# name -> фабрика, возвращающая run(n) -> секунды на n операций
+BENCHMARKS: Dict[str, Callable[[], Callable[[int], float]]] = {}
+
+
+def benchmark(name: str):
+    def register(factory):
+        BENCHMARKS[name] = factory
+        return factory
+    return register
+
+
+def _loop(fn: Callable[[], object]) -> Callable[[int], float]:
+    def run(n: int) -> float:
+        start = time.perf_counter()
+        for _ in range(n):
+            fn()
+        return time.perf_counter() - start
+    return run
+
+
+def _user(i: int):
+    from models import User
+
+    return User(
+        id=i,
+        email=f"user{i}@example.com",
+        username=f"user{i}",
+        full_name=f"User {i}",
+        phone_number=None,
+        avatar=f"/media/avatars/{i}_user.png",
+        status="Hey there! I'm using Messenger",
+        user_status="online",
+        is_active=True,
+        is_email_verified=True,
+        created_at=datetime(2024, 1, 1, tzinfo=timezone.utc),
+    )
+
+
+def _message(sender):
+    from models import Message
+
+    return Message(
+        id=361918418583616,
+        chat_id=42,
+        sender_id=sender.id,
+        sender=sender,
+        content="Привет! Как дела? Созвонимся вечером?",
+        message_type="text",
+        file_url=None,
+        reply_to=None,
+        is_edited=False,
+        is_deleted=False,
+        created_at=datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc),
+    )
+
+
+def _chat(participants: int):
+    from models import Chat
+
+    return Chat(
+        id=42,
+        name="Команда",
+        is_group=True,
+        avatar=None,
+        created_at=datetime(2024, 1, 1, tzinfo=timezone.utc),
+        participants=[_user(i) for i in range(1, participants + 1)],
+    )
+
+
+@benchmark("message_response_serialize")
+def _bench_message_response():
+    from schemas import MessageResponse
+
+    message = _message(_user(1))
+    return _loop(lambda: MessageResponse.model_validate(message).model_dump(mode="json"))
+
+
+@benchmark("chat_response_serialize_2")
+def _bench_chat_response_direct():
+    from schemas import ChatResponse
+
+    chat = _chat(2)
+    return _loop(lambda: ChatResponse.model_validate(chat).model_dump(mode="json"))
+
+
+@benchmark("chat_response_serialize_50")
+def _bench_chat_response_group():
+    from schemas import ChatResponse
+
+    chat = _chat(50)
+    return _loop(lambda: ChatResponse.model_validate(chat).model_dump(mode="json"))
+
+
+@benchmark("jwt_decode")
+def _bench_jwt_decode():
+    from jose import jwt
+
+    from auth import create_access_token
+    from config import settings
+
+    token = create_access_token(data={"sub": "12345"})
+    # Тот же вызов, что в auth.get_current_user и websocket_endpoint
+    return _loop(lambda: jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM]))
+
+
+class _FakeWebSocket:
+    __slots__ = ("frames",)
+
+    def __init__(self):
+        self.frames = 0
+
+    async def send_text(self, data: str):
+        self.frames += 1
+
+    async def send_bytes(self, data: bytes):
+        self.frames += 1
+
+
+def _message_payload() -> dict:
+    from schemas import MessageResponse
+
+    return MessageResponse.model_validate(_message(_user(1))).model_dump(mode="json")
+
+
+def _fanout(recipients: int):
+    from connections import Connection
+    from websocket_manager import ConnectionManager
+    from ws_protocol import JSON_CODEC
+
+    manager = ConnectionManager()
+    user_ids = list(range(1, recipients + 1))
+    for user_id in user_ids:
+        manager.connections.add(Connection(_FakeWebSocket(), user_id, JSON_CODEC))
+    event = {"type": "new_message", "data": _message_payload()}
+
+    async def timed(n: int) -> float:
+        start = time.perf_counter()
+        for _ in range(n):
+            await manager.send_to_chat(event, user_ids)
+        return time.perf_counter() - start
+
+    loop = asyncio.new_event_loop()
+    return lambda n: loop.run_until_complete(timed(n))
+
+
+@benchmark("send_to_chat_10")
+def _bench_send_to_chat_10():
+    return _fanout(10)
+
+
+@benchmark("send_to_chat_100")
+def _bench_send_to_chat_100():
+    return _fanout(100)
+
+
+@benchmark("send_to_chat_1000")
+def _bench_send_to_chat_1000():
+    return _fanout(1000)
+
+
+INBOUND_FRAMES = [
+    '{"type":"typing","chat_id":42,"is_typing":true}',
+    '{"type":"message_read","message_id":361918418583616}',
+    '{"type":"ping"}',
+    '{"type":"webrtc_signal","call_id":361918418583617,"target_user_id":7,'
+    '"data":{"type":"ice-candidate","candidate":{"candidate":"candidate:842163049 1 udp 1677729535 '
+    '203.0.113.7 46154 typ srflx raddr 0.0.0.0 rport 0 generation 0","sdpMid":"0","sdpMLineIndex":0}}}',
+]
+
+
+@benchmark("inbound_decode_dispatch")
+def _bench_inbound_dispatch():
+    from ws_protocol import JSON_CODEC
+
+    handled = {"typing": 0, "message_read": 0, "ping": 0, "webrtc_signal": 0}
+
+    def dispatch():
+        # Как в цикле websocket_endpoint: декодировать кадр и выбрать ветку по type
+        for frame in INBOUND_FRAMES:
+            message_data = JSON_CODEC.decode(frame)
+            message_type = message_data.get("type")
+            if message_type in handled:
+                handled[message_type] += 1
+
+    return _loop(dispatch)
+
+
+def measure(factory, rounds: int, min_time: float) -> dict:
+    run = factory()
+    # Калибровка: увеличивать n, пока раунд не станет длиннее min_time
+    n = 1
+    while True:
+        elapsed = run(n)
+        if elapsed >= min_time:
+            break
+        n = max(n * 2, int(n * min_time * 1.2 / max(elapsed, 1e-9)))
+    per_op = [run(n) / n * 1e6 for _ in range(rounds)]
+    return {
+        "iterations": n,
+        "min_us": round(min(per_op), 3),
+        "median_us": round(statistics.median(per_op), 3),
+        "stdev_us": round(statistics.stdev(per_op), 3) if len(per_op) > 1 else 0.0,
+    }
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[dict]:
+    rows = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        row = {"name": name, "current_us": result["min_us"], "baseline_us": None, "change": None, "regression": False}
+        if base:
+            change = (result["min_us"] - base["min_us"]) / base["min_us"]
+            row.update(baseline_us=base["min_us"], change=round(change, 4), regression=change > threshold)
+        rows.append(row)
+    return rows
+
+
+def _print_table(results: Dict[str, dict], rows: List[dict]):
+    header = f"{'benchmark':<30} {'min us':>10} {'median us':>10} {'baseline':>10} {'change':>8}"
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        result = results[row["name"]]
+        baseline = f"{row['baseline_us']:.3f}" if row["baseline_us"] is not None else "-"
+        change = f"{row['change'] * 100:+.1f}%" if row["change"] is not None else "new"
+        marker = "  REGRESSION" if row["regression"] else ""
+        print(
+            f"{row['name']:<30} {result['min_us']:>10.3f} {result['median_us']:>10.3f} "
+            f"{baseline:>10} {change:>8}{marker}"
+        )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", dest="select", help="подстрока имени бенчмарка")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="секунд на раунд")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="допустимое замедление (доля)")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--save", action="store_true", help="перезаписать baseline результатами прогона")
+    parser.add_argument("--json", action="store_true", help="вывести результаты в JSON")
+    args = parser.parse_args(argv)
+
+    names = [name for name in BENCHMARKS if not args.select or args.select in name]
+    results = {name: measure(BENCHMARKS[name], args.rounds, args.min_time) for name in names}
+
+    baseline = {}
+    if args.baseline.exists():
+        with open(args.baseline) as f:
+            baseline = json.load(f).get("results", {})
+    rows = compare(results, baseline, args.threshold)
+
+    if args.json:
+        print(json.dumps({"results": results, "comparison": rows}, indent=2))
+    else:
+        _print_table(results, rows)
+
+    if args.save:
+        # Бенчмарки, не попавшие в выборку -k, сохраняют прежние значения
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump({
+                "meta": {
+                    "timestamp": datetime.now(timezone.utc).isoformat(),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "machine": platform.machine(),
+                },
+                "results": {**baseline, **results},
+            }, f, indent=2)
+            f.write("\n")
+        return 0
+
+    regressions = [row["name"] for row in rows if row["regression"]]
+    if regressions:
+        print(f"\nregressions over {args.threshold:.0%}: {', '.join(regressions)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""Сравнение кодировок WebSocket: байты на проводе и CPU на событие.
+
+Запуск из каталога backend:
+
+    python -m benchmarks.ws_encoding [--iterations 20000] [--json]
+
+Для каждого типа события считается размер кадра (с заголовком WebSocket)
+и время кодирования/декодирования для JSON и MessagePack, с permessage-deflate
+и без. Deflate моделируется как в websockets: один компрессор на соединение
+(context takeover), Z_SYNC_FLUSH и отброшенный хвост 00 00 ff ff (RFC 7692).
+"defl 1st" - первый кадр соединения, "defl ss" - следующий похожий кадр.
+"""
+import argparse
+import json
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from ws_protocol import CODECS
+
+DEFLATE_TAIL = b"\x00\x00\xff\xff"
+
+
+def _message(i: int) -> dict:
+    created_at = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=i)
+    return {
+        "id": 361918418583616 + i,
+        "chat_id": 42,
+        "sender_id": 7 + i % 3,
+        "content": f"Привет! Сообщение номер {i}, как дела?",
+        "message_type": "text",
+        "created_at": created_at.isoformat(),
+        "sender": {"id": 7 + i % 3, "username": f"user{i % 3}", "avatar": "/media/avatars/7_user.png"},
+    }
+
+
+def sample_events(seq: int = 0) -> dict:
+    """Типичные события; seq сдвигает id/текст, чтобы кадры подряд различались"""
+    return {
+        "new_message": {"type": "new_message", "data": _message(1 + seq)},
+        "user_typing": {
+            "type": "user_typing",
+            "data": {"chat_id": 42, "user_id": 7 + seq, "is_typing": seq % 2 == 0, "username": "alice"},
+        },
+        "user_status": {
+            "type": "user_status",
+            "data": {"statuses": [{"user_id": 100 + i + seq, "status": "online"} for i in range(20)]},
+        },
+        "history_chunk": {
+            "type": "history",
+            "data": {"chat_id": 42, "messages": [_message(i + seq * 50) for i in range(50)]},
+        },
+    }
+
+
+def _frame_size(payload_len: int) -> int:
+    # Кадр сервер -> клиент без маски: 2, 4 или 10 байт заголовка
+    if payload_len < 126:
+        return payload_len + 2
+    if payload_len < 65536:
+        return payload_len + 4
+    return payload_len + 10
+
+
+def _as_bytes(data) -> bytes:
+    return data.encode() if isinstance(data, str) else data
+
+
+def _deflate(compressor, data: bytes) -> bytes:
+    out = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return out[:-4] if out.endswith(DEFLATE_TAIL) else out
+
+
+def _time_per_op(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def run(iterations: int) -> list:
+    results = []
+    next_events = sample_events(seq=1)
+    for event_name, event in sample_events().items():
+        iters = max(iterations // 50, 200) if event_name == "history_chunk" else iterations
+        for codec_name, codec in CODECS.items():
+            raw = _as_bytes(codec.encode(event))
+            encode_us = _time_per_op(lambda: codec.encode(event), iters)
+            decode_us = _time_per_op(lambda: codec.decode(codec.encode(event)), iters) - encode_us
+
+            # Первый кадр в сжатом соединении - без словаря, последующие используют контекст
+            compressor = zlib.compressobj(wbits=-15)
+            cold = _deflate(compressor, raw)
+            warm = _deflate(compressor, _as_bytes(codec.encode(next_events[event_name])))
+
+            def encode_deflate():
+                _deflate(compressor, _as_bytes(codec.encode(event)))
+
+            deflate_us = _time_per_op(encode_deflate, iters)
+            results.append({
+                "event": event_name,
+                "codec": codec_name,
+                "bytes": _frame_size(len(raw)),
+                "bytes_deflate_first": _frame_size(len(cold)),
+                "bytes_deflate_steady": _frame_size(len(warm)),
+                "encode_us": round(encode_us, 2),
+                "decode_us": round(max(decode_us, 0.0), 2),
+                "encode_deflate_us": round(deflate_us, 2),
+            })
+    return results
+
+
+def _print_table(results: list):
+    header = (
+        f"{'event':<14} {'codec':<8} {'bytes':>7} {'defl 1st':>9} {'defl ss':>8} "
+        f"{'enc us':>8} {'dec us':>8} {'enc+defl us':>12}"
+    )
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['event']:<14} {r['codec']:<8} {r['bytes']:>7} {r['bytes_deflate_first']:>9} "
+            f"{r['bytes_deflate_steady']:>8} {r['encode_us']:>8} {r['decode_us']:>8} "
+            f"{r['encode_deflate_us']:>12}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--json", action="store_true", help="вывести результаты в JSON")
+    args = parser.parse_args()
+
+    results = run(args.iterations)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        _print_table(results)
+
+
+if __name__ == "__main__":
+    main()
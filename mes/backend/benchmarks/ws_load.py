@@ -0,0 +1,446 @@
+"""Нагрузочный прогон WebSocket: задержка доставки и пропускная способность.
+
+Запуск из каталога backend:
+
+    python -m benchmarks.ws_load --topology group --clients 2000 --messages 500
+    python -m benchmarks.ws_load --topology channel --clients 5000 --output run.json
+    python -m benchmarks.ws_load --topology direct --compare run.json
+
+Поднимает приложение (uvicorn в этом же процессе) на временной SQLite или
+на --database-url, Redis - по --redis-url или fakeredis в памяти. Создает
+пользователей и чаты выбранной топологии напрямую в БД, подключает всех
+клиентов по WebSocket и отправляет сообщения через POST /api/chats/{id}/messages.
+Задержка - от начала HTTP-запроса отправителя до получения new_message
+каждым получателем. Клиенты и сервер делят один event loop, поэтому
+абсолютные числа пессимистичны - сравнивать имеет смысл прогоны между
+коммитами на одной машине.
+
+Топологии: direct - чаты 1:1, group - группы по 50, channel - каналы по 5000
+(если клиентов меньше, один канал на всех).
+
+Нужны httpx, а без --redis-url - fakeredis и lupa (Lua-скрипты).
+Лимиты частоты на время прогона отключаются (--keep-rate-limits - оставить).
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+TOPOLOGY_SIZES = {"direct": 2, "group": 50, "channel": 5000}
+BENCH_PREFIX = "bench:"
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--topology", choices=sorted(TOPOLOGY_SIZES), default="group")
+    parser.add_argument("--clients", type=int, default=1000, help="число пользователей с WebSocket")
+    parser.add_argument("--messages", type=int, default=500, help="всего отправить сообщений")
+    parser.add_argument("--senders", type=int, default=20, help="параллельных отправителей")
+    parser.add_argument("--rate", type=float, default=0, help="сообщений в секунду всего (0 - без паузы)")
+    parser.add_argument("--codec", choices=["json", "msgpack"], default="json")
+    parser.add_argument("--batch", action="store_true", help="подключаться с ?batch=1")
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--drain-timeout", type=float, default=30, help="сколько ждать недоставленные")
+    parser.add_argument("--database-url", default=None, help="по умолчанию - временная SQLite")
+    parser.add_argument("--redis-url", default=None, help="по умолчанию - fakeredis")
+    parser.add_argument("--keep-rate-limits", action="store_true")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="сохранить отчет в JSON")
+    parser.add_argument("--compare", help="сравнить с сохраненным отчетом")
+    return parser.parse_args(argv)
+
+
+def _configure_environment(args) -> Optional[str]:
+    """Переменные окружения до импорта приложения (settings читаются при импорте)"""
+    tmpdir = None
+    if args.database_url is None:
+        tmpdir = tempfile.mkdtemp(prefix="ws_load_")
+        args.database_url = f"sqlite:///{tmpdir}/ws_load.db"
+    os.environ["DATABASE_URL"] = args.database_url
+    # Без --redis-url адрес не используется: клиент подменяется fakeredis
+    os.environ["REDIS_URL"] = args.redis_url or "redis://localhost:6379/0"
+    os.environ.setdefault("SECRET_KEY", "ws-load-benchmark")
+    return tmpdir
+
+
+def _use_fakeredis():
+    import fakeredis.aioredis
+    import metrics
+
+    pool = fakeredis.aioredis.FakeRedis(decode_responses=True).connection_pool
+    metrics.InstrumentedRedis.from_url = classmethod(
+        lambda cls, *a, **k: cls(connection_pool=pool, decode_responses=True)
+    )
+
+
+def _raise_fd_limit(needed: int):
+    try:
+        import resource
+    except ImportError:  # Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        target = needed if hard == resource.RLIM_INFINITY else min(hard, needed)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def build_topology(kind: str, clients: int) -> List[List[int]]:
+    """Разбить пользователей 0..clients-1 на чаты выбранного размера"""
+    size = min(TOPOLOGY_SIZES[kind], clients)
+    return [list(range(start, min(start + size, clients))) for start in range(0, clients, size)
+            if min(start + size, clients) - start >= 2]
+
+
+def seed_database(chats: List[List[int]], clients: int) -> Dict[str, list]:
+    """Пользователи, чаты и участники одной пачкой вставок; возвращает id и токены"""
+    from sqlalchemy import insert, select
+
+    from auth import create_access_token
+    from database import SessionLocal
+    from models import Chat, User, chat_participants
+
+    db = SessionLocal()
+    try:
+        run = int(time.time())
+        db.execute(insert(User), [
+            {
+                "email": f"load{run}_{i}@bench.local",
+                "username": f"load{run}_{i}",
+                "hashed_password": "!",
+                "is_active": True,
+            }
+            for i in range(clients)
+        ])
+        user_ids = list(db.scalars(
+            select(User.id).where(User.username.like(f"load{run}\\_%", escape="\\")).order_by(User.id)
+        ))
+        first_chat = (db.scalar(select(Chat.id).order_by(Chat.id.desc()).limit(1)) or 0) + 1
+        db.execute(insert(Chat), [
+            {"id": first_chat + n, "name": f"load {n}", "is_group": len(members) > 2, "created_by": user_ids[members[0]]}
+            for n, members in enumerate(chats)
+        ])
+        db.execute(insert(chat_participants), [
+            {"chat_id": first_chat + n, "user_id": user_ids[i]}
+            for n, members in enumerate(chats) for i in members
+        ])
+        db.commit()
+    finally:
+        db.close()
+
+    return {
+        "user_ids": user_ids,
+        "chat_ids": [first_chat + n for n in range(len(chats))],
+        "tokens": [create_access_token(data={"sub": str(user_id)}) for user_id in user_ids],
+    }
+
+
+def percentiles(values: List[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+    return {
+        "count": len(ordered),
+        "p50_ms": round(pick(0.50), 3),
+        "p90_ms": round(pick(0.90), 3),
+        "p99_ms": round(pick(0.99), 3),
+        "p999_ms": round(pick(0.999), 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+    }
+
+
+class LoadClient:
+    """Один WebSocket-клиент: отвечает на ping и записывает задержки new_message"""
+
+    def __init__(self, index: int, codec, stats: dict):
+        self.index = index
+        self.codec = codec
+        self.stats = stats
+        self.websocket = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def connect(self, url: str, subprotocols):
+        import websockets
+
+        self.websocket = await websockets.connect(
+            url, subprotocols=subprotocols, ping_interval=None, max_size=None, open_timeout=60
+        )
+        self.task = asyncio.create_task(self._read_loop())
+
+    async def _read_loop(self):
+        try:
+            async for frame in self.websocket:
+                event = self.codec.decode(frame)
+                events = event["data"]["events"] if event.get("type") == "batch" else [event]
+                for item in events:
+                    self._handle(item)
+        except Exception:
+            self.stats["disconnects"] += 1
+
+    def _handle(self, event: dict):
+        kind = event.get("type")
+        self.stats["events"] += 1
+        if kind == "new_message":
+            content = (event.get("data") or {}).get("content") or ""
+            if content.startswith(BENCH_PREFIX):
+                sent_at = float(content[len(BENCH_PREFIX):])
+                self.stats["latencies"].append(time.perf_counter() - sent_at)
+        elif kind == "ping":
+            asyncio.create_task(self.websocket.send(self.codec.encode({"type": "pong"})))
+
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+        if self.task is not None:
+            await asyncio.gather(self.task, return_exceptions=True)
+
+
+async def run_load(args, base_url: str, seed: dict, chats: List[List[int]]) -> dict:
+    import httpx
+
+    from ws_protocol import CODECS
+
+    codec = CODECS[args.codec]
+    subprotocols = [args.codec] if args.codec != "json" else None
+    stats = {"latencies": [], "events": 0, "disconnects": 0}
+    ws_base = base_url.replace("http://", "ws://")
+    query = "?batch=1" if args.batch else ""
+
+    clients = [LoadClient(i, codec, stats) for i in range(len(seed["tokens"]))]
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+    connect_times = []
+
+    async def connect(client: LoadClient):
+        async with semaphore:
+            start = time.perf_counter()
+            await client.connect(f"{ws_base}/ws/{seed['tokens'][client.index]}{query}", subprotocols)
+            connect_times.append(time.perf_counter() - start)
+
+    connect_start = time.perf_counter()
+    await asyncio.gather(*(connect(client) for client in clients))
+    connect_wall = time.perf_counter() - connect_start
+    # Дать разойтись user_status от подключений, чтобы они не мешали замеру
+    await asyncio.sleep(1)
+
+    rng = random.Random(args.seed)
+    plan = []
+    for _ in range(args.messages):
+        n = rng.randrange(len(chats))
+        plan.append((n, rng.choice(chats[n])))
+    expected = sum(len(chats[n]) - 1 for n, _ in plan)
+
+    send_latencies = []
+    send_errors = {}
+    queue = asyncio.Queue()
+    for item in plan:
+        queue.put_nowait(item)
+    interval = args.senders / args.rate if args.rate > 0 else 0
+
+    async def sender(http):
+        while True:
+            try:
+                n, member = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            chat_id = seed["chat_ids"][n]
+            started = time.perf_counter()
+            response = await http.post(
+                f"/api/chats/{chat_id}/messages",
+                json={"chat_id": chat_id, "content": f"{BENCH_PREFIX}{started!r}"},
+                headers={"Authorization": f"Bearer {seed['tokens'][member]}"},
+            )
+            send_latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                send_errors[response.status_code] = send_errors.get(response.status_code, 0) + 1
+            if interval:
+                await asyncio.sleep(max(0.0, interval - (time.perf_counter() - started)))
+
+    limits = httpx.Limits(max_connections=args.senders, max_keepalive_connections=args.senders)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as http:
+        send_start = time.perf_counter()
+        await asyncio.gather(*(sender(http) for _ in range(args.senders)))
+        send_wall = time.perf_counter() - send_start
+
+    deadline = time.perf_counter() + args.drain_timeout
+    while len(stats["latencies"]) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    total_wall = time.perf_counter() - send_start
+
+    await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+
+    delivered = len(stats["latencies"])
+    return {
+        "connect": {"wall_seconds": round(connect_wall, 3), **percentiles(connect_times)},
+        "send": {
+            "messages": len(plan),
+            "errors": send_errors,
+            "wall_seconds": round(send_wall, 3),
+            "messages_per_second": round(len(plan) / send_wall, 1) if send_wall else None,
+            **percentiles(send_latencies),
+        },
+        "delivery": {
+            "expected": expected,
+            "delivered": delivered,
+            "lost": max(0, expected - delivered),
+            "deliveries_per_second": round(delivered / total_wall, 1) if total_wall else None,
+            **percentiles(stats["latencies"]),
+        },
+        "client_events": stats["events"],
+        "client_disconnects": stats["disconnects"],
+    }
+
+
+async def _main(args) -> dict:
+    import uvicorn
+
+    import main
+    from config import settings
+    from database import Base, get_engine
+    from websocket_manager import manager
+
+    if not args.keep_rate_limits:
+        settings.RATE_LIMITS = {}
+    Base.metadata.create_all(bind=get_engine())
+
+    chats = build_topology(args.topology, args.clients)
+    seed = await asyncio.to_thread(seed_database, chats, args.clients)
+
+    port = _free_port()
+    config = uvicorn.Config(
+        main.app, host="127.0.0.1", port=port, log_level="warning",
+        ws_per_message_deflate=settings.WS_PER_MESSAGE_DEFLATE,
+        ws_ping_interval=None, backlog=max(2048, args.connect_concurrency * 2),
+    )
+    server = uvicorn.Server(config)
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        if server_task.done():
+            server_task.result()
+        await asyncio.sleep(0.05)
+
+    try:
+        results = await run_load(args, f"http://127.0.0.1:{port}", seed, chats)
+        results["server"] = manager.get_stats()
+    finally:
+        server.should_exit = True
+        await server_task
+
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "database": args.database_url.split("://")[0],
+            "redis": "redis" if args.redis_url else "fakeredis",
+        },
+        "params": {
+            "topology": args.topology,
+            "clients": args.clients,
+            "chats": len(chats),
+            "chat_size": len(chats[0]) if chats else 0,
+            "messages": args.messages,
+            "senders": args.senders,
+            "rate": args.rate,
+            "codec": args.codec,
+            "batch": args.batch,
+        },
+        "results": results,
+    }
+
+
+# Метрики для сравнения отчетов: (раздел, ключ, больше - лучше)
+COMPARED = [
+    ("delivery", "p50_ms", False),
+    ("delivery", "p99_ms", False),
+    ("delivery", "max_ms", False),
+    ("delivery", "deliveries_per_second", True),
+    ("delivery", "lost", False),
+    ("send", "p50_ms", False),
+    ("send", "p99_ms", False),
+    ("send", "messages_per_second", True),
+    ("connect", "p99_ms", False),
+]
+
+
+def compare(report: dict, baseline: dict) -> str:
+    lines = [f"{'metric':<32} {'baseline':>12} {'current':>12} {'change':>9}"]
+    if baseline.get("params") != report.get("params"):
+        lines.insert(0, "warning: parameters differ from baseline")
+    for section, key, higher_is_better in COMPARED:
+        old = baseline["results"].get(section, {}).get(key)
+        new = report["results"].get(section, {}).get(key)
+        if old is None or new is None:
+            continue
+        change = ""
+        if old:
+            delta = (new - old) / old * 100
+            worse = delta < 0 if higher_is_better else delta > 0
+            change = f"{delta:+.1f}%{' !' if worse and abs(delta) >= 10 else ''}"
+        lines.append(f"{section + '.' + key:<32} {old:>12} {new:>12} {change:>9}")
+    return "\n".join(lines)
+
+
+def format_report(report: dict) -> str:
+    params, results = report["params"], report["results"]
+    lines = [
+        f"commit {report['meta']['commit']}  {params['topology']}: {params['clients']} clients, "
+        f"{params['chats']} chats x {params['chat_size']}, {params['messages']} messages, codec {params['codec']}"
+        f"{', batch' if params['batch'] else ''}",
+    ]
+    for section in ("connect", "send", "delivery"):
+        data = results[section]
+        summary = "  ".join(f"{key}={value}" for key, value in data.items())
+        lines.append(f"{section:<9} {summary}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    _configure_environment(args)
+    if not args.redis_url:
+        _use_fakeredis()
+    _raise_fd_limit(args.clients * 2 + 1024)
+
+    report = asyncio.run(_main(args))
+    print(format_report(report))
+    if args.compare:
+        with open(args.compare) as f:
+            print()
+            print(compare(report, json.load(f)))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
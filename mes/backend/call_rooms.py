@@ -0,0 +1,442 @@
+import asyncio
+import json
+import os
+import socket
+from datetime import datetime, timezone
+from typing import Dict, List, Iterable, Optional, Set, Tuple
+
+import redis.asyncio as redis
+
+from config import settings
+from models import CallStatus
+
+CALL_ROOMS_CHANNEL = "call_rooms"
+ACTIVE_STATUSES = (CallStatus.RINGING.value, CallStatus.ACTIVE.value)
+FINAL_STATUSES = (
+    CallStatus.ENDED.value,
+    CallStatus.MISSED.value,
+    CallStatus.REJECTED.value,
+)
+
+# Атомарный переход статуса: меняет status, только если текущий входит в ARGV[1].
+# ARGV[2] - новый статус, ARGV[3] - ended_at (или ""), ARGV[4] - присоединившийся user_id (или ""),
+# ARGV[5] - answered_at, записывается при первом переходе ringing -> active.
+# Возвращает {1, предыдущий статус} при успехе и {0, текущий статус} иначе.
+TRANSITION_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], 'status')
+if not current then
+    return {0, ''}
+end
+for allowed in string.gmatch(ARGV[1], '[^,]+') do
+    if allowed == current then
+        redis.call('HSET', KEYS[1], 'status', ARGV[2])
+        if ARGV[3] ~= '' then
+            redis.call('HSET', KEYS[1], 'ended_at', ARGV[3])
+        end
+        if ARGV[5] ~= '' and current == 'ringing' and ARGV[2] == 'active' then
+            redis.call('HSET', KEYS[1], 'answered_at', ARGV[5])
+        end
+        if ARGV[4] ~= '' then
+            local joined = redis.call('HGET', KEYS[1], 'joined') or ''
+            redis.call('HSET', KEYS[1], 'joined', joined .. ',' .. ARGV[4])
+        end
+        return {1, current}
+    end
+end
+return {0, current}
+"""
+
+
+def _room_key(call_id: int) -> str:
+    return f"call:{call_id}"
+
+
+def _user_call_key(user_id: int) -> str:
+    return f"user_call:{user_id}"
+
+
+def _parse_ids(value: str) -> Set[int]:
+    return {int(item) for item in value.split(",") if item}
+
+
+class CallRoom:
+    """Состояние активного звонка: участники чата, присоединившиеся и статус"""
+
+    __slots__ = (
+        "call_id", "chat_id", "initiator_id", "call_type", "status",
+        "participants", "joined", "started_at", "answered_at", "ended_at",
+    )
+
+    def __init__(
+        self,
+        call_id: int,
+        chat_id: int,
+        initiator_id: int,
+        call_type: str,
+        participants: Iterable[int],
+        started_at: datetime,
+        status: str = CallStatus.RINGING.value,
+        joined: Iterable[int] = (),
+        answered_at: Optional[datetime] = None,
+        ended_at: Optional[datetime] = None,
+    ):
+        self.call_id = call_id
+        self.chat_id = chat_id
+        self.initiator_id = initiator_id
+        self.call_type = call_type
+        self.status = status
+        self.participants: Set[int] = set(participants)
+        self.joined: Set[int] = set(joined) or {initiator_id}
+        self.started_at = started_at
+        self.answered_at = answered_at
+        self.ended_at = ended_at
+
+    def to_redis(self) -> Dict[str, str]:
+        return {
+            "chat_id": str(self.chat_id),
+            "initiator_id": str(self.initiator_id),
+            "call_type": self.call_type,
+            "status": self.status,
+            "participants": ",".join(map(str, self.participants)),
+            "joined": ",".join(map(str, self.joined)),
+            "started_at": self.started_at.isoformat(),
+        }
+
+    @classmethod
+    def from_redis(cls, call_id: int, data: Dict[str, str]) -> "CallRoom":
+        answered_at = data.get("answered_at")
+        ended_at = data.get("ended_at")
+        return cls(
+            call_id=call_id,
+            chat_id=int(data["chat_id"]),
+            initiator_id=int(data["initiator_id"]),
+            call_type=data["call_type"],
+            participants=_parse_ids(data["participants"]),
+            started_at=datetime.fromisoformat(data["started_at"]),
+            status=data["status"],
+            joined=_parse_ids(data.get("joined", "")),
+            answered_at=datetime.fromisoformat(answered_at) if answered_at else None,
+            ended_at=datetime.fromisoformat(ended_at) if ended_at else None,
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.call_id,
+            "chat_id": self.chat_id,
+            "initiator_id": self.initiator_id,
+            "call_type": self.call_type,
+            "status": self.status,
+            "started_at": self.started_at,
+            "answered_at": self.answered_at,
+            "ended_at": self.ended_at,
+        }
+
+
+class CallRoomRegistry:
+    """Реестр активных звонков.
+
+    Источник истины - хеши call:{call_id} в Redis, переходы статусов
+    выполняются Lua-скриптом атомарно. Локальный словарь - кэш для
+    маршрутизации сигналинга без обращений к Redis и Postgres; другие узлы
+    узнают о переходах через канал call_rooms. Без Redis реестр работает
+    только в памяти процесса.
+    """
+
+    def __init__(self):
+        self.node_name = f"{socket.gethostname()}:{os.getpid()}"
+        self.redis_client: redis.Redis = None
+        self.manager = None
+        self.rooms: Dict[int, CallRoom] = {}
+        # user_id -> call_id звонка, к которому пользователь присоединился
+        self.user_calls: Dict[int, int] = {}
+        self._transition = None
+        self._pubsub = None
+        self._listen_task: Optional[asyncio.Task] = None
+        # (call_id, from, to) -> ICE-кандидаты, ожидающие отправки
+        self._ice_buffers: Dict[Tuple[int, int, int], List[dict]] = {}
+        self._ice_tasks: Dict[Tuple[int, int, int], asyncio.Task] = {}
+
+    async def start(self, manager):
+        self.manager = manager
+        self.redis_client = manager.redis_client
+        if self.redis_client:
+            self._transition = self.redis_client.register_script(TRANSITION_SCRIPT)
+            self._pubsub = self.redis_client.pubsub()
+            await self._pubsub.subscribe(CALL_ROOMS_CHANNEL)
+            self._listen_task = asyncio.create_task(self._listen_loop())
+
+    def queued_signals(self) -> int:
+        """ICE-кандидаты, ждущие окна батчинга"""
+        return sum(len(signals) for signals in list(self._ice_buffers.values()))
+
+    async def flush_signals(self):
+        """Отправить все ICE-кандидаты из окон склейки (перед остановкой узла)"""
+        for key in list(self._ice_buffers):
+            await self._flush_ice(key)
+
+    async def stop(self):
+        for task in list(self._ice_tasks.values()):
+            task.cancel()
+        if self._listen_task:
+            self._listen_task.cancel()
+            await asyncio.gather(self._listen_task, return_exceptions=True)
+            self._listen_task = None
+        if self._pubsub:
+            await self._pubsub.unsubscribe(CALL_ROOMS_CHANNEL)
+            await self._pubsub.close()
+            self._pubsub = None
+
+    async def create(self, room: CallRoom) -> CallRoom:
+        self.rooms[room.call_id] = room
+        self.user_calls[room.initiator_id] = room.call_id
+        if self.redis_client:
+            ttl = settings.CALL_ROOM_TTL_SECONDS
+            async with self.redis_client.pipeline(transaction=True) as pipe:
+                pipe.hset(_room_key(room.call_id), mapping=room.to_redis())
+                pipe.expire(_room_key(room.call_id), ttl)
+                pipe.set(_user_call_key(room.initiator_id), room.call_id, ex=ttl)
+                await pipe.execute()
+        return room
+
+    async def get(self, call_id: int) -> Optional[CallRoom]:
+        room = self.rooms.get(call_id)
+        if room is not None or not self.redis_client:
+            return room
+        data = await self.redis_client.hgetall(_room_key(call_id))
+        if not data:
+            return None
+        room = CallRoom.from_redis(call_id, data)
+        if room.status in ACTIVE_STATUSES:
+            self.rooms[call_id] = room
+        return room
+
+    async def transition(
+        self,
+        call_id: int,
+        from_statuses: Iterable[str],
+        to_status: str,
+        user_id: Optional[int] = None,
+    ) -> Tuple[Optional[CallRoom], bool]:
+        """Перевести звонок в новый статус, если текущий входит в from_statuses.
+
+        Возвращает (комната, успех). Комната None - звонок не найден.
+        user_id при успехе добавляется к присоединившимся.
+        """
+        room = await self.get(call_id)
+        if room is None:
+            return None, False
+        from_statuses = [getattr(status, "value", status) for status in from_statuses]
+        to_status = getattr(to_status, "value", to_status)
+        now = datetime.now(timezone.utc)
+        ended_at = now if to_status in FINAL_STATUSES else None
+
+        if self.redis_client:
+            ok, current = await self._transition(
+                keys=[_room_key(call_id)],
+                args=[
+                    ",".join(from_statuses),
+                    to_status,
+                    ended_at.isoformat() if ended_at else "",
+                    str(user_id) if user_id is not None else "",
+                    now.isoformat(),
+                ],
+            )
+            if not ok:
+                if not current:
+                    self._forget(room)
+                    return None, False
+                room.status = current
+                return room, False
+        elif room.status not in from_statuses:
+            return room, False
+        else:
+            current = room.status
+
+        if current == CallStatus.RINGING.value and to_status == CallStatus.ACTIVE.value:
+            room.answered_at = now
+        room.status = to_status
+        room.ended_at = ended_at
+        if user_id is not None:
+            room.joined.add(user_id)
+            self.user_calls[user_id] = call_id
+            if self.redis_client:
+                await self.redis_client.set(
+                    _user_call_key(user_id), call_id, ex=settings.CALL_ROOM_TTL_SECONDS
+                )
+        if self.redis_client:
+            await self.redis_client.publish(
+                CALL_ROOMS_CHANNEL,
+                json.dumps({"call_id": call_id, "status": to_status, "node": self.node_name})
+            )
+        return room, True
+
+    async def expire_ringing(self, call_ids: List[int]) -> Tuple[List[CallRoom], List[CallRoom]]:
+        """RINGING -> MISSED пачкой: один pipeline на все звонки тика.
+
+        Возвращает (перешедшие в MISSED, пропущенные раньше). Вторые - комнаты,
+        которые уже MISSED, но еще не удалены: запись итога в Postgres не
+        удалась, ее нужно повторить. Звонки, успевшие стать активными или
+        завершиться иначе, пропускаются.
+        """
+        ended_at = datetime.now(timezone.utc)
+        missed = CallStatus.MISSED.value
+        expired: List[CallRoom] = []
+        unsaved: List[CallRoom] = []
+        if not self.redis_client:
+            for call_id in call_ids:
+                room = self.rooms.get(call_id)
+                if room is None:
+                    continue
+                if room.status == missed:
+                    unsaved.append(room)
+                elif room.status == CallStatus.RINGING.value:
+                    room.status = missed
+                    room.ended_at = ended_at
+                    expired.append(room)
+            return expired, unsaved
+
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for call_id in call_ids:
+                pipe.hgetall(_room_key(call_id))
+                await self._transition(
+                    keys=[_room_key(call_id)],
+                    args=[CallStatus.RINGING.value, missed, ended_at.isoformat(), "", ""],
+                    client=pipe,
+                )
+            results = await pipe.execute()
+
+        for i, call_id in enumerate(call_ids):
+            data, (ok, _) = results[2 * i], results[2 * i + 1]
+            if not data:
+                continue
+            room = CallRoom.from_redis(call_id, data)
+            if not ok:
+                if room.status == missed:
+                    unsaved.append(room)
+                continue
+            room.status = missed
+            room.ended_at = ended_at
+            expired.append(room)
+        if expired:
+            await self.redis_client.publish(
+                CALL_ROOMS_CHANNEL,
+                json.dumps({
+                    "call_ids": [room.call_id for room in expired],
+                    "status": missed,
+                    "node": self.node_name,
+                })
+            )
+        return expired, unsaved
+
+    async def remove(self, room: CallRoom):
+        """Удалить завершенный звонок после записи итога в Postgres"""
+        await self.remove_many([room])
+
+    async def remove_many(self, rooms: List[CallRoom]):
+        for room in rooms:
+            self._forget(room)
+        if self.redis_client and rooms:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for room in rooms:
+                    pipe.delete(_room_key(room.call_id))
+                    for user_id in room.joined:
+                        pipe.delete(_user_call_key(user_id))
+                await pipe.execute()
+
+    async def active_call_for(self, user_id: int) -> Optional[int]:
+        call_id = self.user_calls.get(user_id)
+        if call_id is None and self.redis_client:
+            value = await self.redis_client.get(_user_call_key(user_id))
+            call_id = int(value) if value else None
+        return call_id
+
+    def can_signal(self, room: Optional[CallRoom], from_user_id: int, target_user_id: int) -> bool:
+        return (
+            room is not None
+            and room.status in ACTIVE_STATUSES
+            and from_user_id != target_user_id
+            and from_user_id in room.participants
+            and target_user_id in room.participants
+        )
+
+    async def relay_signal(self, room: CallRoom, from_user_id: int, target_user_id: int, signal: dict):
+        """Переслать сигнал WebRTC; trickle-ICE кандидаты копятся в окне"""
+        key = (room.call_id, from_user_id, target_user_id)
+        if signal.get("type") == "ice-candidate":
+            self._ice_buffers.setdefault(key, []).append(signal)
+            if key not in self._ice_tasks:
+                self._ice_tasks[key] = asyncio.create_task(self._flush_ice_later(key))
+            return
+        # offer/answer не должны обгонять уже накопленные кандидаты
+        await self._flush_ice(key)
+        await self.manager.send_personal_message(
+            {
+                "type": "webrtc_signal",
+                "data": {
+                    "call_id": room.call_id,
+                    "from_user_id": from_user_id,
+                    "signal_type": signal.get("type"),
+                    "signal": signal,
+                }
+            },
+            target_user_id
+        )
+
+    async def _flush_ice_later(self, key: Tuple[int, int, int]):
+        await asyncio.sleep(settings.ICE_BATCH_WINDOW_MS / 1000)
+        self._ice_tasks.pop(key, None)
+        await self._flush_ice(key)
+
+    async def _flush_ice(self, key: Tuple[int, int, int]):
+        task = self._ice_tasks.pop(key, None)
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        signals = self._ice_buffers.pop(key, None)
+        if not signals:
+            return
+        call_id, from_user_id, target_user_id = key
+        if len(signals) == 1:
+            data = {"signal_type": "ice-candidate", "signal": signals[0]}
+        else:
+            data = {"signal_type": "ice-candidates", "signals": signals}
+        await self.manager.send_personal_message(
+            {
+                "type": "webrtc_signal",
+                "data": {"call_id": call_id, "from_user_id": from_user_id, **data}
+            },
+            target_user_id
+        )
+
+    def _forget(self, room: CallRoom):
+        self.rooms.pop(room.call_id, None)
+        for user_id in room.joined:
+            if self.user_calls.get(user_id) == room.call_id:
+                del self.user_calls[user_id]
+        for key in [key for key in self._ice_buffers if key[0] == room.call_id]:
+            self._ice_buffers.pop(key, None)
+            task = self._ice_tasks.pop(key, None)
+            if task is not None:
+                task.cancel()
+
+    async def _listen_loop(self):
+        async for message in self._pubsub.listen():
+            if message.get("type") != "message":
+                continue
+            try:
+                event = json.loads(message["data"])
+                if event.get("node") == self.node_name:
+                    continue
+                for call_id in event.get("call_ids") or [event["call_id"]]:
+                    room = self.rooms.get(call_id)
+                    if room is None:
+                        continue
+                    if event["status"] in FINAL_STATUSES:
+                        self._forget(room)
+                    else:
+                        # Состав присоединившихся меняется - перечитать при следующем обращении
+                        self.rooms.pop(room.call_id, None)
+            except Exception as e:
+                print(f"Call room sync error: {e}")
+
+
+call_rooms = CallRoomRegistry()
@@ -0,0 +1,334 @@
+import asyncio
+import math
+import time
+from typing import Dict, Hashable, List, Optional
+
+import redis.asyncio as redis
+from sqlalchemy import insert, select
+
+from config import settings
+from database import SessionLocal
+from models import Call, CallStatus, UserStatus
+from call_rooms import call_rooms, CallRoom, FINAL_STATUSES
+from presence import presence
+
+TIMEOUTS_KEY = "call_timeouts"
+# call_id -> время следующей проверки активного звонка
+ACTIVE_CHECKS_KEY = "call_active_checks"
+# Сколько просроченных звонков обрабатывать одной пачкой
+EXPIRE_CHUNK = 1000
+# Через сколько повторить запись пропущенных звонков, если вставка не удалась
+PERSIST_RETRY_SECONDS = 5
+
+
+class TimerWheel:
+    """Хешированное колесо таймеров: schedule/cancel за O(1).
+
+    Каждый advance() сдвигает стрелку на один слот и возвращает ключи,
+    срок которых истек. Задержки длиннее оборота колеса хранят число
+    оставшихся оборотов.
+    """
+
+    def __init__(self, slots: int, tick_seconds: float):
+        self.tick_seconds = tick_seconds
+        self._slots: List[Dict[Hashable, int]] = [{} for _ in range(slots)]
+        self._index: Dict[Hashable, int] = {}
+        self._position = 0
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._index
+
+    def schedule(self, key: Hashable, delay_seconds: float):
+        self.cancel(key)
+        size = len(self._slots)
+        ticks = max(1, math.ceil(delay_seconds / self.tick_seconds))
+        slot = (self._position + ticks) % size
+        self._slots[slot][key] = (ticks - 1) // size
+        self._index[key] = slot
+
+    def cancel(self, key: Hashable) -> bool:
+        slot = self._index.pop(key, None)
+        if slot is None:
+            return False
+        self._slots[slot].pop(key, None)
+        return True
+
+    def advance(self) -> List[Hashable]:
+        self._position = (self._position + 1) % len(self._slots)
+        bucket = self._slots[self._position]
+        expired = []
+        for key, rounds in bucket.items():
+            if rounds == 0:
+                expired.append(key)
+            else:
+                bucket[key] = rounds - 1
+        for key in expired:
+            del bucket[key]
+            del self._index[key]
+        return expired
+
+
+def _insert_calls(rooms: List[CallRoom]):
+    """Итоговые записи звонков одной вставкой на тик.
+
+    Уже записанные пропускаются: запись повторяется, пока комната с итоговым
+    статусом остается в Redis, и ее может повторить другой узел.
+    """
+    db = SessionLocal()
+    try:
+        existing = set(db.execute(
+            select(Call.id).where(Call.id.in_([room.call_id for room in rooms]))
+        ).scalars())
+        rows = [
+            {
+                "id": room.call_id,
+                "chat_id": room.chat_id,
+                "initiator_id": room.initiator_id,
+                "call_type": room.call_type,
+                "status": room.status,
+                "started_at": room.started_at,
+                "answered_at": room.answered_at,
+                "ended_at": room.ended_at,
+            }
+            for room in rooms
+            if room.call_id not in existing
+        ]
+        if rows:
+            db.execute(insert(Call), rows)
+            db.commit()
+    finally:
+        db.close()
+
+
+class RingingTimeouts:
+    """Истечение звонков, на которые не ответили, и брошенных активных.
+
+    Таймеры живут в локальном колесе; дедлайны дублируются в sorted set
+    call_timeouts в Redis. Если узел упал, его просроченные звонки на
+    следующем тике подбирает любой другой узел - переход RINGING -> MISSED
+    атомарный, так что двойной обработки не бывает. Дедлайн снимается только
+    после записи итога в Postgres: если вставка не удалась, комната остается
+    MISSED в Redis и запись повторяется. Так же через finish() записываются
+    отклоненные и завершенные звонки.
+
+    Принятые звонки проверяются раз в CALL_ACTIVE_CHECK_SECONDS (sorted set
+    call_active_checks): клиенты могли уйти без /end, и комната истекла бы
+    по TTL, не попав в историю. Звонок, в котором в сети меньше двух
+    присоединившихся или чья комната близка к истечению, завершается (ENDED).
+    """
+
+    def __init__(self):
+        self.redis_client: redis.Redis = None
+        self.manager = None
+        self.wheel: Optional[TimerWheel] = None
+        self._task: Optional[asyncio.Task] = None
+        # Без Redis: call_id -> время следующей проверки активного звонка
+        self._active_checks: Dict[int, float] = {}
+        self.stats = {
+            "scheduled": 0, "cancelled": 0, "missed": 0, "recovered": 0,
+            "abandoned": 0, "persist_errors": 0,
+        }
+
+    async def start(self, manager):
+        self.manager = manager
+        self.redis_client = manager.redis_client
+        self.wheel = TimerWheel(settings.CALL_TIMER_WHEEL_SLOTS, settings.CALL_TIMER_TICK_MS / 1000)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def schedule(self, call_id: int):
+        timeout = settings.CALL_RINGING_TIMEOUT_SECONDS
+        self.wheel.schedule(call_id, timeout)
+        self.stats["scheduled"] += 1
+        if self.redis_client:
+            await self.redis_client.zadd(TIMEOUTS_KEY, {str(call_id): time.time() + timeout})
+
+    async def cancel(self, call_id: int):
+        """Снять таймер звонка и проверки активного звонка"""
+        if self.wheel.cancel(call_id):
+            self.stats["cancelled"] += 1
+        self._active_checks.pop(call_id, None)
+        if self.redis_client:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                pipe.zrem(TIMEOUTS_KEY, str(call_id))
+                pipe.zrem(ACTIVE_CHECKS_KEY, str(call_id))
+                await pipe.execute()
+
+    async def finish(self, room: CallRoom):
+        """Записать итог отклоненного или завершенного звонка, затем снять таймеры.
+
+        Если вставка не удалась, комната остается в Redis с итоговым статусом,
+        а звонок ставится в проверки активных: запись повторит _check_active.
+        """
+        try:
+            await asyncio.to_thread(_insert_calls, [room])
+        except Exception as e:
+            print(f"Call insert failed: {e}")
+            self.stats["persist_errors"] += 1
+            await self.watch_active([room.call_id], delay=PERSIST_RETRY_SECONDS)
+            return
+        await self.cancel(room.call_id)
+        await call_rooms.remove(room)
+
+    async def watch_active(self, call_ids: List[int], delay: Optional[float] = None):
+        """Запланировать проверку активных звонков через CALL_ACTIVE_CHECK_SECONDS"""
+        if not call_ids:
+            return
+        at = time.time() + (settings.CALL_ACTIVE_CHECK_SECONDS if delay is None else delay)
+        if self.redis_client:
+            await self.redis_client.zadd(ACTIVE_CHECKS_KEY, {str(call_id): at for call_id in call_ids})
+        else:
+            for call_id in call_ids:
+                self._active_checks[call_id] = at
+
+    async def _run(self):
+        tick = self.wheel.tick_seconds
+        next_tick = time.monotonic() + tick
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+            # Если цикл притормозил, догнать пропущенные тики
+            expired = []
+            while next_tick <= time.monotonic():
+                expired.extend(self.wheel.advance())
+                next_tick += tick
+            try:
+                if self.redis_client:
+                    expired.extend(await self._recover_orphans(exclude=expired))
+                for i in range(0, len(expired), EXPIRE_CHUNK):
+                    await self._expire(expired[i:i + EXPIRE_CHUNK])
+                await self._check_active()
+            except Exception as e:
+                print(f"Ringing timeout error: {e}")
+
+    async def _recover_orphans(self, exclude: List[int]) -> List[int]:
+        """Дедлайны, просроченные дольше двух тиков - таймеры упавших узлов"""
+        grace = 2 * self.wheel.tick_seconds
+        overdue = await self.redis_client.zrangebyscore(
+            TIMEOUTS_KEY, "-inf", time.time() - grace, start=0, num=EXPIRE_CHUNK
+        )
+        skip = set(exclude)
+        orphans = [int(call_id) for call_id in overdue if int(call_id) not in skip]
+        for call_id in orphans:
+            self.wheel.cancel(call_id)
+        self.stats["recovered"] += len(orphans)
+        return orphans
+
+    async def _expire(self, call_ids: List[int]):
+        expired, unsaved = await call_rooms.expire_ringing(call_ids)
+        rooms = expired + unsaved
+        if rooms:
+            try:
+                await asyncio.to_thread(_insert_calls, rooms)
+            except Exception as e:
+                # Дедлайны остаются: комнаты уже MISSED, запись повторится
+                print(f"Missed call insert failed: {e}")
+                self.stats["persist_errors"] += 1
+                failed = {room.call_id for room in rooms}
+                await self._retry_later(list(failed))
+                call_ids = [call_id for call_id in call_ids if call_id not in failed]
+                rooms = []
+            await call_rooms.remove_many(rooms)
+        if self.redis_client and call_ids:
+            await self.redis_client.zrem(TIMEOUTS_KEY, *[str(call_id) for call_id in call_ids])
+        self.stats["missed"] += len(rooms)
+
+        # Участники узнают о пропущенном звонке, когда он уже в истории
+        for room in rooms:
+            await self.manager.send_to_chat(
+                {
+                    "type": "call_missed",
+                    "data": {
+                        "call_id": room.call_id,
+                        "chat_id": room.chat_id,
+                        "initiator_id": room.initiator_id
+                    }
+                },
+                list(room.participants)
+            )
+
+    async def _retry_later(self, call_ids: List[int]):
+        for call_id in call_ids:
+            self.wheel.schedule(call_id, PERSIST_RETRY_SECONDS)
+        if self.redis_client:
+            at = time.time() + PERSIST_RETRY_SECONDS
+            await self.redis_client.zadd(TIMEOUTS_KEY, {str(call_id): at for call_id in call_ids})
+
+    async def _check_active(self):
+        now = time.time()
+        if self.redis_client:
+            due = [
+                int(call_id) for call_id in
+                await self.redis_client.zrangebyscore(ACTIVE_CHECKS_KEY, "-inf", now, start=0, num=EXPIRE_CHUNK)
+            ]
+        else:
+            due = [call_id for call_id, at in self._active_checks.items() if at <= now]
+        if not due:
+            return
+
+        # Комнату нужно завершить до истечения TTL, с запасом в две проверки
+        max_age = settings.CALL_ROOM_TTL_SECONDS - 2 * settings.CALL_ACTIVE_CHECK_SECONDS
+        ended: List[CallRoom] = []
+        # Завершены, но не записаны (ошибка записи на этом или другом узле)
+        unsaved: List[CallRoom] = []
+        gone: List[int] = []
+        recheck: List[int] = []
+        retry: List[int] = []
+        for call_id in due:
+            room = await call_rooms.get(call_id)
+            if room is None:
+                gone.append(call_id)
+            elif room.status in FINAL_STATUSES:
+                unsaved.append(room)
+            elif room.status != CallStatus.ACTIVE.value:
+                gone.append(call_id)
+            elif now - room.started_at.timestamp() < max_age and await self._in_progress(room):
+                recheck.append(call_id)
+            else:
+                room, ok = await call_rooms.transition(call_id, [CallStatus.ACTIVE], CallStatus.ENDED)
+                if ok:
+                    ended.append(room)
+                else:
+                    recheck.append(call_id)
+
+        finished = ended + unsaved
+        if finished:
+            try:
+                await asyncio.to_thread(_insert_calls, finished)
+            except Exception as e:
+                # Комнаты остаются в Redis с итоговым статусом - запись повторится
+                print(f"Abandoned call insert failed: {e}")
+                self.stats["persist_errors"] += 1
+                retry = [room.call_id for room in finished]
+                finished = []
+            await call_rooms.remove_many(finished)
+        gone.extend(room.call_id for room in finished)
+        if self.redis_client and gone:
+            await self.redis_client.zrem(ACTIVE_CHECKS_KEY, *[str(call_id) for call_id in gone])
+        for call_id in gone:
+            self._active_checks.pop(call_id, None)
+        await self.watch_active(recheck)
+        await self.watch_active(retry, delay=PERSIST_RETRY_SECONDS)
+        self.stats["abandoned"] += len(ended)
+
+        for room in ended:
+            await self.manager.send_to_chat(
+                {"type": "call_ended", "data": {"call_id": room.call_id, "ended_by": None}},
+                list(room.participants)
+            )
+
+    @staticmethod
+    async def _in_progress(room: CallRoom) -> bool:
+        """В сети хотя бы двое присоединившихся"""
+        statuses = await presence.get_statuses(room.joined)
+        return sum(1 for status in statuses.values() if status == UserStatus.ONLINE.value) >= 2
+
+
+ringing_timeouts = RingingTimeouts()
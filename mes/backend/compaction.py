@@ -0,0 +1,214 @@
+"""Фоновое уплотнение: удаленные сообщения, осиротевшие строки и файлы.
+
+delete_message только помечает сообщение (is_deleted, content = NULL).
+Раз в COMPACTION_INTERVAL_SECONDS один узел (отметка в Redis) проходит:
+
+1. Удаленные сообщения старше COMPACTION_TOMBSTONE_DAYS - строки сообщений
+   вместе с реакциями и прочтениями.
+2. Реакции и прочтения без сообщения: внешних ключей на messages.id нет
+   (см. message_partitions.py), каскад при удалении чата их не трогает.
+3. Файлы в media/, на которые не ссылаются ни пользователи, ни чаты, ни
+   сообщения (в том числе архивные) - например, старая аватарка с другим
+   расширением или вложение удаленного сообщения.
+
+Каждый шаг - короткая транзакция на COMPACTION_BATCH_SIZE строк или файлов,
+между шагами пауза COMPACTION_BATCH_PAUSE_SECONDS, за проход не больше
+COMPACTION_MAX_BATCHES шагов каждого вида. Курсоры по id сохраняются между
+проходами: длинная таблица проходится за несколько запусков.
+"""
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, exists, func, select, text
+
+from config import settings
+from database import get_engine
+from message_partitions import DETACHED_QUERY, MAINTENANCE_LOCK_KEY, message_partitions
+from models import Chat, Message, MessageRead, MessageReaction, User
+
+# Каталог загрузок, как в main.py; URL файла - /media/<путь внутри каталога>
+MEDIA_ROOT = Path("media")
+MEDIA_URL_PREFIX = "/media/"
+# Отметка прохода: пока живет ключ, другие узлы проход пропускают
+PASS_KEY = "compaction:pass"
+# Строки под чужой блокировкой не ждем - шаг повторится в следующий проход
+LOCK_TIMEOUT = "2s"
+
+CHILD_TABLES = {"reactions": MessageReaction, "reads": MessageRead}
+
+
+class Compactor:
+    """Пакетная чистка удаленных сообщений и неиспользуемых файлов"""
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._redis = None
+        self._cursors: Dict[str, int] = {"tombstones": 0, **{name: 0 for name in CHILD_TABLES}}
+        self.stats = {
+            "tombstones": 0, "reactions": 0, "reads": 0,
+            "media_files": 0, "media_bytes": 0, "passes": 0, "last_run": None
+        }
+
+    async def start(self, manager):
+        self._redis = manager.redis_client
+        if settings.COMPACTION_INTERVAL_SECONDS > 0:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                if await self._claim_pass():
+                    await self.run_pass()
+            except Exception as e:
+                print(f"Compaction failed: {e}")
+            await asyncio.sleep(settings.COMPACTION_INTERVAL_SECONDS)
+
+    async def _claim_pass(self) -> bool:
+        if not self._redis:
+            return True
+        ttl = max(int(settings.COMPACTION_INTERVAL_SECONDS), 1)
+        return bool(await self._redis.set(PASS_KEY, "1", nx=True, ex=ttl))
+
+    async def run_pass(self, now: Optional[datetime] = None):
+        now = now or datetime.now(timezone.utc)
+        if settings.COMPACTION_TOMBSTONE_DAYS > 0:
+            cutoff = now - timedelta(days=settings.COMPACTION_TOMBSTONE_DAYS)
+            await self._batches(lambda: self._purge_tombstones(cutoff))
+        for name in CHILD_TABLES:
+            await self._batches(lambda name=name: self._sweep_orphans(name))
+        await self._collect_media(now)
+        self.stats["passes"] += 1
+        self.stats["last_run"] = now.isoformat()
+
+    async def _batches(self, step: Callable[[], bool]):
+        """Шаги в потоке с паузами; step возвращает True, когда дошел до конца"""
+        for _ in range(settings.COMPACTION_MAX_BATCHES):
+            if await asyncio.to_thread(step):
+                return
+            await asyncio.sleep(settings.COMPACTION_BATCH_PAUSE_SECONDS)
+
+    @staticmethod
+    def _set_lock_timeout(connection):
+        if connection.dialect.name == "postgresql":
+            connection.execute(text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+
+    # --- шаги (синхронно, в потоке) ---
+
+    def _purge_tombstones(self, cutoff: datetime) -> bool:
+        """Следующие BATCH_SIZE удаленных сообщений по id; старые - удалить"""
+        after = self._cursors["tombstones"]
+        with get_engine().begin() as connection:
+            self._set_lock_timeout(connection)
+            # is_deleted IS true - условие частичного индекса ix_messages_deleted
+            rows = connection.execute(
+                select(Message.id, func.coalesce(Message.updated_at, Message.created_at))
+                .where(Message.is_deleted.is_(True), Message.id > after)
+                .order_by(Message.id)
+                .limit(settings.COMPACTION_BATCH_SIZE)
+            ).all()
+            expired = [message_id for message_id, deleted_at in rows if deleted_at and _aware(deleted_at) < cutoff]
+            if expired:
+                for model in CHILD_TABLES.values():
+                    connection.execute(delete(model).where(model.message_id.in_(expired)))
+                connection.execute(delete(Message).where(Message.id.in_(expired)))
+        self.stats["tombstones"] += len(expired)
+        if len(rows) < settings.COMPACTION_BATCH_SIZE:
+            self._cursors["tombstones"] = 0
+            return True
+        self._cursors["tombstones"] = rows[-1][0]
+        return False
+
+    def _sweep_orphans(self, name: str) -> bool:
+        """Реакции или прочтения в окне id [курсор, курсор + BATCH_SIZE) без сообщения"""
+        model = CHILD_TABLES[name]
+        after = self._cursors[name]
+        upper = after + settings.COMPACTION_BATCH_SIZE
+        with get_engine().begin() as connection:
+            if connection.dialect.name == "postgresql":
+                # Отсоединенная, но еще не выгруженная секция: ее сообщений нет в messages,
+                # а реакции нужны для архива. Блокировка обслуживания секций на время шага
+                if not connection.execute(select(func.pg_try_advisory_xact_lock(MAINTENANCE_LOCK_KEY))).scalar():
+                    return True
+                if connection.execute(DETACHED_QUERY).first():
+                    return True
+            self._set_lock_timeout(connection)
+            orphan_ids = connection.execute(
+                select(model.id).where(
+                    model.id > after, model.id <= upper,
+                    ~exists().where(Message.id == model.message_id)
+                )
+            ).scalars().all()
+            if orphan_ids:
+                connection.execute(delete(model).where(model.id.in_(orphan_ids)))
+            last_id = connection.execute(select(func.max(model.id))).scalar() or 0
+        self.stats[name] += len(orphan_ids)
+        if upper >= last_id:
+            self._cursors[name] = 0
+            return True
+        self._cursors[name] = upper
+        return False
+
+    # --- файлы ---
+
+    async def _collect_media(self, now: datetime):
+        # Свежие файлы не трогаем: загрузка пишет файл раньше, чем ссылку в БД
+        older_than = now.timestamp() - settings.COMPACTION_MEDIA_GRACE_SECONDS
+        candidates = await asyncio.to_thread(self._media_files, older_than)
+        if not candidates:
+            return
+        archived = await asyncio.to_thread(message_partitions.archived_files)
+        batch_size = settings.COMPACTION_BATCH_SIZE
+        for batch_number, start in enumerate(range(0, len(candidates), batch_size)):
+            if batch_number >= settings.COMPACTION_MAX_BATCHES:
+                break
+            if batch_number:
+                await asyncio.sleep(settings.COMPACTION_BATCH_PAUSE_SECONDS)
+            await asyncio.to_thread(self._remove_unreferenced, candidates[start:start + batch_size], archived)
+
+    @staticmethod
+    def _media_files(older_than: float) -> List[Tuple[str, Path]]:
+        files = []
+        for directory, _, names in os.walk(MEDIA_ROOT):
+            for name in names:
+                path = Path(directory) / name
+                try:
+                    if path.stat().st_mtime > older_than:
+                        continue
+                except FileNotFoundError:
+                    continue
+                files.append((MEDIA_URL_PREFIX + path.relative_to(MEDIA_ROOT).as_posix(), path))
+        return files
+
+    def _remove_unreferenced(self, candidates: List[Tuple[str, Path]], archived: set):
+        urls = [url for url, _ in candidates]
+        with get_engine().connect() as connection:
+            referenced = set(archived)
+            for column in (User.avatar, Chat.avatar, Message.file_url):
+                referenced.update(connection.execute(select(column).where(column.in_(urls))).scalars())
+        for url, path in candidates:
+            if url in referenced:
+                continue
+            try:
+                size = path.stat().st_size
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            self.stats["media_files"] += 1
+            self.stats["media_bytes"] += size
+
+
+def _aware(value: datetime) -> datetime:
+    # SQLite возвращает время без зоны (server_default now() - UTC)
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+compactor = Compactor()
@@ -1,5 +1,6 @@
+from functools import lru_cache
 from pydantic_settings import BaseSettings
-from typing import Optional
+from typing import Dict, List, Optional
 
 class Settings(BaseSettings):
     DATABASE_URL: str
@@ -13,10 +14,148 @@ class Settings(BaseSettings):
     SMTP_USER: Optional[str] = None
     SMTP_PASSWORD: Optional[str] = None
     FRONTEND_URL: str = "http://localhost:3000"
+    # Реплики PostgreSQL для чтения (JSON-список URL); пусто - все запросы на primary
+    DATABASE_REPLICA_URLS: List[str] = []
+    # После записи чтения пользователя столько секунд идут на primary (read-your-writes)
+    REPLICA_STICKY_SECONDS: float = 5
+    # Реплика с отставанием больше порога не получает чтений; период проверки отставания
+    REPLICA_MAX_LAG_SECONDS: float = 2
+    REPLICA_LAG_CHECK_SECONDS: float = 1
+    # Секции messages (PostgreSQL): сколько месяцев создавать наперед, через сколько
+    # дней после конца секция уходит в архив (0 - не архивировать), куда и как часто проверять
+    MESSAGE_PARTITION_PREMAKE_MONTHS: int = 3
+    MESSAGE_ARCHIVE_AFTER_DAYS: int = 365
+    MESSAGE_ARCHIVE_DIR: str = "archive/messages"
+    MESSAGE_PARTITION_CHECK_SECONDS: int = 3600
+    # Компактор (compaction.py): удаленные сообщения старше TOMBSTONE_DAYS вычищаются
+    # (0 - хранить), шаги по BATCH_SIZE строк/файлов с паузой, не больше MAX_BATCHES
+    # шагов каждого вида за проход; файлы media/ моложе GRACE не удаляются
+    COMPACTION_TOMBSTONE_DAYS: int = 30
+    COMPACTION_BATCH_SIZE: int = 500
+    COMPACTION_BATCH_PAUSE_SECONDS: float = 0.2
+    COMPACTION_MAX_BATCHES: int = 200
+    COMPACTION_MEDIA_GRACE_SECONDS: int = 3600
+    COMPACTION_INTERVAL_SECONDS: int = 3600
+    # Счетчики реакций: период пакетного пересчета и сколько сообщений за транзакцию
+    REACTION_FLUSH_MS: int = 500
+    REACTION_FLUSH_BATCH: int = 500
+    # Непрочитанные: период сверки счетчиков Redis с БД (0 - не сверять),
+    # пользователей за шаг и пауза между шагами
+    UNREAD_RECONCILE_SECONDS: int = 900
+    UNREAD_RECONCILE_BATCH: int = 500
+    UNREAD_RECONCILE_PAUSE_SECONDS: float = 0.1
+    # Рассылка в чаты: с какого числа участников - через пул воркеров, воркеров
+    # и получателей в пачке; кэш составов чатов в памяти узла и в Redis
+    FANOUT_LARGE_CHAT_MEMBERS: int = 500
+    FANOUT_WORKERS: int = 8
+    FANOUT_CHUNK_SIZE: int = 256
+    FANOUT_MEMBERS_TTL_SECONDS: int = 60
+    FANOUT_MEMBERS_CACHE_SIZE: int = 1000
+    FANOUT_MEMBERS_REDIS_TTL_SECONDS: int = 86400
+    # Снимок при подключении WebSocket с ?sync=1: чатов, сообщений на чат
+    # и чатов в одном кадре sync_snapshot
+    SYNC_MAX_CHATS: int = 50
+    SYNC_MESSAGES_PER_CHAT: int = 20
+    SYNC_CHUNK_CHATS: int = 10
+    # Кэш профилей и чатов: время жизни записи в Redis и размер LRU процесса без Redis
+    RESPONSE_CACHE_TTL_SECONDS: int = 300
+    RESPONSE_CACHE_LOCAL_SIZE: int = 10000
+    # Web Push: закрытый ключ VAPID (base64url, 32 байта P-256; пусто - push выключен)
+    # и контакт для push-сервисов (mailto: или https:)
+    VAPID_PRIVATE_KEY: str = ""
+    VAPID_SUBJECT: str = "mailto:admin@example.com"
+    # Окно схлопывания событий одного чата в одно уведомление, размер пачки
+    # и период опроса очереди
+    PUSH_COLLAPSE_MS: int = 5000
+    PUSH_BATCH_SIZE: int = 200
+    PUSH_POLL_MS: int = 1000
+    # Одновременных запросов к push-сервисам (и соединений в пуле), повторы
+    # на 429/5xx с экспоненциальной паузой, время жизни уведомления у push-сервиса
+    PUSH_CONCURRENCY: int = 20
+    PUSH_MAX_RETRIES: int = 3
+    PUSH_RETRY_BASE_MS: int = 500
+    PUSH_TTL_SECONDS: int = 86400
+    PUSH_HTTP_TIMEOUT_SECONDS: float = 10.0
+    # Отладка: заголовки X-DB-* с числом и временем SQL-запросов в ответах
+    DEBUG: bool = False
+    # Один и тот же запрос столько раз за HTTP-запрос/событие WS - подозрение на N+1
+    SQL_REPEATED_STATEMENT_THRESHOLD: int = 5
+    # Номер узла для генератора id (0-63). Если не задан, арендуется в Redis при старте
+    # (ключ с TTL, продлевается heartbeat'ом); без Redis при нескольких воркерах обязателен
+    NODE_ID: Optional[int] = None
+    NODE_LEASE_TTL_SECONDS: int = 30
+    # Онлайн-статус: TTL ключа, период heartbeat и окно пакетной рассылки изменений
+    PRESENCE_TTL_SECONDS: int = 60
+    PRESENCE_HEARTBEAT_SECONDS: int = 20
+    PRESENCE_BATCH_WINDOW_MS: int = 500
+    # Liveness WebSocket: пинг после интервала тишины, закрытие если нет ответа за таймаут
+    WS_PING_INTERVAL_SECONDS: int = 20
+    WS_PING_TIMEOUT_SECONDS: int = 20
+    # Сколько пингов и закрытий молчащих соединений reaper ведет одновременно
+    WS_REAPER_CONCURRENCY: int = 256
+    # Предлагать клиентам сжатие permessage-deflate
+    WS_PER_MESSAGE_DEFLATE: bool = True
+    # Микробатчинг исходящих событий для клиентов, подключившихся с ?batch=1
+    WS_BATCH_WINDOW_MS: int = 15
+    WS_BATCH_MAX_EVENTS: int = 100
+    # Реестр соединений узла (connections.py): число шардов и лимит сокетов
+    # одного пользователя на узле (сверх лимита новое соединение закрывается с 1008)
+    WS_REGISTRY_SHARDS: int = 64
+    WS_MAX_CONNECTIONS_PER_USER: int = 10
+    # Остановка узла (serve.py): клиенты получают reconnect с задержкой 0..JITTER,
+    # на досылку очередей и закрытие сокетов дается не больше DRAIN_TIMEOUT
+    WS_DRAIN_RECONNECT_JITTER_MS: int = 10000
+    WS_DRAIN_TIMEOUT_SECONDS: int = 10
+    # Число воркеров serve.py (0 - по числу CPU)
+    WEB_CONCURRENCY: int = 0
+    # Звонки: сколько живет комната в Redis и окно склейки trickle-ICE кандидатов
+    CALL_ROOM_TTL_SECONDS: int = 4 * 60 * 60
+    ICE_BATCH_WINDOW_MS: int = 50
+    # Неотвеченный звонок становится пропущенным через CALL_RINGING_TIMEOUT_SECONDS;
+    # колесо таймеров: шаг и число слотов (один оборот = шаг * слоты)
+    CALL_RINGING_TIMEOUT_SECONDS: int = 45
+    CALL_TIMER_TICK_MS: int = 500
+    CALL_TIMER_WHEEL_SLOTS: int = 256
+    # Активный звонок проверяется раз в CALL_ACTIVE_CHECK_SECONDS: если в сети меньше
+    # двух присоединившихся (клиенты ушли без /end) или комната близка к истечению TTL,
+    # звонок завершается и записывается в историю
+    CALL_ACTIVE_CHECK_SECONDS: int = 60
+    # Лимиты token bucket: событие -> [токенов в секунду, размер корзины].
+    # "connection" - все кадры одного соединения, "message_send" - POST сообщений
+    RATE_LIMITS: Dict[str, List[float]] = {
+        "connection": [50, 200],
+        "typing": [2, 10],
+        "message_read": [20, 100],
+        "webrtc_signal": [50, 200],
+        "ping": [1, 5],
+        "message_send": [5, 20],
+        "reaction": [5, 30],
+    }
+    # Сколько отказов подряд терпеть, прежде чем закрыть соединение
+    RATE_LIMIT_MAX_STRIKES: int = 100
+    # Бюджет холодного старта воркера (импорт + lifespan); превышение пишется в лог
+    STARTUP_BUDGET_MS: int = 1000
+    # Снимки метрик воркеров хоста для /metrics (metrics.py): общий каталог
+    # (пусто - во временной папке по pid родительского процесса) и период записи
+    METRICS_DIR: str = ""
+    METRICS_SNAPSHOT_SECONDS: float = 5
     
     class Config:
         env_file = ".env"
         case_sensitive = True
 
-settings = Settings()
+@lru_cache
+def get_settings() -> Settings:
+    return Settings()
+
+class _LazySettings:
+    """Настройки читаются из окружения при первом обращении, а не при импорте модуля"""
+    
+    def __getattr__(self, name):
+        return getattr(get_settings(), name)
+    
+    def __setattr__(self, name, value):
+        setattr(get_settings(), name, value)
+
+settings = _LazySettings()
 
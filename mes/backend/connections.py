@@ -0,0 +1,156 @@
+"""Реестр WebSocket-соединений узла.
+
+Соединение - одна запись Connection со __slots__: пользователь, устройство,
+время подключения и последнего кадра, кодек и батчер исходящих событий.
+Раньше те же данные лежали в четырех словарях (списки сокетов по
+пользователю, last_seen, codecs, batchers), и отключение было list.remove.
+
+Соединения пользователя - двусвязный список записей (новые в голове), сам
+пользователь - одна запись в одном из WS_REGISTRY_SHARDS словарей по
+user_id % числу шардов. Добавление и удаление - O(1) без контейнера на
+пользователя. Для обхода всех соединений (рассылка всем, reaper, остановка
+узла) у шарда есть кортеж-снимок: он строится при первом обходе после
+изменения шарда и дальше не меняется, поэтому обход может ждать отправки
+(await) без копии всего реестра и без блокировок.
+"""
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from fastapi import WebSocket
+
+# Клиент сам называет устройство (?device=...), длиннее не храним
+DEVICE_MAX_LENGTH = 64
+
+
+class Connection:
+    """Одно соединение WebSocket на узле"""
+    __slots__ = (
+        "websocket", "user_id", "device", "codec", "batcher",
+        "connected_at", "last_seen", "prev", "next",
+    )
+
+    def __init__(self, websocket: WebSocket, user_id: int, codec, device: Optional[str] = None):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.device = device[:DEVICE_MAX_LENGTH] if device else None
+        self.codec = codec
+        # Батчер исходящих событий (только для соединений с ?batch=1)
+        self.batcher = None
+        self.connected_at = self.last_seen = time.monotonic()
+        self.prev: Optional["Connection"] = None
+        self.next: Optional["Connection"] = None
+
+    @property
+    def closed(self) -> bool:
+        return self.codec is None
+
+    def close(self):
+        """Соединение снято с реестра; запись еще может быть в снимке шарда"""
+        self.codec = None
+        if self.batcher is not None:
+            self.batcher.close()
+            self.batcher = None
+
+
+class ConnectionRegistry:
+    """Соединения узла по пользователям, разбитые на шарды"""
+
+    def __init__(self, shards: int):
+        # user_id -> самое новое соединение пользователя (голова списка)
+        self._shards: List[Dict[int, Connection]] = [{} for _ in range(max(shards, 1))]
+        self._snapshots: List[Optional[Tuple[Connection, ...]]] = [None] * len(self._shards)
+        self._sockets: Dict[WebSocket, Connection] = {}
+        self._users = 0
+
+    def _index(self, user_id: int) -> int:
+        return user_id % len(self._shards)
+
+    def __len__(self) -> int:
+        """Пользователи с соединением на узле"""
+        return self._users
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._shards[self._index(user_id)]
+
+    def __iter__(self) -> Iterator[int]:
+        """id пользователей; реестр не должен меняться во время обхода"""
+        for shard in self._shards:
+            yield from shard
+
+    def user_ids(self) -> List[int]:
+        return [user_id for shard in self._shards for user_id in shard]
+
+    def connection_count(self) -> int:
+        return len(self._sockets)
+
+    def get(self, websocket: WebSocket) -> Optional[Connection]:
+        return self._sockets.get(websocket)
+
+    def first(self, user_id: int) -> Optional[Connection]:
+        """Самое новое соединение пользователя; остальные - по next.
+
+        Снятая запись сохраняет next, поэтому обход переживает отключения
+        во время await; подключенные после начала обхода в него не попадут.
+        """
+        return self._shards[user_id % len(self._shards)].get(user_id)
+
+    def for_user(self, user_id: int) -> Iterator[Connection]:
+        """Соединения пользователя, от новых к старым"""
+        return self._walk(self.first(user_id))
+
+    def count(self, user_id: int) -> int:
+        return sum(1 for _ in self.for_user(user_id))
+
+    def add(self, connection: Connection) -> bool:
+        """Зарегистрировать соединение; True - первое у пользователя на узле"""
+        index = self._index(connection.user_id)
+        shard = self._shards[index]
+        head = shard.get(connection.user_id)
+        connection.next = head
+        if head is not None:
+            head.prev = connection
+        else:
+            self._users += 1
+        shard[connection.user_id] = connection
+        self._sockets[connection.websocket] = connection
+        self._snapshots[index] = None
+        return head is None
+
+    def remove(self, websocket: WebSocket) -> Optional[Connection]:
+        """Снять соединение; None - уже снято"""
+        connection = self._sockets.pop(websocket, None)
+        if connection is None:
+            return None
+        index = self._index(connection.user_id)
+        shard = self._shards[index]
+        if connection.prev is not None:
+            connection.prev.next = connection.next
+        elif connection.next is not None:
+            shard[connection.user_id] = connection.next
+        else:
+            del shard[connection.user_id]
+            self._users -= 1
+        if connection.next is not None:
+            connection.next.prev = connection.prev
+        connection.prev = None
+        self._snapshots[index] = None
+        return connection
+
+    def snapshot(self) -> Iterator[Connection]:
+        """Все соединения узла: шард за шардом, по неизменяемым снимкам"""
+        for index in range(len(self._shards)):
+            connections = self._snapshots[index]
+            if connections is None:
+                collected: List[Connection] = []
+                for connection in self._shards[index].values():
+                    while connection is not None:
+                        collected.append(connection)
+                        connection = connection.next
+                connections = self._snapshots[index] = tuple(collected)
+            yield from connections
+
+    @staticmethod
+    def _walk(connection: Optional[Connection]) -> Iterator[Connection]:
+        while connection is not None:
+            yield connection
+            connection = connection.next
@@ -1,17 +1,73 @@
-from sqlalchemy import create_engine
+import threading
+from typing import List
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine, make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from config import settings
+from metrics import InstrumentedQueuePool, instrument_engine
+import query_stats
 
-engine = create_engine(settings.DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Engine создается при первой сессии, а не при импорте: импорт приложения
+# не требует ни настроек окружения, ни доступной БД
+_engine: Engine = None
+_replica_engines: List[Engine] = None
+_engine_lock = threading.Lock()
+
+def _create_engine(url: str, name: str) -> Engine:
+    # SQLite (локальная разработка) оставляет свой пул по умолчанию
+    pool_options = {}
+    if make_url(url).get_backend_name() != "sqlite":
+        pool_options["poolclass"] = InstrumentedQueuePool
+    engine = create_engine(url, **pool_options)
+    instrument_engine(engine, name)
+    query_stats.instrument_engine(engine)
+    return engine
+
+def get_engine() -> Engine:
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = _create_engine(settings.DATABASE_URL, "primary")
+    return _engine
+
+def get_replica_engines() -> List[Engine]:
+    """Engine реплик для чтения (DATABASE_REPLICA_URLS), порядок как в настройках"""
+    global _replica_engines
+    if _replica_engines is None:
+        with _engine_lock:
+            if _replica_engines is None:
+                _replica_engines = [
+                    _create_engine(url, f"replica{index}")
+                    for index, url in enumerate(settings.DATABASE_REPLICA_URLS)
+                ]
+    return _replica_engines
+
+def check_database():
+    """Открыть первое соединение пула (вызывается из lifespan)"""
+    with get_engine().connect() as connection:
+        connection.execute(text("SELECT 1"))
+
+class _LazySessionmaker(sessionmaker):
+    def __call__(self, **local_kw):
+        if self.kw.get("bind") is None:
+            self.configure(bind=get_engine())
+        return super().__call__(**local_kw)
+
+SessionLocal = _LazySessionmaker(autocommit=False, autoflush=False)
 
 Base = declarative_base()
 
+def __getattr__(name):
+    # from database import engine - тот же ленивый engine
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
-
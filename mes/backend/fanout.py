@@ -0,0 +1,188 @@
+"""Рассылка событий участникам чата, в том числе группам на тысячи человек.
+
+Состав чата - отсортированный array('i') id участников (4 байта на участника
+вместо ORM-объекта User): в памяти узла на FANOUT_MEMBERS_TTL_SECONDS
+(LRU на FANOUT_MEMBERS_CACHE_SIZE чатов), общий для узлов - множество Redis
+chat_members:{chat_id}, без него - один запрос по chat_participants без
+загрузки пользователей. Участники после создания чата не меняются, поэтому
+кэш не сбрасывается, только истекает.
+
+Чаты меньше FANOUT_LARGE_CHAT_MEMBERS рассылаются как раньше, прямо в
+запросе (manager.send_to_chat). Для больших выбираются только получатели с
+соединением на этом узле (обход меньшего из двух множеств), они делятся между
+FANOUT_WORKERS постоянными воркерами по user_id % FANOUT_WORKERS и уходят
+пачками по FANOUT_CHUNK_SIZE. Запрос не ждет доставки; один пользователь
+всегда попадает к одному воркеру, поэтому порядок его событий сохраняется.
+Время от публикации до последней доставки - ws_large_fanout_duration_seconds.
+"""
+import asyncio
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from sqlalchemy import select
+
+from config import settings
+from database import get_engine
+from metrics import WS_FANOUT_RECIPIENTS, WS_LARGE_FANOUT
+from models import chat_participants
+from push import PUSH_EVENTS, push_notifier
+
+
+def _members_key(chat_id: int) -> str:
+    return f"chat_members:{chat_id}"
+
+
+def _load_members(chat_id: int) -> List[int]:
+    with get_engine().connect() as connection:
+        return list(connection.execute(
+            select(chat_participants.c.user_id).where(chat_participants.c.chat_id == chat_id)
+        ).scalars())
+
+
+def contains(members: array, user_id: int) -> bool:
+    index = bisect_left(members, user_id)
+    return index < len(members) and members[index] == user_id
+
+
+class _Run:
+    """Одна рассылка в большой чат: сколько пачек еще в очередях"""
+    __slots__ = ("started", "pending", "recipients")
+
+    def __init__(self, recipients: int, pending: int):
+        self.started = time.perf_counter()
+        self.recipients = recipients
+        self.pending = pending
+
+
+class ChatFanout:
+    """Кэш составов чатов и пул воркеров рассылки для больших групп"""
+
+    def __init__(self):
+        self._manager = None
+        self._redis = None
+        self._members: "OrderedDict[int, Tuple[float, array]]" = OrderedDict()
+        self._queues: List[asyncio.Queue] = []
+        self._workers: List[asyncio.Task] = []
+        self.stats = {
+            "events": 0, "large_events": 0, "recipients": 0, "delivered": 0,
+            "member_loads": 0, "last_ms": 0.0, "max_ms": 0.0
+        }
+
+    async def start(self, manager):
+        self._manager = manager
+        self._redis = manager.redis_client
+        self._queues = [asyncio.Queue() for _ in range(max(settings.FANOUT_WORKERS, 1))]
+        self._workers = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queues = []
+        self._members.clear()
+
+    def queued_chunks(self) -> int:
+        """Пачки, ждущие воркеров"""
+        return sum(queue.qsize() for queue in self._queues)
+
+    # --- состав чата ---
+
+    async def members(self, chat_id: int) -> array:
+        """Отсортированные id участников; пустой - чата нет"""
+        now = time.monotonic()
+        cached = self._members.get(chat_id)
+        if cached is not None and cached[0] > now:
+            self._members.move_to_end(chat_id)
+            return cached[1]
+
+        user_ids: List[int] = []
+        if self._redis:
+            user_ids = [int(user_id) for user_id in await self._redis.smembers(_members_key(chat_id))]
+        if not user_ids:
+            user_ids = await asyncio.to_thread(_load_members, chat_id)
+            self.stats["member_loads"] += 1
+            if user_ids and self._redis:
+                async with self._redis.pipeline(transaction=True) as pipe:
+                    pipe.sadd(_members_key(chat_id), *user_ids)
+                    pipe.expire(_members_key(chat_id), settings.FANOUT_MEMBERS_REDIS_TTL_SECONDS)
+                    await pipe.execute()
+        members = array("i", sorted(user_ids))
+        if members:
+            self._members[chat_id] = (now + settings.FANOUT_MEMBERS_TTL_SECONDS, members)
+            self._members.move_to_end(chat_id)
+            if len(self._members) > settings.FANOUT_MEMBERS_CACHE_SIZE:
+                self._members.popitem(last=False)
+        return members
+
+    # --- рассылка ---
+
+    async def publish(self, chat_id: int, message: dict, exclude: Optional[int] = None,
+                      members: Optional[array] = None):
+        """Событие всем участникам чата, кроме exclude"""
+        if members is None:
+            members = await self.members(chat_id)
+        self.stats["events"] += 1
+        if len(members) < settings.FANOUT_LARGE_CHAT_MEMBERS or not self._queues:
+            await self._manager.send_to_chat(message, [user_id for user_id in members if user_id != exclude])
+            return
+
+        self.stats["large_events"] += 1
+        local = self._manager.connections
+        if len(local) < len(members):
+            online = [user_id for user_id in local if user_id != exclude and contains(members, user_id)]
+        else:
+            online = [user_id for user_id in members if user_id != exclude and user_id in local]
+
+        shards: List[List[int]] = [[] for _ in self._queues]
+        for user_id in online:
+            shards[user_id % len(shards)].append(user_id)
+        chunk_size = max(settings.FANOUT_CHUNK_SIZE, 1)
+        jobs = [
+            (queue, shard[start:start + chunk_size])
+            for queue, shard in zip(self._queues, shards)
+            for start in range(0, len(shard), chunk_size)
+        ]
+        run = _Run(len(online), len(jobs))
+        # Один кэш закодированных кадров на все пачки события
+        encoded = {}
+        for queue, chunk in jobs:
+            queue.put_nowait((message, encoded, chunk, run))
+        if not jobs:
+            self._finish(run)
+
+        # Остальные участники - в очередь Web Push (как в send_to_chat)
+        if push_notifier.enabled and message.get("type") in PUSH_EVENTS:
+            offline = [user_id for user_id in members if user_id != exclude and user_id not in local]
+            if offline:
+                try:
+                    await push_notifier.enqueue(offline, message)
+                except Exception as e:
+                    print(f"Push enqueue failed: {e}")
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            message, encoded, chunk, run = await queue.get()
+            try:
+                for user_id in chunk:
+                    await self._manager.send_personal_message(message, user_id, encoded)
+                self.stats["delivered"] += len(chunk)
+            except Exception as e:
+                print(f"Fan-out chunk failed: {e}")
+            run.pending -= 1
+            if run.pending == 0:
+                self._finish(run)
+
+    def _finish(self, run: _Run):
+        elapsed = time.perf_counter() - run.started
+        WS_LARGE_FANOUT.observe(elapsed)
+        WS_FANOUT_RECIPIENTS.observe(run.recipients)
+        self.stats["recipients"] += run.recipients
+        self.stats["last_ms"] = round(elapsed * 1000, 2)
+        self.stats["max_ms"] = max(self.stats["max_ms"], self.stats["last_ms"])
+
+
+chat_fanout = ChatFanout()
@@ -0,0 +1,154 @@
+"""Снимок для начальной синхронизации сразу после подключения WebSocket.
+
+Без снимка клиент при каждом открытии делает GET /api/chats/ и по запросу
+истории на каждый чат. С /ws/{token}?sync=1 сервер сам отправляет
+SYNC_MAX_CHATS самых активных чатов (по последнему сообщению) вместе с
+SYNC_MESSAGES_PER_CHAT последними сообщениями каждого и счетчиками
+непрочитанных. Клиент может уменьшить лимиты: ?sync_chats=...&sync_messages=...
+
+Снимок уходит кадрами sync_snapshot по SYNC_CHUNK_CHATS чатов: на кадр два
+запроса - чаты с участниками и последние сообщения (ROW_NUMBER() по чату, в
+PostgreSQL - LATERAL с LIMIT по индексу (chat_id, id)), в памяти не больше
+одного кадра. Последний
+кадр помечен done. События, пришедшие во время отправки снимка, доставляются
+как обычно - клиент объединяет их со снимком по id.
+"""
+import asyncio
+from typing import Dict, List
+
+from fastapi import WebSocket
+from sqlalchemy import and_, func, select, true
+from sqlalchemy.orm import Session, aliased, joinedload
+
+from config import settings
+from database import SessionLocal
+from models import Chat, Message, chat_participants
+from presence import presence
+from replicas import replica_router
+from schemas import ChatResponse, MessageResponse
+from unread import unread_counters
+
+
+def _limit(value, maximum: int) -> int:
+    try:
+        return max(0, min(int(value), maximum))
+    except (TypeError, ValueError):
+        return maximum
+
+
+def wants_snapshot(websocket: WebSocket) -> bool:
+    return websocket.query_params.get("sync") in ("1", "true")
+
+
+def chat_order(db: Session, user_id: int, limit: int) -> List[int]:
+    """id чатов пользователя по убыванию id последнего сообщения"""
+    last_message_id = (
+        select(func.max(Message.id))
+        .where(Message.chat_id == Chat.id, Message.is_deleted == False)
+        .correlate(Chat)
+        .scalar_subquery()
+    )
+    activity = func.coalesce(last_message_id, 0).label("activity")
+    query = (
+        select(Chat.id, activity)
+        .join(chat_participants, and_(chat_participants.c.chat_id == Chat.id, chat_participants.c.user_id == user_id))
+        .order_by(activity.desc(), Chat.id.desc())
+        .limit(limit)
+    )
+    return [chat_id for chat_id, _ in db.execute(query)]
+
+
+def recent_messages(db: Session, chat_ids: List[int], per_chat: int) -> Dict[int, List[Message]]:
+    """Последние per_chat сообщений каждого чата с отправителями - один запрос"""
+    if db.get_bind().dialect.name == "postgresql":
+        # LATERAL читает по индексу (chat_id, id) ровно per_chat строк на чат;
+        # ROW_NUMBER() пронумеровал бы всю историю каждого чата
+        chats = select(Chat.id).where(Chat.id.in_(chat_ids)).subquery()
+        recent = (
+            select(Message)
+            .where(Message.chat_id == chats.c.id, Message.is_deleted == False)
+            .order_by(Message.id.desc())
+            .limit(per_chat)
+            .lateral()
+        )
+        message = aliased(Message, recent)
+        query = db.query(message).select_from(chats).join(recent, true())
+    else:
+        ranked = (
+            select(Message, func.row_number().over(partition_by=Message.chat_id, order_by=Message.id.desc()).label("rn"))
+            .where(Message.chat_id.in_(chat_ids), Message.is_deleted == False)
+            .subquery()
+        )
+        message = aliased(Message, ranked)
+        query = db.query(message).filter(ranked.c.rn <= per_chat)
+    messages: Dict[int, List[Message]] = {chat_id: [] for chat_id in chat_ids}
+    for row in query.options(joinedload(message.sender)).order_by(message.chat_id, message.id):
+        messages[row.chat_id].append(row)
+    return messages
+
+
+def _session(engine) -> Session:
+    return SessionLocal(bind=engine) if engine is not None else SessionLocal()
+
+
+def _load_order(engine, user_id: int, limit: int) -> List[int]:
+    with _session(engine) as db:
+        return chat_order(db, user_id, limit)
+
+
+def _load_chunk(engine, chat_ids: List[int], per_chat: int) -> List[dict]:
+    """Чаты кадра с участниками и последними сообщениями - два запроса (в потоке)"""
+    with _session(engine) as db:
+        chats = {chat.id: chat for chat in db.query(Chat).options(joinedload(Chat.participants)).filter(Chat.id.in_(chat_ids))}
+        messages = recent_messages(db, chat_ids, per_chat) if per_chat else {}
+        return [
+            {
+                **ChatResponse.model_validate(chats[chat_id]).model_dump(mode="json"),
+                "messages": [
+                    MessageResponse.model_validate(message).model_dump(mode="json")
+                    for message in messages.get(chat_id, ())
+                ],
+            }
+            for chat_id in chat_ids
+            if chat_id in chats
+        ]
+
+
+class InitialSync:
+    """Отправка снимка чатов и последних сообщений новому соединению"""
+
+    def __init__(self):
+        self.stats = {"snapshots": 0, "frames": 0, "chats": 0, "messages": 0}
+
+    async def send_snapshot(self, manager, websocket: WebSocket, user_id: int):
+        max_chats = _limit(websocket.query_params.get("sync_chats"), settings.SYNC_MAX_CHATS)
+        per_chat = _limit(websocket.query_params.get("sync_messages"), settings.SYNC_MESSAGES_PER_CHAT)
+        engine = await replica_router.choose(user_id)
+        chat_ids = await asyncio.to_thread(_load_order, engine, user_id, max_chats) if max_chats else []
+        unread = await unread_counters.get_counts(user_id)
+
+        chunk_size = max(settings.SYNC_CHUNK_CHATS, 1)
+        starts = range(0, len(chat_ids), chunk_size) or [0]
+        for index, start in enumerate(starts):
+            chats = []
+            if chat_ids:
+                chats = await asyncio.to_thread(_load_chunk, engine, chat_ids[start:start + chunk_size], per_chat)
+            await presence.overlay([
+                user
+                for chat in chats
+                for user in [*chat["participants"], *(message["sender"] for message in chat["messages"])]
+            ])
+            for chat in chats:
+                chat["unread_count"] = unread.get(chat["id"], 0)
+                self.stats["messages"] += len(chat["messages"])
+            self.stats["chats"] += len(chats)
+            self.stats["frames"] += 1
+            # Мимо батчера: кадры снимка большие и уже сгруппированы
+            await manager.send_frame(websocket, {
+                "type": "sync_snapshot",
+                "data": {"chats": chats, "done": index == len(starts) - 1}
+            })
+        self.stats["snapshots"] += 1
+
+
+initial_sync = InitialSync()
@@ -1,30 +1,99 @@
+import time
+# Начало импорта - для замера холодного старта воркера
+_import_started = time.perf_counter()
+
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
 from fastapi.staticfiles import StaticFiles
 from sqlalchemy.orm import Session
 from contextlib import asynccontextmanager
-import json
 from pathlib import Path
+import asyncio
+import math
 
-from database import engine, Base, get_db
+from database import check_database, get_db
 from models import User
 from websocket_manager import manager
+from presence import presence
+from call_rooms import call_rooms
+from call_timeouts import ringing_timeouts
+from rate_limit import rate_limiter
+from replicas import replica_router, ReadYourWritesMiddleware
+from message_partitions import message_partitions
+from compaction import compactor
+from reactions import reaction_counts
+from unread import unread_counters
+from push import push_notifier
+from response_cache import response_cache
+from initial_sync import initial_sync, wants_snapshot
+from fanout import chat_fanout, contains
 from auth import get_current_user
 from jose import jwt, JWTError
 from config import settings
+from snowflake import id_generator, node_lease
+import metrics
+import query_stats
 
 # Импорт роутеров
 from routers import auth, users, chats, calls
 
-# Создание таблиц
-Base.metadata.create_all(bind=engine)
+# Схема БД управляется миграциями (alembic upgrade head), при импорте нет I/O
+media_path = Path("media")
+
+# Длительность холодного старта: импорт модулей и startup в lifespan
+startup_stats = {}
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
+    lifespan_started = time.perf_counter()
+    startup_stats["import_ms"] = round((lifespan_started - _import_started) * 1000, 1)
+    users.UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    await asyncio.to_thread(check_database)
     await manager.init_redis()
+    # Номер узла для генератора id: явно из настроек или аренда в Redis
+    if settings.NODE_ID is not None:
+        id_generator.set_node_id(settings.NODE_ID)
+    elif manager.redis_client:
+        await node_lease.start(manager.redis_client, settings.NODE_LEASE_TTL_SECONDS)
+    elif settings.WEB_CONCURRENCY > 1:
+        # Все воркеры получили бы номер 0 и одинаковые id
+        raise RuntimeError("NODE_ID is required when running several workers without Redis")
+    await presence.start(manager)
+    rate_limiter.init(manager.redis_client)
+    await replica_router.start(manager)
+    await call_rooms.start(manager)
+    await ringing_timeouts.start(manager)
+    await message_partitions.start(manager)
+    await compactor.start(manager)
+    await reaction_counts.start(manager)
+    await unread_counters.start(manager)
+    await push_notifier.start(manager)
+    await response_cache.start(manager)
+    await chat_fanout.start(manager)
+    manager.start_reaper()
+    await metrics.worker_snapshots.start(settings.METRICS_DIR, settings.METRICS_SNAPSHOT_SECONDS)
+    startup_stats["lifespan_ms"] = round((time.perf_counter() - lifespan_started) * 1000, 1)
+    startup_stats["total_ms"] = round(startup_stats["import_ms"] + startup_stats["lifespan_ms"], 1)
+    if startup_stats["total_ms"] > settings.STARTUP_BUDGET_MS:
+        print(f"Startup took {startup_stats['total_ms']} ms, budget {settings.STARTUP_BUDGET_MS} ms: {startup_stats}")
     yield
     # Shutdown
+    await metrics.worker_snapshots.stop()
+    await manager.stop_reaper()
+    await chat_fanout.stop()
+    await response_cache.stop()
+    await push_notifier.stop()
+    await unread_counters.stop()
+    await reaction_counts.stop()
+    await compactor.stop()
+    await message_partitions.stop()
+    await ringing_timeouts.stop()
+    await call_rooms.stop()
+    await replica_router.stop()
+    await presence.stop()
+    await node_lease.stop()
     if manager.redis_client:
         await manager.redis_client.close()
 
@@ -38,6 +107,18 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(ReadYourWritesMiddleware)
+app.add_middleware(query_stats.QueryStatsMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+
+# Метрики, которые считаются в момент сбора
+metrics.WS_CONNECTIONS.set_function(manager.connections.connection_count)
+metrics.WS_USERS.set_function(lambda: len(manager.connections))
+metrics.WS_QUEUE_DEPTH.labels("batch").set_function(manager.queued_events)
+metrics.WS_QUEUE_DEPTH.labels("presence").set_function(presence.queued_changes)
+metrics.WS_QUEUE_DEPTH.labels("ice").set_function(call_rooms.queued_signals)
+metrics.WS_QUEUE_DEPTH.labels("fanout").set_function(chat_fanout.queued_chunks)
+metrics.WS_QUEUE_DEPTH.labels("call_timeouts").set_function(lambda: len(ringing_timeouts.wheel or ()))
 
 # Подключение роутеров
 app.include_router(auth.router)
@@ -45,10 +126,8 @@ app.include_router(users.router)
 app.include_router(chats.router)
 app.include_router(calls.router)
 
-# Статические файлы
-media_path = Path("media")
-media_path.mkdir(exist_ok=True)
-app.mount("/media", StaticFiles(directory="media"), name="media")
+# Статические файлы (каталог создается в lifespan)
+app.mount("/media", StaticFiles(directory=media_path, check_dir=False), name="media")
 
 @app.get("/")
 async def root():
@@ -56,11 +135,38 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    return {
+        "status": "healthy",
+        "websocket": manager.get_stats(),
+        "presence": presence.stats,
+        "rate_limits": rate_limiter.stats,
+        "db_replicas": replica_router.get_stats(),
+        "message_partitions": message_partitions.stats,
+        "compaction": compactor.stats,
+        "reaction_counts": reaction_counts.stats,
+        "unread": unread_counters.stats,
+        "push": push_notifier.stats,
+        "response_cache": response_cache.stats,
+        "initial_sync": initial_sync.stats,
+        "fanout": chat_fanout.stats,
+        "node_lease": node_lease.stats,
+        "call_timeouts": {"pending": len(ringing_timeouts.wheel or ()), **ringing_timeouts.stats},
+        "startup": startup_stats
+    }
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    snapshots = await asyncio.to_thread(metrics.worker_snapshots.read)
+    return Response(metrics.render(snapshots), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 # WebSocket для чатов и уведомлений
 @app.websocket("/ws/{token}")
 async def websocket_endpoint(websocket: WebSocket, token: str, db: Session = Depends(get_db)):
+    # Узел останавливается - клиент переподключится к другому воркеру
+    if manager.draining:
+        await websocket.close(code=status.WS_1012_SERVICE_RESTART)
+        return
+    
     # Валидация токена
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
@@ -77,15 +183,57 @@ async def websocket_endpoint(websocket: WebSocket, token: str, db: Session = Dep
     if not user:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         return
+    # Соединение из пула вернуть сразу: сокет живет часами, запросы редки
+    db.close()
+    
+    # Сверх WS_MAX_CONNECTIONS_PER_USER соединение закрывается с 1008
+    if not await manager.connect(websocket, user_id):
+        return
+    connection_bucket = rate_limiter.connection_bucket()
+    strikes = 0
+    notice_after = 0.0
     
-    await manager.connect(websocket, user_id)
+    # Учет SQL-запросов текущего события (см. query_stats)
+    event_tracking = None
     
     try:
+        # Начальная синхронизация одним потоком кадров вместо десятков HTTP-запросов
+        if wants_snapshot(websocket):
+            await initial_sync.send_snapshot(manager, websocket, user_id)
+        
         while True:
-            data = await websocket.receive_text()
-            message_data = json.loads(data)
+            # Не держать соединение из пула, пока ждем кадр от клиента
+            db.close()
+            if event_tracking:
+                query_stats.finish(event_tracking, user_id=user_id)
+                event_tracking = None
+            message_data = await manager.receive(websocket)
             
             message_type = message_data.get("type")
+            event_tracking = query_stats.start(f"ws {message_type}")
+            
+            # Лимиты: сначала на соединение (локально), затем на пользователя и тип события
+            retry_after = connection_bucket.take() if connection_bucket else 0
+            if retry_after:
+                rate_limiter.record("connection", False)
+            else:
+                retry_after = await rate_limiter.hit(user_id, message_type)
+            if retry_after:
+                strikes += 1
+                if strikes >= settings.RATE_LIMIT_MAX_STRIKES:
+                    await manager.disconnect(websocket, user_id)
+                    await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+                    return
+                # Не больше одного уведомления за окно ожидания
+                now = time.monotonic()
+                if now >= notice_after:
+                    notice_after = now + retry_after
+                    await manager.send(websocket, {
+                        "type": "rate_limited",
+                        "data": {"event": message_type, "retry_after_ms": math.ceil(retry_after * 1000)}
+                    })
+                continue
+            strikes = 0
             
             # Обработка различных типов сообщений
             if message_type == "typing":
@@ -94,12 +242,11 @@ async def websocket_endpoint(websocket: WebSocket, token: str, db: Session = Dep
                 
                 await manager.set_typing(chat_id, user_id, is_typing)
                 
-                # Уведомить других участников чата
-                from models import Chat
-                chat = db.query(Chat).filter(Chat.id == chat_id).first()
-                if chat:
-                    participant_ids = [p.id for p in chat.participants if p.id != user_id]
-                    await manager.send_to_chat(
+                # Уведомить других участников чата (состав - из кэша fanout.py)
+                members = await chat_fanout.members(chat_id) if isinstance(chat_id, int) else ()
+                if contains(members, user_id):
+                    await chat_fanout.publish(
+                        chat_id,
                         {
                             "type": "user_typing",
                             "data": {
@@ -109,25 +256,25 @@ async def websocket_endpoint(websocket: WebSocket, token: str, db: Session = Dep
                                 "username": user.username
                             }
                         },
-                        participant_ids
+                        exclude=user_id,
+                        members=members
                     )
             
             elif message_type == "webrtc_signal":
-                # WebRTC сигналинг
+                # WebRTC сигналинг только между участниками одного активного звонка
                 target_user_id = message_data.get("target_user_id")
-                signal_data = message_data.get("data")
+                signal_data = message_data.get("data") or {}
+                call_id = message_data.get("call_id") or await call_rooms.active_call_for(user_id)
+                room = await call_rooms.get(call_id) if call_id else None
+                
+                if not call_rooms.can_signal(room, user_id, target_user_id):
+                    await manager.send(websocket, {
+                        "type": "error",
+                        "data": {"code": "signal_rejected", "call_id": call_id}
+                    })
+                    continue
                 
-                await manager.send_personal_message(
-                    {
-                        "type": "webrtc_signal",
-                        "data": {
-                            "from_user_id": user_id,
-                            "signal_type": signal_data.get("type"),
-                            "signal": signal_data
-                        }
-                    },
-                    target_user_id
-                )
+                await call_rooms.relay_signal(room, user_id, target_user_id, signal_data)
             
             elif message_type == "message_read":
                 # Отметка сообщения как прочитанного
@@ -143,12 +290,16 @@ async def websocket_endpoint(websocket: WebSocket, token: str, db: Session = Dep
                     ).first()
                     
                     if not existing_read:
+                        chat_id, sender_id = message.chat_id, message.sender_id
                         message_read = MessageRead(
                             message_id=message_id,
                             user_id=user_id
                         )
                         db.add(message_read)
                         db.commit()
+                        db.close()
+                        # Отметка прочтения и счетчик непрочитанных чата
+                        await unread_counters.mark_read(user_id, chat_id, message_id)
                         
                         # Уведомить отправителя
                         await manager.send_personal_message(
@@ -157,14 +308,18 @@ async def websocket_endpoint(websocket: WebSocket, token: str, db: Session = Dep
                                 "data": {
                                     "message_id": message_id,
                                     "user_id": user_id,
-                                    "chat_id": message.chat_id
+                                    "chat_id": chat_id
                                 }
                             },
-                            message.sender_id
+                            sender_id
                         )
             
             elif message_type == "ping":
-                await websocket.send_json({"type": "pong"})
+                await manager.send(websocket, {"type": "pong"})
+            
+            elif message_type == "pong":
+                # Ответ на серверный ping - last_seen уже обновлен
+                pass
     
     except WebSocketDisconnect:
         await manager.disconnect(websocket, user_id)
@@ -173,6 +328,17 @@ async def websocket_endpoint(websocket: WebSocket, token: str, db: Session = Dep
         await manager.disconnect(websocket, user_id)
 
 if __name__ == "__main__":
+    # Запуск для разработки; в продакшене - serve.py
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        reload=True,
+        # Протокольные ping/pong на уровне сервера (реализация websockets)
+        ws_ping_interval=settings.WS_PING_INTERVAL_SECONDS,
+        ws_ping_timeout=settings.WS_PING_TIMEOUT_SECONDS,
+        # permessage-deflate включается, только если клиент запросил его при рукопожатии
+        ws_per_message_deflate=settings.WS_PER_MESSAGE_DEFLATE
+    )
 
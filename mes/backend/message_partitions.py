@@ -0,0 +1,310 @@
+"""Помесячные секции messages и архив старых секций в сжатых файлах.
+
+В PostgreSQL messages секционирована по диапазонам id (миграция 0002):
+id - snowflake, поэтому границы секций - начала месяцев. Фоновая задача
+заранее создает секции на MESSAGE_PARTITION_PREMAKE_MONTHS вперед, а секции,
+закончившиеся раньше MESSAGE_ARCHIVE_AFTER_DAYS назад, отсоединяет,
+выгружает в MESSAGE_ARCHIVE_DIR и удаляет вместе с реакциями и прочтениями.
+
+Архив секции - два файла: <секция>.jsonl.gz и <секция>.json. Сообщения
+каждого чата лежат отдельным gzip-членом (по возрастанию id), а индекс
+хранит для чата смещение, длину и число сообщений - чтение истории одного
+чата распаковывает только его кусок. Удаленные сообщения в архив не идут;
+файлы вложений остаются в media/, их список тоже пишется в индекс.
+"""
+import asyncio
+import gzip
+import json
+import os
+import re
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import text
+
+from config import settings
+from database import get_engine
+from snowflake import snowflake_from_datetime, snowflake_to_datetime
+
+PARENT_TABLE = "messages"
+PARTITION_PREFIX = "messages_"
+# Ключ pg_try_advisory_lock: секции обслуживает один узел за раз
+MAINTENANCE_LOCK_KEY = 0x6D657373
+# Не ждать блокировку messages дольше, чем это - повторим в следующий проход
+DETACH_LOCK_TIMEOUT = "5s"
+
+PARTITIONS_QUERY = text("""
+SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = 'messages'::regclass
+""")
+# Отсоединенные, но еще не выгруженные секции (процесс прервался посередине)
+DETACHED_QUERY = text("""
+SELECT c.relname FROM pg_class c
+WHERE c.relkind = 'r' AND NOT c.relispartition AND c.relnamespace = 'public'::regnamespace
+  AND (c.relname = 'messages_legacy' OR c.relname ~ '^messages_p[0-9]{6}$')
+""")
+BOUND_RE = re.compile(r"FROM \((.+)\) TO \((.+)\)")
+
+# Сообщение со своими реакциями и прочтениями - одна строка архива
+EXPORT_QUERY = """
+SELECT m.id, m.chat_id, m.sender_id, m.content, m.message_type, m.file_url, m.reply_to,
+       m.is_edited, m.is_deleted, m.reaction_counts, m.created_at, m.updated_at,
+       (SELECT coalesce(json_agg(json_build_object(
+            'user_id', r.user_id, 'emoji', r.emoji, 'created_at', r.created_at)), '[]')
+        FROM message_reactions r WHERE r.message_id = m.id) AS reactions,
+       (SELECT coalesce(json_agg(json_build_object(
+            'user_id', mr.user_id, 'read_at', mr.read_at)), '[]')
+        FROM message_reads mr WHERE mr.message_id = m.id) AS read_by
+FROM {table} m
+WHERE NOT coalesce(m.is_deleted, false)
+ORDER BY m.chat_id, m.id
+"""
+
+
+def is_partition(name: str) -> bool:
+    """Таблица-секция messages (ее нет в моделях - alembic ее не сравнивает)"""
+    return name.startswith(PARTITION_PREFIX)
+
+
+def _month_start(value: date) -> datetime:
+    return datetime(value.year, value.month, 1, tzinfo=timezone.utc)
+
+
+def _add_months(value: datetime, months: int) -> datetime:
+    month = value.month - 1 + months
+    return value.replace(year=value.year + month // 12, month=month % 12 + 1)
+
+
+def _parse_bound(value: str) -> Optional[int]:
+    value = value.strip().strip("'")
+    return None if value in ("MINVALUE", "MAXVALUE") else int(value)
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class MessagePartitions:
+    """Обслуживание секций messages и чтение архива"""
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        # Индексы архивов (новые первыми) и mtime каталога, по которому они прочитаны
+        self._indexes: List[dict] = []
+        self._indexes_mtime: Optional[float] = None
+        self.stats = {"partitions": 0, "created": 0, "archived": 0, "archive_reads": 0, "last_run": None}
+
+    async def start(self, manager):
+        if get_engine().dialect.name == "postgresql":
+            self._task = asyncio.create_task(self._maintenance_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _maintenance_loop(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.maintain)
+            except Exception as e:
+                print(f"Message partition maintenance failed: {e}")
+            await asyncio.sleep(settings.MESSAGE_PARTITION_CHECK_SECONDS)
+
+    # --- обслуживание секций (синхронно, в потоке) ---
+
+    def maintain(self, now: Optional[datetime] = None):
+        """Создать секции наперед и заархивировать старые"""
+        now = now or datetime.now(timezone.utc)
+        engine = get_engine()
+        with engine.connect() as lock_connection:
+            if not lock_connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": MAINTENANCE_LOCK_KEY}).scalar():
+                return
+            try:
+                self._maintain(engine, now)
+            finally:
+                lock_connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MAINTENANCE_LOCK_KEY})
+                lock_connection.commit()
+        self.stats["last_run"] = now.isoformat()
+
+    def _maintain(self, engine, now: datetime):
+        with engine.begin() as connection:
+            partitions = self._partitions(connection)
+            if not partitions:
+                # Таблица не секционирована (миграция 0002 не применена)
+                return
+            self._premake(connection, partitions, now)
+            detached = [row[0] for row in connection.execute(DETACHED_QUERY)]
+
+        # Секции, отсоединенные в прошлый раз, но не выгруженные до конца
+        for name in detached:
+            self._archive(name)
+        if settings.MESSAGE_ARCHIVE_AFTER_DAYS > 0:
+            cutoff = snowflake_from_datetime(now - timedelta(days=settings.MESSAGE_ARCHIVE_AFTER_DAYS))
+            for name, lower, upper in partitions:
+                if upper is not None and upper <= cutoff and self._detach(name):
+                    self._archive(name)
+        with engine.connect() as connection:
+            self.stats["partitions"] = len(self._partitions(connection))
+
+    @staticmethod
+    def _partitions(connection) -> List[Tuple[str, Optional[int], Optional[int]]]:
+        if connection.execute(text("SELECT to_regclass('messages')")).scalar() is None:
+            return []
+        partitions = []
+        for name, bound in connection.execute(PARTITIONS_QUERY):
+            match = BOUND_RE.search(bound or "")
+            if match:
+                partitions.append((name, _parse_bound(match.group(1)), _parse_bound(match.group(2))))
+        return sorted(partitions, key=lambda row: row[2] if row[2] is not None else float("inf"))
+
+    def _premake(self, connection, partitions, now: datetime):
+        upper = max((row[2] for row in partitions if row[2] is not None), default=None)
+        if upper is None:
+            return
+        start = _month_start(snowflake_to_datetime(upper).date())
+        horizon = _add_months(_month_start(now.date()), settings.MESSAGE_PARTITION_PREMAKE_MONTHS + 1)
+        while start < horizon:
+            end = _add_months(start, 1)
+            name = f"{PARTITION_PREFIX}p{start:%Y%m}"
+            lower = max(upper, snowflake_from_datetime(start))
+            connection.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {PARENT_TABLE} "
+                f"FOR VALUES FROM ({lower}) TO ({snowflake_from_datetime(end)})"
+            ))
+            self.stats["created"] += 1
+            upper = snowflake_from_datetime(end)
+            start = end
+
+    def _detach(self, name: str) -> bool:
+        try:
+            with get_engine().begin() as connection:
+                connection.execute(text(f"SET LOCAL lock_timeout = '{DETACH_LOCK_TIMEOUT}'"))
+                connection.execute(text(f"ALTER TABLE {PARENT_TABLE} DETACH PARTITION {name}"))
+            return True
+        except Exception as e:
+            print(f"Detach of {name} postponed: {e}")
+            return False
+
+    def _archive(self, name: str):
+        """Выгрузить отсоединенную секцию в файлы и удалить ее из БД"""
+        archive_dir = Path(settings.MESSAGE_ARCHIVE_DIR)
+        archive_dir.mkdir(parents=True, exist_ok=True)
+        data_path = archive_dir / f"{name}.jsonl.gz"
+        index_path = archive_dir / f"{name}.json"
+        engine = get_engine()
+
+        with engine.connect() as connection:
+            bounds = connection.execute(text(f"SELECT min(id), max(id) FROM {name}")).one()
+            chats: Dict[str, list] = {}
+            files = set()
+            total = 0
+            tmp_path = data_path.with_suffix(".tmp")
+            with open(tmp_path, "wb") as f:
+                rows = connection.execution_options(stream_results=True, max_row_buffer=1000).execute(
+                    text(EXPORT_QUERY.format(table=name))
+                ).mappings()
+                chat_id, lines = None, []
+                for row in rows:
+                    if row["chat_id"] != chat_id and lines:
+                        chats[str(chat_id)] = self._write_member(f, lines)
+                        lines = []
+                    chat_id = row["chat_id"]
+                    if row["file_url"]:
+                        files.add(row["file_url"])
+                    lines.append(json.dumps(dict(row), default=_json_default, ensure_ascii=False))
+                    total += 1
+                if lines:
+                    chats[str(chat_id)] = self._write_member(f, lines)
+                f.flush()
+                os.fsync(f.fileno())
+            if not total:
+                # Пустая секция (например, созданная наперед) - файлы не нужны
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, data_path)
+                index = {
+                    "partition": name, "from_id": bounds[0], "to_id": bounds[1],
+                    "messages": total, "chats": chats, "files": sorted(files),
+                }
+                tmp_index = index_path.with_suffix(".tmp")
+                with open(tmp_index, "w") as f:
+                    json.dump(index, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_index, index_path)
+
+        # Файлы на диске - теперь можно удалить строки из БД
+        with engine.begin() as connection:
+            if bounds[0] is not None:
+                for table in ("message_reactions", "message_reads"):
+                    connection.execute(
+                        text(f"DELETE FROM {table} WHERE message_id BETWEEN :lower AND :upper"),
+                        {"lower": bounds[0], "upper": bounds[1]}
+                    )
+            connection.execute(text(f"DROP TABLE {name}"))
+        self.stats["archived"] += 1
+        print(f"Archived partition {name}: {total} messages in {len(chats)} chats")
+
+    @staticmethod
+    def _write_member(f, lines: List[str]) -> list:
+        offset = f.tell()
+        f.write(gzip.compress(("\n".join(lines) + "\n").encode()))
+        return [offset, f.tell() - offset, len(lines)]
+
+    # --- чтение архива ---
+
+    def has_archives(self) -> bool:
+        return bool(self._load_indexes())
+
+    def _load_indexes(self) -> List[dict]:
+        archive_dir = Path(settings.MESSAGE_ARCHIVE_DIR)
+        try:
+            mtime = archive_dir.stat().st_mtime
+        except FileNotFoundError:
+            return []
+        if mtime != self._indexes_mtime:
+            indexes = []
+            for path in archive_dir.glob(f"{PARTITION_PREFIX}*.json"):
+                with open(path) as f:
+                    index = json.load(f)
+                index["path"] = path.with_name(f"{index['partition']}.jsonl.gz")
+                indexes.append(index)
+            self._indexes = sorted(indexes, key=lambda index: index["to_id"] or 0, reverse=True)
+            self._indexes_mtime = mtime
+        return self._indexes
+
+    def archived_files(self) -> Set[str]:
+        """Вложения заархивированных сообщений (компактор их не удаляет)"""
+        return {url for index in self._load_indexes() for url in index.get("files", ())}
+
+    def archived_messages(self, chat_id: int, skip: int, limit: int) -> List[dict]:
+        """Сообщения чата из архива от новых к старым: пропустить skip, вернуть до limit"""
+        result = []
+        for index in self._load_indexes():
+            entry = index["chats"].get(str(chat_id))
+            if entry is None:
+                continue
+            offset, length, count = entry
+            if skip >= count:
+                skip -= count
+                continue
+            with open(index["path"], "rb") as f:
+                f.seek(offset)
+                lines = gzip.decompress(f.read(length)).decode().splitlines()
+            self.stats["archive_reads"] += 1
+            # В файле по возрастанию id, лента - от новых к старым
+            newest_first = [json.loads(line) for line in reversed(lines)]
+            result.extend(newest_first[skip:skip + limit - len(result)])
+            skip = 0
+            if len(result) >= limit:
+                break
+        return result
+
+
+message_partitions = MessagePartitions()
@@ -0,0 +1,417 @@
+"""Метрики в формате Prometheus (text exposition 0.0.4).
+
+Счетчики - обычные числа без блокировок: почти все обновления идут из
+одного потока event loop, а редкие обновления из потоков пула SQLAlchemy
+допускают потерю единичного инкремента ради отсутствия мьютекса на горячем
+пути. Дочерние метрики с метками создаются один раз и дальше берутся из
+словаря.
+
+Каждая серия помечена worker="<pid>": воркеры uvicorn - отдельные процессы,
+и /metrics любого из них отдает серии всех воркеров хоста (WorkerSnapshots).
+Суммы по узлу - sum without (worker).
+"""
+import asyncio
+import json
+import os
+import tempfile
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Tuple
+
+import redis.asyncio as redis
+from redis.asyncio.client import Pipeline
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+# Границы гистограмм задержек (секунды)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], "_Metric"] = {}
+        REGISTRY.append(self)
+
+    def labels(self, *values, **kwargs):
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self) -> List[str]:
+        worker = (str(os.getpid()),)
+        if self.labelnames:
+            lines = []
+            for key, child in list(self._children.items()):
+                lines.extend(child._child_samples(self.name, ("worker",) + self.labelnames, worker + key))
+            return lines
+        return self._child_samples(self.name, ("worker",), worker)
+
+    def _child_samples(self, name, labelnames, labelvalues) -> List[str]:
+        raise NotImplementedError
+
+    def render(self, snapshots: List[Dict[str, List[str]]] = ()) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        for snapshot in snapshots:
+            lines.extend(snapshot.get(self.name, ()))
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        self.value = 0
+        super().__init__(*args, **kwargs)
+
+    def _new_child(self):
+        return Counter.__new__(Counter)._init_child()
+
+    def _init_child(self):
+        self.value = 0
+        return self
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def _child_samples(self, name, labelnames, labelvalues):
+        return [f"{name}{_format_labels(labelnames, labelvalues)} {_format_value(self.value)}"]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        self.value = 0
+        self._function: Optional[Callable[[], float]] = None
+        super().__init__(*args, **kwargs)
+
+    def _new_child(self):
+        child = Gauge.__new__(Gauge)
+        child.value = 0
+        child._function = None
+        return child
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set_function(self, function: Callable[[], float]):
+        """Значение вычисляется при сборе метрик, без работы на горячем пути"""
+        self._function = function
+
+    def _child_samples(self, name, labelnames, labelvalues):
+        value = self.value
+        if self._function is not None:
+            try:
+                value = self._function()
+            except Exception:
+                value = float("nan")
+        return [f"{name}{_format_labels(labelnames, labelvalues)} {_format_value(value)}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self._buckets = tuple(buckets)
+        self._init_counts()
+        super().__init__(name, documentation, labelnames)
+
+    def _init_counts(self):
+        # Последний элемент - корзина +Inf
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        return self
+
+    def _new_child(self):
+        child = Histogram.__new__(Histogram)
+        child._buckets = self._buckets
+        return child._init_counts()
+
+    def observe(self, value: float):
+        self._counts[bisect_left(self._buckets, value)] += 1
+        self._sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def _child_samples(self, name, labelnames, labelvalues):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self._buckets + (float("inf"),), self._counts):
+            cumulative += count
+            le = 'le="' + _format_value(bound) + '"'
+            lines.append(f"{name}_bucket{_format_labels(labelnames, labelvalues, le)} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labelnames, labelvalues)} {_format_value(self._sum)}")
+        lines.append(f"{name}_count{_format_labels(labelnames, labelvalues)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram: Histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+REGISTRY: List[_Metric] = []
+
+
+def render(snapshots: List[Dict[str, List[str]]] = ()) -> str:
+    """Свои метрики и снимки других воркеров (WorkerSnapshots.read)"""
+    return "\n".join(metric.render(snapshots) for metric in REGISTRY) + "\n"
+
+
+class WorkerSnapshots:
+    """Снимки метрик воркеров хоста в общем каталоге.
+
+    Scrape /metrics попадает в случайный воркер, поэтому каждый воркер раз в
+    interval записывает свои серии в <каталог>/<pid>.json, а /metrics отдает
+    свои текущие серии и снимки остальных. Снимок старше трех интервалов -
+    от завершившегося воркера: он удаляется и в ответ не попадает.
+    """
+
+    def __init__(self):
+        self.directory: Optional[str] = None
+        self.interval = 5.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, directory: str, interval: float):
+        # По умолчанию - каталог на процесс-родитель: воркеры одного uvicorn/serve.py
+        self.directory = directory or os.path.join(tempfile.gettempdir(), f"mes-metrics-{os.getppid()}")
+        self.interval = interval
+        os.makedirs(self.directory, exist_ok=True)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.directory:
+            try:
+                os.remove(self._path())
+            except OSError:
+                pass
+
+    def _path(self) -> str:
+        return os.path.join(self.directory, f"{os.getpid()}.json")
+
+    async def _run(self):
+        while True:
+            try:
+                samples = {metric.name: metric._samples() for metric in REGISTRY}
+                await asyncio.to_thread(self._write, samples)
+            except Exception as e:
+                print(f"Metrics snapshot failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def _write(self, samples: Dict[str, List[str]]):
+        path = self._path()
+        with open(path + ".tmp", "w") as f:
+            json.dump(samples, f, separators=(",", ":"))
+        os.replace(path + ".tmp", path)
+
+    def read(self) -> List[Dict[str, List[str]]]:
+        """Снимки остальных живых воркеров (блокирующий I/O - через to_thread)"""
+        if not self.directory:
+            return []
+        own = os.path.basename(self._path())
+        stale = time.time() - 3 * self.interval
+        snapshots = []
+        for entry in os.scandir(self.directory):
+            if entry.name == own or not entry.name.endswith(".json"):
+                continue
+            try:
+                if entry.stat().st_mtime < stale:
+                    os.remove(entry.path)
+                    continue
+                with open(entry.path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                # Файл заменяется или удален прямо сейчас
+                continue
+        return snapshots
+
+
+worker_snapshots = WorkerSnapshots()
+
+
+# HTTP
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests", ("method", "route", "status"))
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "HTTP request latency", ("method", "route"))
+
+# WebSocket
+WS_CONNECTIONS = Gauge("ws_connections", "Open WebSocket connections on this node")
+WS_USERS = Gauge("ws_users", "Users with at least one WebSocket on this node")
+WS_FRAMES_SENT = Counter("ws_frames_sent_total", "WebSocket frames sent")
+WS_FRAMES_RECEIVED = Counter("ws_frames_received_total", "WebSocket frames received")
+WS_SEND_ERRORS = Counter("ws_send_errors_total", "Failed WebSocket sends")
+WS_FANOUT = Histogram("ws_fanout_duration_seconds", "Time to fan out one event to a chat")
+WS_FANOUT_RECIPIENTS = Histogram(
+    "ws_fanout_recipients", "Recipients per fan-out", buckets=(1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+)
+WS_LARGE_FANOUT = Histogram(
+    "ws_large_fanout_duration_seconds", "Time from publish to last delivery in a large chat (fanout.py)"
+)
+WS_QUEUE_DEPTH = Gauge("ws_queue_depth", "Events waiting in outbound queues", ("queue",))
+
+# Postgres
+DB_QUERY = Histogram("db_query_duration_seconds", "SQL statement execution time")
+# engine: primary, replica0, replica1, ... (порядок DATABASE_REPLICA_URLS)
+DB_POOL_WAIT = Histogram("db_pool_checkout_wait_seconds", "Time waiting for a pooled DB connection", ("engine",))
+DB_POOL_CHECKED_OUT = Gauge("db_pool_checked_out", "DB connections currently checked out", ("engine",))
+DB_REPLICA_LAG = Gauge("db_replica_lag_seconds", "Replication lag of read replicas", ("replica",))
+DB_READS = Counter("db_reads_total", "Read-only requests by chosen database", ("target",))
+
+# Кэш ответов (response_cache.py)
+RESPONSE_CACHE = Counter(
+    "response_cache_requests_total", "Cached entity lookups and conditional GETs", ("entity", "result")
+)
+
+# Web Push
+PUSH_REQUESTS = Counter("push_requests_total", "Web Push requests by outcome", ("result",))
+PUSH_QUEUE_COLLAPSED = Counter("push_queue_collapsed_total", "Push events merged into a pending notification")
+
+# Redis
+REDIS_LATENCY = Histogram("redis_command_duration_seconds", "Redis command round-trip time", ("command",))
+REDIS_ERRORS = Counter("redis_errors_total", "Failed Redis commands", ("command",))
+
+
+class MetricsMiddleware:
+    """ASGI middleware: задержка и число HTTP-запросов по шаблону маршрута"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            # Шаблон пути (/api/chats/{chat_id}) вместо конкретного URL - ограниченная кардинальность
+            route = scope.get("route")
+            route_path = getattr(route, "path", None) or "unmatched"
+            method = scope["method"]
+            HTTP_LATENCY.labels(method, route_path).observe(elapsed)
+            HTTP_REQUESTS.labels(method, route_path, status_code).inc()
+
+
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        except Exception:
+            REDIS_ERRORS.labels("PIPELINE").inc()
+            raise
+        finally:
+            REDIS_LATENCY.labels("PIPELINE").observe(time.perf_counter() - start)
+
+
+class InstrumentedRedis(redis.Redis):
+    """Redis-клиент, измеряющий задержку каждой команды и pipeline"""
+
+    async def execute_command(self, *args, **options):
+        command = str(args[0]).upper() if args else "UNKNOWN"
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        except Exception:
+            REDIS_ERRORS.labels(command).inc()
+            raise
+        finally:
+            REDIS_LATENCY.labels(command).observe(time.perf_counter() - start)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> Pipeline:
+        return InstrumentedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool, замеряющий ожидание свободного соединения"""
+
+    engine_label = "primary"
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_WAIT.labels(self.engine_label).observe(time.perf_counter() - start)
+
+
+def instrument_engine(engine, name: str):
+    """Время SQL-запросов и занятость пула соединений; name - метка engine в метриках пула"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("query_start")
+        if starts:
+            DB_QUERY.observe(time.perf_counter() - starts.pop())
+
+    pool = engine.pool
+    if isinstance(pool, InstrumentedQueuePool):
+        pool.engine_label = name
+    if hasattr(pool, "checkedout"):
+        DB_POOL_CHECKED_OUT.labels(name).set_function(pool.checkedout)
@@ -1,7 +1,8 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Table, Text, Enum
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, DateTime, ForeignKey, Table, Text, Enum, Index, JSON
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
+from snowflake import id_generator
 import enum
 
 # Таблица для участников чатов
@@ -9,7 +10,11 @@ chat_participants = Table(
     'chat_participants',
     Base.metadata,
     Column('chat_id', Integer, ForeignKey('chats.id', ondelete='CASCADE')),
-    Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE'))
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE')),
+    # Последнее прочитанное сообщение: все после него - непрочитанные (см. unread.py)
+    Column('last_read_message_id', BigInteger, nullable=True),
+    # Выборки "чаты пользователя" идут от user_id
+    Index('ix_chat_participants_user_chat', 'user_id', 'chat_id')
 )
 
 class UserStatus(str, enum.Enum):
@@ -64,46 +69,76 @@ class MessageType(str, enum.Enum):
 class Message(Base):
     __tablename__ = "messages"
     
-    id = Column(Integer, primary_key=True, index=True)
+    # id генерируется приложением (snowflake) до вставки
+    id = Column(BigInteger, primary_key=True, index=True, autoincrement=False, default=id_generator.next_id)
     chat_id = Column(Integer, ForeignKey("chats.id", ondelete='CASCADE'), nullable=False)
     sender_id = Column(Integer, ForeignKey("users.id", ondelete='CASCADE'), nullable=False)
     content = Column(Text, nullable=True)
     message_type = Column(String, default=MessageType.TEXT)
     file_url = Column(String, nullable=True)
-    reply_to = Column(Integer, ForeignKey("messages.id"), nullable=True)
+    # Ссылки на сообщения без внешних ключей: старые секции messages
+    # отсоединяются и уходят в архив (см. message_partitions.py)
+    reply_to = Column(BigInteger, nullable=True)
     is_edited = Column(Boolean, default=False)
     is_deleted = Column(Boolean, default=False)
+    # {emoji: число реакций}, пересчитывается пачками (см. reactions.py)
+    reaction_counts = Column(JSON, nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     
     # Relationships
     chat = relationship("Chat", back_populates="messages")
     sender = relationship("User", back_populates="sent_messages", foreign_keys=[sender_id])
-    reactions = relationship("MessageReaction", back_populates="message", cascade="all, delete-orphan")
-    read_by = relationship("MessageRead", back_populates="message", cascade="all, delete-orphan")
+    reactions = relationship(
+        "MessageReaction", back_populates="message", cascade="all, delete-orphan",
+        primaryjoin="Message.id == foreign(MessageReaction.message_id)"
+    )
+    read_by = relationship(
+        "MessageRead", back_populates="message", cascade="all, delete-orphan",
+        primaryjoin="Message.id == foreign(MessageRead.message_id)"
+    )
+    
+    # История чата: выборка по chat_id в порядке id (он же порядок времени).
+    # Частичные индексы - для компактора (compaction.py): удаленные и файлы
+    __table_args__ = (
+        Index('ix_messages_chat_id_id', 'chat_id', 'id'),
+        Index('ix_messages_deleted', 'id', postgresql_where=is_deleted.is_(True), sqlite_where=is_deleted.is_(True)),
+        Index('ix_messages_file_url', 'file_url', postgresql_where=file_url.isnot(None), sqlite_where=file_url.isnot(None)),
+    )
 
 class MessageReaction(Base):
     __tablename__ = "message_reactions"
     
     id = Column(Integer, primary_key=True, index=True)
-    message_id = Column(Integer, ForeignKey("messages.id", ondelete='CASCADE'), nullable=False)
+    message_id = Column(BigInteger, nullable=False)
     user_id = Column(Integer, ForeignKey("users.id", ondelete='CASCADE'), nullable=False)
     emoji = Column(String, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     # Relationships
-    message = relationship("Message", back_populates="reactions")
+    message = relationship(
+        "Message", back_populates="reactions",
+        primaryjoin="Message.id == foreign(MessageReaction.message_id)"
+    )
+    
+    # Одна реакция каждого вида от пользователя; индекс же служит пересчету по message_id
+    __table_args__ = (
+        Index('ix_message_reactions_message_user_emoji', 'message_id', 'user_id', 'emoji', unique=True),
+    )
 
 class MessageRead(Base):
     __tablename__ = "message_reads"
     
     id = Column(Integer, primary_key=True, index=True)
-    message_id = Column(Integer, ForeignKey("messages.id", ondelete='CASCADE'), nullable=False)
+    message_id = Column(BigInteger, nullable=False)
     user_id = Column(Integer, ForeignKey("users.id", ondelete='CASCADE'), nullable=False)
     read_at = Column(DateTime(timezone=True), server_default=func.now())
     
     # Relationships
-    message = relationship("Message", back_populates="read_by")
+    message = relationship(
+        "Message", back_populates="read_by",
+        primaryjoin="Message.id == foreign(MessageRead.message_id)"
+    )
 
 class CallType(str, enum.Enum):
     AUDIO = "audio"
@@ -119,11 +154,28 @@ class CallStatus(str, enum.Enum):
 class Call(Base):
     __tablename__ = "calls"
     
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(BigInteger, primary_key=True, index=True, autoincrement=False, default=id_generator.next_id)
     chat_id = Column(Integer, ForeignKey("chats.id", ondelete='CASCADE'), nullable=False)
     initiator_id = Column(Integer, ForeignKey("users.id", ondelete='CASCADE'), nullable=False)
     call_type = Column(String, default=CallType.AUDIO)
     status = Column(String, default=CallStatus.RINGING)
     started_at = Column(DateTime(timezone=True), server_default=func.now())
+    answered_at = Column(DateTime(timezone=True), nullable=True)
     ended_at = Column(DateTime(timezone=True), nullable=True)
+    
+    # История звонков: join по чатам участника, keyset-пагинация по id
+    __table_args__ = (
+        Index('ix_calls_chat_id_id', 'chat_id', 'id'),
+    )
+
 
+class PushSubscription(Base):
+    """Подписка Web Push браузера (PushSubscription.toJSON() на клиенте)"""
+    __tablename__ = "push_subscriptions"
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete='CASCADE'), nullable=False, index=True)
+    endpoint = Column(String, unique=True, nullable=False)
+    p256dh = Column(String, nullable=False)
+    auth = Column(String, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
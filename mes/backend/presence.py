@@ -0,0 +1,317 @@
+import asyncio
+import json
+import os
+import socket
+import time
+from typing import Dict, List, Iterable, Set
+
+import redis.asyncio as redis
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from config import settings
+from database import SessionLocal
+from models import chat_participants, UserStatus
+from schemas import UserResponse
+
+PRESENCE_CHANNEL = "user_status"
+# user_id -> самый поздний срок полей узлов в presence:{user_id} (для уборки)
+PRESENCE_EXPIRY_KEY = "presence:expiry"
+# Сколько команд отправлять в Redis одним pipeline
+PIPELINE_CHUNK = 1000
+
+
+def _presence_key(user_id: int) -> str:
+    return f"presence:{user_id}"
+
+
+# Поле узла снято; хеш опустел и offline рассылается сейчас - убрать из расписания уборки
+DISCONNECT_SCRIPT = """
+redis.call('HDEL', KEYS[1], ARGV[1])
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 1
+end
+if ARGV[2] == '1' then
+    redis.call('ZREM', KEYS[2], ARGV[3])
+end
+return 0
+"""
+
+# Уборка за упавшими узлами: снять просроченные поля (значение поля - срок в мс);
+# вернуть пользователей, у которых не осталось ни одного узла
+SWEEP_SCRIPT = """
+local now = tonumber(ARGV[1])
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, tonumber(ARGV[2]))
+local offline = {}
+for _, user_id in ipairs(due) do
+    local key = ARGV[3] .. user_id
+    local fields = redis.call('HGETALL', key)
+    local latest = nil
+    for i = 1, #fields, 2 do
+        local expires = tonumber(fields[i + 1]) or 0
+        if expires <= now then
+            redis.call('HDEL', key, fields[i])
+        elseif latest == nil or expires > latest then
+            latest = expires
+        end
+    end
+    if latest then
+        redis.call('ZADD', KEYS[1], latest, user_id)
+    else
+        redis.call('ZREM', KEYS[1], user_id)
+        table.insert(offline, user_id)
+    end
+end
+return offline
+"""
+
+
+def _expires_ms() -> int:
+    return int((time.time() + settings.PRESENCE_TTL_SECONDS) * 1000)
+
+
+def visible_user_ids(db: Session, user_id: int, user_ids: Iterable[int]) -> List[int]:
+    """Из user_ids - сам пользователь и те, с кем у него есть общий чат"""
+    user_ids = list(dict.fromkeys(user_ids))
+    member = chat_participants.alias("member")
+    contact = chat_participants.alias("contact")
+    query = (
+        select(contact.c.user_id)
+        .join(member, member.c.chat_id == contact.c.chat_id)
+        .where(member.c.user_id == user_id, contact.c.user_id.in_(user_ids))
+        .distinct()
+    )
+    visible = set(db.execute(query).scalars())
+    visible.add(user_id)
+    return [candidate for candidate in user_ids if candidate in visible]
+
+
+def _load_contacts(user_ids: List[int]) -> Dict[int, Set[int]]:
+    """user_id -> id пользователей, с которыми у него есть общий чат"""
+    member = chat_participants.alias("member")
+    contact = chat_participants.alias("contact")
+    query = (
+        select(member.c.user_id, contact.c.user_id)
+        .join(contact, contact.c.chat_id == member.c.chat_id)
+        .where(member.c.user_id.in_(user_ids), contact.c.user_id != member.c.user_id)
+        .distinct()
+    )
+    contacts: Dict[int, Set[int]] = {}
+    db = SessionLocal()
+    try:
+        for user_id, contact_id in db.execute(query):
+            contacts.setdefault(user_id, set()).add(contact_id)
+    finally:
+        db.close()
+    return contacts
+
+
+class PresenceTracker:
+    """Онлайн-статус с TTL в Redis.
+
+    Каждый узел держит поле в хеше presence:{user_id} со сроком (мс) и
+    продлевает его heartbeat'ом. Если воркер падает, его поля перестают
+    продлеваться: уборка по PRESENCE_EXPIRY_KEY на живых узлах снимает
+    просроченные поля и рассылает offline, когда у пользователя не осталось
+    ни одного узла. Изменения статусов копятся в окне и рассылаются
+    одним PUBLISH, а каждый узел доставляет их только своим локальным
+    пользователям, у которых есть общий чат с изменившимся.
+    """
+
+    def __init__(self):
+        self.node_name = f"{socket.gethostname()}:{os.getpid()}"
+        self.redis_client: redis.Redis = None
+        self.manager = None
+        self._pending: Dict[int, str] = {}
+        self._pubsub = None
+        self._disconnect = None
+        self._sweep = None
+        self._tasks: List[asyncio.Task] = []
+        self.stats = {"swept_offline": 0}
+
+    async def start(self, manager):
+        self.manager = manager
+        self.redis_client = manager.redis_client
+        self._tasks.append(asyncio.create_task(self._flush_loop()))
+        if self.redis_client:
+            self._disconnect = self.redis_client.register_script(DISCONNECT_SCRIPT)
+            self._sweep = self.redis_client.register_script(SWEEP_SCRIPT)
+            self._pubsub = self.redis_client.pubsub()
+            await self._pubsub.subscribe(PRESENCE_CHANNEL)
+            self._tasks.append(asyncio.create_task(self._heartbeat_loop()))
+            self._tasks.append(asyncio.create_task(self._listen_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        if self._pubsub:
+            await self._pubsub.unsubscribe(PRESENCE_CHANNEL)
+            await self._pubsub.close()
+            self._pubsub = None
+        # Снять отметки этого узла, не дожидаясь TTL
+        if self.redis_client and self.manager:
+            for chunk in self._chunks(self.manager.connections.user_ids()):
+                async with self.redis_client.pipeline(transaction=False) as pipe:
+                    for user_id in chunk:
+                        pipe.hdel(_presence_key(user_id), self.node_name)
+                    await pipe.execute()
+
+    async def user_connected(self, user_id: int):
+        """Первое соединение пользователя на этом узле"""
+        if not self.redis_client:
+            self._pending[user_id] = UserStatus.ONLINE.value
+            return
+        key = _presence_key(user_id)
+        expires = _expires_ms()
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.exists(key)
+            pipe.hset(key, self.node_name, expires)
+            pipe.expire(key, settings.PRESENCE_TTL_SECONDS)
+            pipe.zadd(PRESENCE_EXPIRY_KEY, {user_id: expires})
+            was_online = (await pipe.execute())[0]
+        if not was_online:
+            self._pending[user_id] = UserStatus.ONLINE.value
+
+    async def user_disconnected(self, user_id: int, publish: bool = True):
+        """Последнее соединение пользователя на этом узле закрыто.
+
+        publish=False - снять отметку узла без рассылки offline (узел
+        перезапускается, и клиент сейчас же переподключится к другому).
+        """
+        if not self.redis_client:
+            if publish:
+                self._pending[user_id] = UserStatus.OFFLINE.value
+            return
+        # Без рассылки пользователь остается в расписании уборки: не вернется
+        # на другой узел - offline разошлет уборка
+        still_online = await self._disconnect(
+            keys=[_presence_key(user_id), PRESENCE_EXPIRY_KEY],
+            args=[self.node_name, "1" if publish else "0", user_id]
+        )
+        if publish and not still_online:
+            self._pending[user_id] = UserStatus.OFFLINE.value
+
+    def queued_changes(self) -> int:
+        """Изменения статусов, ждущие публикации"""
+        return len(self._pending)
+
+    async def get_statuses(self, user_ids: Iterable[int]) -> Dict[int, str]:
+        user_ids = list(dict.fromkeys(user_ids))
+        if not self.redis_client:
+            local = self.manager.connections if self.manager else {}
+            return {
+                user_id: UserStatus.ONLINE.value if user_id in local else UserStatus.OFFLINE.value
+                for user_id in user_ids
+            }
+        statuses: Dict[int, str] = {}
+        for chunk in self._chunks(user_ids):
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for user_id in chunk:
+                    pipe.exists(_presence_key(user_id))
+                results = await pipe.execute()
+            for user_id, online in zip(chunk, results):
+                statuses[user_id] = UserStatus.ONLINE.value if online else UserStatus.OFFLINE.value
+        return statuses
+
+    async def with_status(self, users) -> List[UserResponse]:
+        """Сериализовать пользователей с живым статусом вместо колонки из БД"""
+        statuses = await self.get_statuses([user.id for user in users])
+        return [
+            UserResponse.model_validate(user).model_copy(update={"user_status": statuses[user.id]})
+            for user in users
+        ]
+
+    async def overlay(self, users: List):
+        """Проставить живой статус вложенным пользователям (dict или UserResponse)
+        участников чатов и отправителей сообщений - одним опросом на всех"""
+        statuses = await self.get_statuses(
+            user["id"] if isinstance(user, dict) else user.id for user in users
+        )
+        for user in users:
+            if isinstance(user, dict):
+                user["user_status"] = statuses[user["id"]]
+            else:
+                user.user_status = statuses[user.id]
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(settings.PRESENCE_HEARTBEAT_SECONDS)
+            try:
+                expires = _expires_ms()
+                for chunk in self._chunks(self.manager.connections.user_ids()):
+                    async with self.redis_client.pipeline(transaction=False) as pipe:
+                        for user_id in chunk:
+                            key = _presence_key(user_id)
+                            pipe.hset(key, self.node_name, expires)
+                            pipe.expire(key, settings.PRESENCE_TTL_SECONDS)
+                            pipe.zadd(PRESENCE_EXPIRY_KEY, {user_id: expires})
+                        await pipe.execute()
+                await self.sweep()
+            except Exception as e:
+                print(f"Presence heartbeat error: {e}")
+
+    async def sweep(self):
+        """Снять поля упавших узлов и разослать offline тем, у кого узлов не осталось"""
+        while True:
+            offline = await self._sweep(
+                keys=[PRESENCE_EXPIRY_KEY],
+                args=[int(time.time() * 1000), PIPELINE_CHUNK, _presence_key("")]
+            )
+            for user_id in offline:
+                self._pending[int(user_id)] = UserStatus.OFFLINE.value
+            self.stats["swept_offline"] += len(offline)
+            if len(offline) < PIPELINE_CHUNK:
+                return
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(settings.PRESENCE_BATCH_WINDOW_MS / 1000)
+            if not self._pending:
+                continue
+            changes, self._pending = self._pending, {}
+            batch = [{"user_id": user_id, "status": status} for user_id, status in changes.items()]
+            try:
+                if self.redis_client:
+                    await self.redis_client.publish(PRESENCE_CHANNEL, json.dumps(batch))
+                else:
+                    await self._deliver(batch)
+            except Exception as e:
+                print(f"Presence flush error: {e}")
+
+    async def _listen_loop(self):
+        async for message in self._pubsub.listen():
+            if message.get("type") != "message":
+                continue
+            try:
+                await self._deliver(json.loads(message["data"]))
+            except Exception as e:
+                print(f"Presence delivery error: {e}")
+
+    async def _deliver(self, batch: List[dict]):
+        """Разослать пачку изменений локальным пользователям-контактам"""
+        local = self.manager.connections
+        if not local or not batch:
+            return
+        contacts = await asyncio.to_thread(_load_contacts, [item["user_id"] for item in batch])
+
+        per_recipient: Dict[int, List[dict]] = {}
+        for item in batch:
+            for contact_id in contacts.get(item["user_id"], ()):
+                if contact_id in local:
+                    per_recipient.setdefault(contact_id, []).append(item)
+
+        for recipient_id, statuses in per_recipient.items():
+            await self.manager.send_personal_message(
+                {"type": "user_status", "data": {"statuses": statuses}},
+                recipient_id
+            )
+
+    @staticmethod
+    def _chunks(items: List[int]):
+        for i in range(0, len(items), PIPELINE_CHUNK):
+            yield items[i:i + PIPELINE_CHUNK]
+
+
+presence = PresenceTracker()
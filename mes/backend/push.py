@@ -0,0 +1,394 @@
+"""Web Push для получателей без открытого WebSocket.
+
+События new_message, incoming_call и call_missed для пользователей, которых
+нет онлайн ни на одном узле (presence), складываются в очередь со схлопыванием
+по (пользователь, чат, вид): хеш push:item:{ключ} копит число событий и
+последнее из них, sorted set push:due хранит момент отправки - первое событие
+плюс PUSH_COLLAPSE_MS. Пять сообщений подряд дают одно уведомление
+"5 новых сообщений". Воркер на каждом узле забирает созревшие ключи (Lua,
+без дублей между узлами), загружает подписки одним запросом и шлет запросы
+через общий пул HTTP-соединений с повторами на 429/5xx. Подписки, на которые
+push-сервис отвечает 404/410, удаляются.
+
+Полезная нагрузка шифруется по RFC 8291 (aes128gcm), push-сервис
+авторизуется по VAPID (RFC 8292). Без VAPID_PRIVATE_KEY push выключен.
+"""
+import asyncio
+import base64
+import json
+import os
+import random
+import struct
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from jose import jwt
+from sqlalchemy import delete, select
+
+from config import settings
+from database import get_engine
+from metrics import PUSH_QUEUE_COLLAPSED, PUSH_REQUESTS
+from models import Chat, PushSubscription, User, UserStatus
+from presence import presence
+
+# Какие события WebSocket превращаются в push и как они схлопываются
+PUSH_EVENTS = {"new_message", "incoming_call", "call_missed"}
+DUE_KEY = "push:due"
+ITEM_PREFIX = "push:item:"
+# Недоставленный ключ живет не дольше суток (узел упал между записью и сбором)
+ITEM_TTL_SECONDS = 24 * 60 * 60
+# Звонок без ответа дольше не актуален
+CALL_PUSH_TTL_SECONDS = 60
+PREVIEW_LENGTH = 100
+RECORD_SIZE = 4096
+
+# Забрать до ARGV[2] ключей со сроком <= ARGV[1]: {ключ, count, last, ...}
+COLLECT_SCRIPT = """
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+local result = {}
+for _, member in ipairs(members) do
+    local key = ARGV[3] .. member
+    local item = redis.call('HMGET', key, 'count', 'last')
+    redis.call('DEL', key)
+    redis.call('ZREM', KEYS[1], member)
+    if item[2] then
+        table.insert(result, member)
+        table.insert(result, item[1] or '1')
+        table.insert(result, item[2])
+    end
+end
+return result
+"""
+
+
+def _b64decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+def _b64encode(value: bytes) -> str:
+    return base64.urlsafe_b64encode(value).rstrip(b"=").decode()
+
+
+def _hkdf(salt: bytes, ikm: bytes, info: bytes, length: int) -> bytes:
+    return HKDF(algorithm=hashes.SHA256(), length=length, salt=salt, info=info).derive(ikm)
+
+
+def encrypt_payload(p256dh: str, auth: str, plaintext: bytes) -> bytes:
+    """Тело запроса Web Push: заголовок aes128gcm и одна зашифрованная запись (RFC 8291)"""
+    ua_public = _b64decode(p256dh)
+    auth_secret = _b64decode(auth)
+    ua_key = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256R1(), ua_public)
+    as_private = ec.generate_private_key(ec.SECP256R1())
+    as_public = as_private.public_key().public_bytes(
+        serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+    )
+    shared_secret = as_private.exchange(ec.ECDH(), ua_key)
+    ikm = _hkdf(auth_secret, shared_secret, b"WebPush: info\x00" + ua_public + as_public, 32)
+    salt = os.urandom(16)
+    key = _hkdf(salt, ikm, b"Content-Encoding: aes128gcm\x00", 16)
+    nonce = _hkdf(salt, ikm, b"Content-Encoding: nonce\x00", 12)
+    # \x02 - разделитель последней записи
+    ciphertext = AESGCM(key).encrypt(nonce, plaintext + b"\x02", None)
+    return salt + struct.pack("!IB", RECORD_SIZE, len(as_public)) + as_public + ciphertext
+
+
+def _plural(count: int, forms: Tuple[str, str, str]) -> str:
+    if count % 10 == 1 and count % 100 != 11:
+        return forms[0]
+    if 2 <= count % 10 <= 4 and not 12 <= count % 100 <= 14:
+        return forms[1]
+    return forms[2]
+
+
+def _item_from_event(message: dict) -> Optional[dict]:
+    """Что из события нужно для уведомления (хранится в очереди)"""
+    kind = message.get("type")
+    data = message.get("data") or {}
+    if kind == "new_message":
+        content = data.get("content") or ""
+        return {
+            "kind": kind, "chat_id": data.get("chat_id"), "sender_id": data.get("sender_id"),
+            "preview": content[:PREVIEW_LENGTH], "message_id": data.get("id"),
+        }
+    if kind in ("incoming_call", "call_missed"):
+        return {
+            "kind": kind, "chat_id": data.get("chat_id"), "sender_id": data.get("initiator_id"),
+            "call_id": data.get("call_id"), "call_type": data.get("call_type"),
+        }
+    return None
+
+
+def _notification(item: dict, count: int, chat: Optional[Tuple[str, bool]], sender: Optional[str]) -> dict:
+    """Текст уведомления для service worker (sw.js)"""
+    chat_name, is_group = chat or (None, False)
+    sender = sender or "Пользователь"
+    title = chat_name if is_group and chat_name else sender
+    kind = item["kind"]
+    if kind == "new_message":
+        if count > 1:
+            body = f"{count} {_plural(count, ('новое сообщение', 'новых сообщения', 'новых сообщений'))}"
+        else:
+            body = item["preview"] or "Вложение"
+            if is_group:
+                body = f"{sender}: {body}"
+    elif kind == "incoming_call":
+        body = "Входящий видеозвонок" if item.get("call_type") == "video" else "Входящий звонок"
+    else:
+        body = f"{count} {_plural(count, ('пропущенный звонок', 'пропущенных звонка', 'пропущенных звонков'))}"
+    data = {key: item[key] for key in ("kind", "chat_id", "message_id", "call_id") if item.get(key) is not None}
+    return {"title": title, "body": body, "tag": f"chat-{item['chat_id']}", "data": data}
+
+
+def _load_context(user_ids: List[int], chat_ids: List[int], sender_ids: List[int]):
+    """Подписки получателей, названия чатов и имена отправителей - три запроса на пачку"""
+    with get_engine().connect() as connection:
+        subscriptions: Dict[int, list] = {}
+        for row in connection.execute(
+            select(PushSubscription.id, PushSubscription.user_id, PushSubscription.endpoint,
+                   PushSubscription.p256dh, PushSubscription.auth)
+            .where(PushSubscription.user_id.in_(user_ids))
+        ):
+            subscriptions.setdefault(row.user_id, []).append(row)
+        chats = {
+            row.id: (row.name, bool(row.is_group))
+            for row in connection.execute(select(Chat.id, Chat.name, Chat.is_group).where(Chat.id.in_(chat_ids)))
+        }
+        senders = dict(connection.execute(select(User.id, User.username).where(User.id.in_(sender_ids))).all())
+    return subscriptions, chats, senders
+
+
+def _delete_subscriptions(subscription_ids: List[int]):
+    with get_engine().begin() as connection:
+        connection.execute(delete(PushSubscription).where(PushSubscription.id.in_(subscription_ids)))
+
+
+class PushNotifier:
+    """Очередь push-уведомлений со схлопыванием и воркер доставки"""
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._redis = None
+        self._collect = None
+        self._http = None
+        self._private_key = None
+        self.public_key: Optional[str] = None
+        # Без Redis: ключ -> [срок, count, last]
+        self._local: Dict[str, list] = {}
+        # audience -> (токен VAPID, истекает)
+        self._vapid_tokens: Dict[str, Tuple[str, float]] = {}
+        self.stats = {"queued": 0, "collapsed": 0, "sent": 0, "failed": 0, "retried": 0, "pruned": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self._private_key is not None
+
+    def configure(self):
+        """Ключи VAPID из настроек; без них push выключен"""
+        if not settings.VAPID_PRIVATE_KEY:
+            self._private_key = None
+            self.public_key = None
+            return
+        self._private_key = ec.derive_private_key(
+            int.from_bytes(_b64decode(settings.VAPID_PRIVATE_KEY), "big"), ec.SECP256R1()
+        )
+        self.public_key = _b64encode(self._private_key.public_key().public_bytes(
+            serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+        ))
+        self._vapid_tokens.clear()
+
+    async def start(self, manager):
+        self.configure()
+        if not self.enabled:
+            return
+        # httpx заметно удлиняет холодный старт - только если push включен
+        import httpx
+        self._redis = manager.redis_client
+        if self._redis:
+            self._collect = self._redis.register_script(COLLECT_SCRIPT)
+        self._http = httpx.AsyncClient(
+            timeout=settings.PUSH_HTTP_TIMEOUT_SECONDS,
+            limits=httpx.Limits(
+                max_connections=settings.PUSH_CONCURRENCY,
+                max_keepalive_connections=settings.PUSH_CONCURRENCY
+            )
+        )
+        self._task = asyncio.create_task(self._worker_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._http:
+            await self._http.aclose()
+            self._http = None
+
+    # --- очередь ---
+
+    async def enqueue(self, user_ids: Iterable[int], message: dict):
+        """Событие для пользователей без соединения на этом узле"""
+        if not self.enabled or message.get("type") not in PUSH_EVENTS:
+            return
+        item = _item_from_event(message)
+        if item is None or item["chat_id"] is None:
+            return
+        # Соединение может быть на другом узле - тогда push не нужен
+        statuses = await presence.get_statuses(user_id for user_id in user_ids if user_id != item["sender_id"])
+        offline = [user_id for user_id, status in statuses.items() if status != UserStatus.ONLINE.value]
+        if not offline:
+            return
+        # Звонок ждать нельзя, сообщения копятся окно схлопывания
+        delay = 0 if item["kind"] == "incoming_call" else settings.PUSH_COLLAPSE_MS / 1000
+        due = time.time() + delay
+        last = json.dumps(item)
+        members = [f"{user_id}:{item['chat_id']}:{item['kind']}" for user_id in offline]
+        self.stats["queued"] += len(members)
+        if not self._redis:
+            for member in members:
+                entry = self._local.get(member)
+                if entry is None:
+                    self._local[member] = [due, 1, last]
+                else:
+                    entry[1] += 1
+                    entry[2] = last
+                    self._collapsed()
+            return
+        async with self._redis.pipeline(transaction=True) as pipe:
+            for member in members:
+                key = ITEM_PREFIX + member
+                pipe.hincrby(key, "count", 1)
+                pipe.hset(key, "last", last)
+                pipe.expire(key, ITEM_TTL_SECONDS)
+                pipe.zadd(DUE_KEY, {member: due}, nx=True)
+            results = await pipe.execute()
+        for count in results[::4]:
+            if count > 1:
+                self._collapsed()
+
+    def _collapsed(self):
+        self.stats["collapsed"] += 1
+        PUSH_QUEUE_COLLAPSED.inc()
+
+    async def _take_due(self) -> List[Tuple[int, int, dict]]:
+        """Созревшие ключи: (user_id, count, последнее событие)"""
+        now = time.time()
+        batch = settings.PUSH_BATCH_SIZE
+        if self._redis:
+            flat = await self._collect(keys=[DUE_KEY], args=[now, batch, ITEM_PREFIX])
+            rows = [(flat[i], int(flat[i + 1]), flat[i + 2]) for i in range(0, len(flat), 3)]
+        else:
+            due = [member for member, entry in self._local.items() if entry[0] <= now][:batch]
+            rows = [(member, self._local[member][1], self._local.pop(member)[2]) for member in due]
+        return [(int(member.split(":", 1)[0]), count, json.loads(last)) for member, count, last in rows]
+
+    # --- доставка ---
+
+    async def _worker_loop(self):
+        while True:
+            try:
+                items = await self._take_due()
+                if items:
+                    await self.deliver(items)
+                    if len(items) >= settings.PUSH_BATCH_SIZE:
+                        continue
+            except Exception as e:
+                print(f"Push delivery error: {e}")
+            await asyncio.sleep(settings.PUSH_POLL_MS / 1000)
+
+    async def deliver(self, items: List[Tuple[int, int, dict]]):
+        subscriptions, chats, senders = await asyncio.to_thread(
+            _load_context,
+            list({user_id for user_id, _, _ in items}),
+            list({item["chat_id"] for _, _, item in items}),
+            list({item["sender_id"] for _, _, item in items if item.get("sender_id") is not None}),
+        )
+        semaphore = asyncio.Semaphore(settings.PUSH_CONCURRENCY)
+        requests = []
+        for user_id, count, item in items:
+            notification = _notification(item, count, chats.get(item["chat_id"]), senders.get(item.get("sender_id")))
+            payload = json.dumps(notification, ensure_ascii=False).encode()
+            if item["kind"] == "incoming_call":
+                ttl, urgency = CALL_PUSH_TTL_SECONDS, "high"
+            else:
+                ttl, urgency = settings.PUSH_TTL_SECONDS, "normal"
+            # Topic: push-сервис заменит еще не доставленное уведомление того же чата
+            topic = f"{item['kind'].replace('_', '')}{item['chat_id']}"[:32]
+            for subscription in subscriptions.get(user_id, ()):
+                requests.append(self._send(semaphore, subscription, payload, ttl, urgency, topic))
+        results = await asyncio.gather(*requests)
+        dead = [subscription_id for subscription_id in results if subscription_id is not None]
+        if dead:
+            await asyncio.to_thread(_delete_subscriptions, dead)
+            self.stats["pruned"] += len(dead)
+
+    async def _send(self, semaphore, subscription, payload: bytes, ttl: int, urgency: str, topic: str) -> Optional[int]:
+        """Один запрос с повторами; вернуть id подписки, если она больше не действует"""
+        import httpx
+        async with semaphore:
+            body = encrypt_payload(subscription.p256dh, subscription.auth, payload)
+            headers = {
+                "Authorization": self._vapid_header(subscription.endpoint),
+                "Content-Encoding": "aes128gcm",
+                "Content-Type": "application/octet-stream",
+                "TTL": str(ttl),
+                "Urgency": urgency,
+                "Topic": topic,
+            }
+            for attempt in range(settings.PUSH_MAX_RETRIES + 1):
+                retry_after = None
+                try:
+                    response = await self._http.post(subscription.endpoint, content=body, headers=headers)
+                    status = response.status_code
+                    if status < 300:
+                        self._record("sent")
+                        return None
+                    if status in (404, 410):
+                        self._record("gone")
+                        return subscription.id
+                    if status != 429 and status < 500:
+                        # 400/403/413 - повтор не поможет
+                        self._record("rejected")
+                        return None
+                    retry_after = response.headers.get("Retry-After")
+                except httpx.HTTPError:
+                    pass
+                if attempt == settings.PUSH_MAX_RETRIES:
+                    break
+                self.stats["retried"] += 1
+                delay = settings.PUSH_RETRY_BASE_MS / 1000 * 2 ** attempt * (1 + random.random())
+                if retry_after and retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+                await asyncio.sleep(delay)
+            self._record("failed")
+            return None
+
+    def _record(self, result: str):
+        PUSH_REQUESTS.labels(result).inc()
+        if result == "sent":
+            self.stats["sent"] += 1
+        elif result != "gone":
+            self.stats["failed"] += 1
+
+    def _vapid_header(self, endpoint: str) -> str:
+        parts = urlsplit(endpoint)
+        audience = f"{parts.scheme}://{parts.netloc}"
+        now = time.time()
+        cached = self._vapid_tokens.get(audience)
+        if cached is None or cached[1] - now < 3600:
+            expires = now + 12 * 3600
+            pem = self._private_key.private_bytes(
+                serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+            )
+            token = jwt.encode(
+                {"aud": audience, "exp": int(expires), "sub": settings.VAPID_SUBJECT}, pem, algorithm="ES256"
+            )
+            cached = self._vapid_tokens[audience] = (token, expires)
+        return f"vapid t={cached[0]}, k={self.public_key}"
+
+
+push_notifier = PushNotifier()
@@ -0,0 +1,159 @@
+"""Учет SQL-запросов на HTTP-запрос и на событие WebSocket.
+
+Слушатели событий engine считают запросы и время в БД для текущего
+контекста (ContextVar), а одинаковый текст запроса, выполненный много раз
+подряд, помечается как подозрение на N+1 (ленивые связи в цикле).
+"""
+import json
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+
+from config import settings
+
+logger = logging.getLogger("messenger.sql")
+
+# Сколько символов SQL показывать в логах и заголовках
+STATEMENT_PREVIEW = 200
+
+
+class QueryStats:
+    __slots__ = ("label", "count", "total_time", "statements")
+
+    def __init__(self, label: str = ""):
+        self.label = label
+        self.count = 0
+        self.total_time = 0.0
+        # Текст запроса (без параметров) -> сколько раз выполнен
+        self.statements: Dict[str, int] = {}
+
+    def record(self, statement: str, elapsed: float):
+        self.count += 1
+        self.total_time += elapsed
+        self.statements[statement] = self.statements.get(statement, 0) + 1
+
+    def repeated(self, threshold: Optional[int] = None) -> List[dict]:
+        """Запросы, выполненные не меньше threshold раз - кандидаты в N+1"""
+        if threshold is None:
+            threshold = settings.SQL_REPEATED_STATEMENT_THRESHOLD
+        return [
+            {"count": count, "statement": statement[:STATEMENT_PREVIEW]}
+            for statement, count in sorted(self.statements.items(), key=lambda item: -item[1])
+            if count >= threshold
+        ]
+
+    def to_dict(self) -> dict:
+        return {
+            "label": self.label,
+            "queries": self.count,
+            "db_ms": round(self.total_time * 1000, 2),
+            "repeated": self.repeated(),
+        }
+
+
+_current: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+# Глобальные сборщики assert_max_queries: видят запросы из любых потоков и задач
+# (TestClient выполняет приложение в своем потоке, куда контекст не передается)
+_collectors: List[QueryStats] = []
+
+
+def start(label: str) -> tuple:
+    """Начать учет; вернуть (stats, token) для finish()"""
+    stats = QueryStats(label)
+    return stats, _current.set(stats)
+
+
+def finish(tracking: tuple, **fields) -> QueryStats:
+    stats, token = tracking
+    _current.reset(token)
+    report(stats, **fields)
+    return stats
+
+
+def report(stats: QueryStats, **fields):
+    """Структурированная запись в лог: подозрения на N+1 - warning, остальное - debug"""
+    data = stats.to_dict()
+    level = logging.WARNING if data["repeated"] else logging.DEBUG
+    if logger.isEnabledFor(level):
+        logger.log(level, json.dumps({**data, **fields}, ensure_ascii=False))
+
+
+@contextmanager
+def assert_max_queries(limit: int, label: str = ""):
+    """Хелпер для тестов: упасть, если блок выполнил больше limit запросов.
+
+        with assert_max_queries(3):
+            client.get("/api/chats/")
+    """
+    stats = QueryStats(label)
+    _collectors.append(stats)
+    try:
+        yield stats
+    finally:
+        _collectors.remove(stats)
+    if stats.count > limit:
+        lines = [f"{count}x {statement[:STATEMENT_PREVIEW]}" for statement, count in stats.statements.items()]
+        raise AssertionError(
+            f"{label or 'block'} executed {stats.count} queries, budget {limit}:\n" + "\n".join(lines)
+        )
+
+
+def instrument_engine(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if _collectors or _current.get() is not None:
+            conn.info["query_stats_start"] = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop("query_stats_start", None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        stats = _current.get()
+        if stats is not None:
+            stats.record(statement, elapsed)
+        for collector in _collectors:
+            collector.record(statement, elapsed)
+
+
+class QueryStatsMiddleware:
+    """ASGI middleware: учет запросов к БД на каждый HTTP-запрос.
+
+    В режиме DEBUG итоги добавляются в заголовки ответа X-DB-Queries,
+    X-DB-Time-Ms и X-DB-Repeated (число запросов-кандидатов в N+1).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if settings.DEBUG:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"x-db-queries", str(stats.count).encode()))
+                    headers.append((b"x-db-time-ms", f"{stats.total_time * 1000:.2f}".encode()))
+                    headers.append((b"x-db-repeated", str(len(stats.repeated())).encode()))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        stats, token = start(f"{scope['method']} {scope['path']}")
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            route = scope.get("route")
+            report(stats, route=getattr(route, "path", None), status=status_code)
@@ -0,0 +1,175 @@
+import time
+from typing import Dict, Optional, Tuple
+
+import redis.asyncio as redis
+
+from config import settings
+
+# Token bucket в Redis. KEYS[1] - ключ корзины; ARGV: rate (токенов/с), burst,
+# now (мс), сколько токенов запрошено. Выдает столько, сколько есть (0..requested),
+# и при отказе - через сколько мс появится следующий токен.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1])
+local ts = tonumber(data[2])
+if tokens == nil then
+    tokens = burst
+    ts = now
+end
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+local granted = math.min(requested, math.floor(tokens))
+tokens = tokens - granted
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+local retry = 0
+if granted == 0 then
+    retry = math.ceil((1 - tokens) * 1000 / rate)
+end
+return {granted, retry}
+"""
+
+# Токены, взятые из Redis про запас, действительны недолго, чтобы узел
+# не копил чужую квоту
+LEASE_SECONDS = 0.25
+# При разрастании локальных таблиц удаляются записи, не трогавшиеся дольше этого
+IDLE_SECONDS = 60
+MAX_LOCAL_ENTRIES = 50000
+
+
+class TokenBucket:
+    """Локальная корзина токенов (на соединение или без Redis)"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self, now: Optional[float] = None) -> float:
+        """0 - токен взят; иначе секунды до появления токена"""
+        if now is None:
+            now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class _Lease:
+    __slots__ = ("tokens", "expires", "blocked_until", "updated")
+
+    def __init__(self):
+        self.tokens = 0
+        self.expires = 0.0
+        self.blocked_until = 0.0
+        self.updated = 0.0
+
+
+class RateLimiter:
+    """Лимиты на пользователя и тип события.
+
+    Общая для всех соединений и узлов корзина живет в Redis и списывается
+    Lua-скриптом атомарно. Быстрый путь локальный: из Redis берется сразу
+    несколько токенов (лиза на LEASE_SECONDS), а после отказа узел до
+    retry_after не ходит в Redis вовсе. Без Redis (или пока Redis недоступен) -
+    только локальные корзины.
+    """
+
+    def __init__(self):
+        self.redis_client: redis.Redis = None
+        self._script = None
+        self._leases: Dict[Tuple[int, str], _Lease] = {}
+        self._buckets: Dict[Tuple[int, str], TokenBucket] = {}
+        # Счетчики отброшенной нагрузки по типам событий
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def init(self, redis_client: Optional[redis.Redis]):
+        self.redis_client = redis_client
+        if redis_client:
+            self._script = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    @staticmethod
+    def limits_for(event: str) -> Optional[Tuple[float, int]]:
+        limits = settings.RATE_LIMITS.get(event)
+        if not limits:
+            return None
+        return float(limits[0]), int(limits[1])
+
+    def connection_bucket(self) -> Optional[TokenBucket]:
+        limits = self.limits_for("connection")
+        return TokenBucket(*limits) if limits else None
+
+    async def hit(self, user_id: int, event: str) -> float:
+        """Списать токен; 0 - разрешено, иначе секунды до повтора"""
+        limits = self.limits_for(event)
+        if limits is None:
+            return 0.0
+        now = time.monotonic()
+        key = (user_id, event)
+        if self._script is None:
+            retry_after = self._hit_local(key, limits, now)
+        else:
+            try:
+                retry_after = await self._hit_shared(key, limits, now)
+            except redis.RedisError:
+                # Ошибка уже учтена в redis_errors_total; лимит держит корзина узла
+                retry_after = self._hit_local(key, limits, now)
+        self.record(event, retry_after == 0)
+        return retry_after
+
+    def record(self, event: str, allowed: bool):
+        counters = self.stats.get(event)
+        if counters is None:
+            counters = self.stats[event] = {"allowed": 0, "shed": 0}
+        counters["allowed" if allowed else "shed"] += 1
+
+    def _hit_local(self, key: Tuple[int, str], limits: Tuple[float, int], now: float) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            self._prune(self._buckets, now)
+            bucket = self._buckets[key] = TokenBucket(*limits)
+        return bucket.take(now)
+
+    async def _hit_shared(self, key: Tuple[int, str], limits: Tuple[float, int], now: float) -> float:
+        lease = self._leases.get(key)
+        if lease is None:
+            self._prune(self._leases, now)
+            lease = self._leases[key] = _Lease()
+        lease.updated = now
+        if now < lease.blocked_until:
+            return lease.blocked_until - now
+        if lease.tokens > 0 and now < lease.expires:
+            lease.tokens -= 1
+            return 0.0
+
+        rate, burst = limits
+        requested = max(1, min(burst, int(rate * LEASE_SECONDS)))
+        granted, retry_ms = await self._script(
+            keys=[f"ratelimit:{key[1]}:{key[0]}"],
+            args=[rate, burst, int(time.time() * 1000), requested],
+        )
+        if granted == 0:
+            lease.tokens = 0
+            lease.blocked_until = now + retry_ms / 1000
+            return retry_ms / 1000
+        lease.tokens = granted - 1
+        lease.expires = now + LEASE_SECONDS
+        return 0.0
+
+    @staticmethod
+    def _prune(table: dict, now: float):
+        if len(table) < MAX_LOCAL_ENTRIES:
+            return
+        for key in [key for key, item in table.items() if now - item.updated > IDLE_SECONDS]:
+            del table[key]
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,110 @@
+"""Счетчики реакций сообщений: messages.reaction_counts ({emoji: число}).
+
+Строки message_reactions - источник правды, они пишутся сразу. Счетчики
+обновляются пачками: id изменившихся сообщений копятся в множестве Redis
+(без Redis - в памяти процесса), раз в REACTION_FLUSH_MS узел забирает до
+REACTION_FLUSH_BATCH id и одной транзакцией пересчитывает их по индексу
+(message_id, user_id, emoji). Сколько бы реакций ни пришло на сообщение за
+интервал, его строка обновляется один раз, а пересчет вместо прибавления не
+дает счетчикам разойтись, если узел упал между записью реакции и сбросом.
+История отдает счетчики вместе со строкой сообщения, без лишних запросов.
+"""
+import asyncio
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import bindparam, func, select, update
+
+from config import settings
+from database import get_engine
+from models import Message, MessageReaction
+
+DIRTY_KEY = "reactions:dirty"
+
+
+def recount(message_ids: List[int]):
+    """Пересчитать reaction_counts сообщений по строкам message_reactions"""
+    counts: Dict[int, Dict[str, int]] = {message_id: {} for message_id in message_ids}
+    with get_engine().begin() as connection:
+        # Сначала блокировки строк (в порядке id - одинаково на всех узлах): пересчет
+        # того же сообщения на другом узле дождется коммита и увидит свежие строки
+        connection.execute(
+            select(Message.id).where(Message.id.in_(message_ids)).order_by(Message.id).with_for_update()
+        ).all()
+        rows = connection.execute(
+            select(MessageReaction.message_id, MessageReaction.emoji, func.count())
+            .where(MessageReaction.message_id.in_(message_ids))
+            .group_by(MessageReaction.message_id, MessageReaction.emoji)
+            .order_by(func.count().desc(), MessageReaction.emoji)
+        )
+        for message_id, emoji, count in rows:
+            counts[message_id][emoji] = count
+        connection.execute(
+            update(Message).where(Message.id == bindparam("message_id")).values(reaction_counts=bindparam("counts")),
+            [{"message_id": message_id, "counts": value or None} for message_id, value in counts.items()]
+        )
+
+
+class ReactionCounts:
+    """Очередь сообщений с изменившимися реакциями и ее пакетный сброс"""
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._redis = None
+        self._dirty: Set[int] = set()
+        self.stats = {"flushes": 0, "recounted": 0}
+
+    async def start(self, manager):
+        self._redis = manager.redis_client
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"Reaction counts flush on shutdown failed: {e}")
+
+    async def mark_dirty(self, *message_ids: int):
+        if self._redis:
+            await self._redis.sadd(DIRTY_KEY, *message_ids)
+        else:
+            self._dirty.update(message_ids)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(settings.REACTION_FLUSH_MS / 1000)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Reaction counts flush failed: {e}")
+
+    async def flush(self):
+        batch = settings.REACTION_FLUSH_BATCH
+        while True:
+            message_ids = await self._take(batch)
+            if not message_ids:
+                return
+            try:
+                await asyncio.to_thread(recount, message_ids)
+            except Exception:
+                # Вернуть в очередь - пересчет повторится в следующий раз
+                await self.mark_dirty(*message_ids)
+                raise
+            self.stats["flushes"] += 1
+            self.stats["recounted"] += len(message_ids)
+            if len(message_ids) < batch:
+                return
+
+    async def _take(self, count: int) -> List[int]:
+        if self._redis:
+            return [int(message_id) for message_id in await self._redis.spop(DIRTY_KEY, count) or ()]
+        message_ids = []
+        while self._dirty and len(message_ids) < count:
+            message_ids.append(self._dirty.pop())
+        return message_ids
+
+
+reaction_counts = ReactionCounts()
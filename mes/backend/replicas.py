@@ -0,0 +1,193 @@
+"""Маршрутизация чтений на реплики PostgreSQL.
+
+Read-only эндпоинты берут сессию через get_read_db: она открывается на
+одной из реплик по кругу, кроме двух случаев, когда чтение идет на primary:
+пользователь недавно что-то записал (read-your-writes) или все реплики
+отстают больше REPLICA_MAX_LAG_SECONDS. Отметка о записи хранится в Redis,
+чтобы следующий запрос на другом узле или воркере тоже увидел свою запись.
+"""
+import asyncio
+import itertools
+import math
+import time
+from typing import Dict, List, Optional
+
+import redis.asyncio as redis
+from fastapi import Depends
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from auth import get_current_profile
+from config import settings
+from database import SessionLocal, get_replica_engines
+from metrics import DB_READS, DB_REPLICA_LAG
+
+# Методы, которые ничего не пишут и не включают read-your-writes
+SAFE_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+
+# Отставание реплики: 0, если все полученное WAL уже применено (иначе на
+# простаивающем primary время последней транзакции растет без реального отставания)
+LAG_QUERY = text("""
+SELECT CASE
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+""")
+
+# Сколько локальных отметок о записи держать до очистки устаревших
+MAX_LOCAL_WRITES = 50000
+
+
+def _written_key(user_id: int) -> str:
+    return f"db:written:{user_id}"
+
+
+def _label(engine: Engine) -> str:
+    url = engine.url
+    return f"{url.host or 'local'}:{url.port or ''}/{url.database or ''}"
+
+
+def _measure_lag(engine: Engine) -> float:
+    if engine.dialect.name != "postgresql":
+        # Локальная разработка на SQLite - реплика-копия без репликации
+        return 0.0
+    with engine.connect() as connection:
+        return float(connection.execute(LAG_QUERY).scalar() or 0.0)
+
+
+class ReplicaRouter:
+    """Выбор БД для read-only запроса и фоновая проверка отставания реплик"""
+
+    def __init__(self):
+        self.redis_client: redis.Redis = None
+        self.engines: List[Engine] = []
+        # Отставание по реплике (секунды); inf - реплика недоступна
+        self.lag: Dict[Engine, float] = {}
+        self._round_robin = itertools.count()
+        # user_id -> monotonic-время, до которого чтения идут на primary
+        self._written: Dict[int, float] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"replica": 0, "primary_sticky": 0, "primary_lag": 0}
+
+    async def start(self, manager):
+        self.redis_client = manager.redis_client
+        self.engines = get_replica_engines()
+        if not self.engines:
+            return
+        for engine in self.engines:
+            DB_REPLICA_LAG.labels(_label(engine)).set_function(lambda engine=engine: self.lag.get(engine, math.inf))
+        await self._check_lag()
+        self._task = asyncio.create_task(self._lag_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def mark_write(self, user_id: int):
+        """Пользователь что-то записал: его чтения временно идут на primary"""
+        if not self.engines:
+            return
+        now = time.monotonic()
+        if len(self._written) >= MAX_LOCAL_WRITES:
+            self._written = {uid: until for uid, until in self._written.items() if until > now}
+        self._written[user_id] = now + settings.REPLICA_STICKY_SECONDS
+        if self.redis_client:
+            await self.redis_client.set(
+                _written_key(user_id), "1", px=math.ceil(settings.REPLICA_STICKY_SECONDS * 1000)
+            )
+
+    async def _is_sticky(self, user_id: int) -> bool:
+        if self._written.get(user_id, 0.0) > time.monotonic():
+            return True
+        if self.redis_client:
+            # Запись могла пройти через другой узел или воркер
+            return bool(await self.redis_client.exists(_written_key(user_id)))
+        return False
+
+    async def choose(self, user_id: Optional[int]) -> Optional[Engine]:
+        """Engine реплики для чтения или None - читать с primary"""
+        if not self.engines:
+            return None
+        if user_id is not None and await self._is_sticky(user_id):
+            self.stats["primary_sticky"] += 1
+            DB_READS.labels("primary_sticky").inc()
+            return None
+        healthy = [
+            engine for engine in self.engines
+            if self.lag.get(engine, math.inf) <= settings.REPLICA_MAX_LAG_SECONDS
+        ]
+        if not healthy:
+            self.stats["primary_lag"] += 1
+            DB_READS.labels("primary_lag").inc()
+            return None
+        self.stats["replica"] += 1
+        DB_READS.labels("replica").inc()
+        return healthy[next(self._round_robin) % len(healthy)]
+
+    def get_stats(self) -> dict:
+        return {
+            # Отставание в секундах; None - реплика недоступна
+            "replicas": {
+                _label(engine): None if math.isinf(lag) else round(lag, 3)
+                for engine, lag in ((engine, self.lag.get(engine, math.inf)) for engine in self.engines)
+            },
+            **self.stats,
+        }
+
+    async def _check_lag(self):
+        for engine in self.engines:
+            try:
+                self.lag[engine] = await asyncio.to_thread(_measure_lag, engine)
+            except Exception as e:
+                print(f"Replica {_label(engine)} lag check failed: {e}")
+                self.lag[engine] = math.inf
+
+    async def _lag_loop(self):
+        while True:
+            await asyncio.sleep(settings.REPLICA_LAG_CHECK_SECONDS)
+            await self._check_lag()
+
+
+replica_router = ReplicaRouter()
+
+
+async def get_read_db(current_user: dict = Depends(get_current_profile)):
+    """Сессия для read-only эндпоинтов: реплика или primary (см. ReplicaRouter).
+
+    Пользователь - из кэша профилей, а не запросом к primary: эндпоинты с этой
+    сессией берут current_user через get_current_profile (FastAPI вызовет его
+    один раз на запрос) и не держат второе соединение из пула primary.
+    """
+    engine = await replica_router.choose(current_user["id"])
+    db = SessionLocal(bind=engine) if engine is not None else SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+class ReadYourWritesMiddleware:
+    """ASGI middleware: успешный изменяющий запрос включает read-your-writes.
+
+    Отметка ставится до отправки ответа, поэтому следующий запрос клиента
+    уже читает с primary. user_id кладет в request.state get_current_user.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in SAFE_METHODS:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                user_id = scope.get("state", {}).get("user_id")
+                if user_id is not None:
+                    await replica_router.mark_write(user_id)
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,173 @@
+"""Кэш сериализованных профилей и чатов, условные GET (ETag / 304).
+
+GET /api/users/{id}, /api/auth/me и /api/chats/{id} клиенты вызывают на
+каждую отрисовку шапки и аватарки. Готовый JSON сущности лежит в Redis
+(cache:user:{id}, cache:chat:{id}) на RESPONSE_CACHE_TTL_SECONDS, без Redis -
+в LRU процесса. Проверка токена для этих запросов тоже берет профиль из кэша:
+повторная загрузка - чтение Redis без запросов к БД.
+
+Изменение профиля (update_me, аватар, подтверждение email) сбрасывает запись
+пользователя и записи его чатов (в чате вложены профили участников). Сброс
+увеличивает поколение cache:gen:{сущность}; запрос, начавший загрузку из БД
+до сброса, не запишет устаревшие данные (проверка поколения в Lua). Загрузка
+идет с primary: реплика может еще не видеть изменение, после которого запись
+сброшена.
+
+ETag - хеш отданного тела (вместе с живым статусом присутствия), If-None-Match
+с совпадающим ETag получает 304 без тела.
+"""
+import asyncio
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from fastapi import Request, Response
+from sqlalchemy.orm import Session
+
+from config import settings
+from database import SessionLocal
+from metrics import RESPONSE_CACHE
+from models import Chat, User, chat_participants
+from schemas import ChatResponse, UserResponse
+
+# Записать значение, только если поколение не менялось с начала загрузки
+FILL_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+
+def _cache_key(kind: str, entity_id: int) -> str:
+    return f"cache:{kind}:{entity_id}"
+
+
+def _gen_key(kind: str, entity_id: int) -> str:
+    return f"cache:gen:{kind}:{entity_id}"
+
+
+def _load_user(db: Session, user_id: int) -> Optional[dict]:
+    user = db.query(User).filter(User.id == user_id).first()
+    return UserResponse.model_validate(user).model_dump(mode="json") if user else None
+
+
+def _load_chat(db: Session, chat_id: int) -> Optional[dict]:
+    chat = db.query(Chat).filter(Chat.id == chat_id).first()
+    return ChatResponse.model_validate(chat).model_dump(mode="json") if chat else None
+
+
+LOADERS: Dict[str, Callable[[Session, int], Optional[dict]]] = {"user": _load_user, "chat": _load_chat}
+
+
+def _run_loader(kind: str, entity_id: int) -> Optional[dict]:
+    with SessionLocal() as db:
+        return LOADERS[kind](db, entity_id)
+
+
+def _matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [value.strip() for value in if_none_match.split(",")]
+    return "*" in candidates or any(value.removeprefix("W/") == etag for value in candidates)
+
+
+class ResponseCache:
+    """Общий кэш JSON профилей и чатов с поколениями для сброса"""
+
+    def __init__(self):
+        self._redis = None
+        self._fill = None
+        # Без Redis: ключ -> JSON, поколения ключей
+        self._local: "OrderedDict[str, str]" = OrderedDict()
+        self._local_gen: Dict[str, int] = {}
+        self.stats = {"hits": 0, "misses": 0, "not_modified": 0, "invalidations": 0}
+
+    async def start(self, manager):
+        self._redis = manager.redis_client
+        if self._redis:
+            self._fill = self._redis.register_script(FILL_SCRIPT)
+
+    async def stop(self):
+        self._local.clear()
+        self._local_gen.clear()
+
+    async def get(self, kind: str, entity_id: int) -> Optional[dict]:
+        """Сущность из кэша; при промахе - из БД (primary) с записью в кэш"""
+        key = _cache_key(kind, entity_id)
+        if self._redis:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                pipe.get(key)
+                pipe.get(_gen_key(kind, entity_id))
+                cached, generation = await pipe.execute()
+        else:
+            cached = self._local.get(key)
+            generation = self._local_gen.get(key, 0)
+            if cached is not None:
+                self._local.move_to_end(key)
+        if cached is not None:
+            self.stats["hits"] += 1
+            RESPONSE_CACHE.labels(kind, "hit").inc()
+            return json.loads(cached)
+
+        self.stats["misses"] += 1
+        RESPONSE_CACHE.labels(kind, "miss").inc()
+        payload = await asyncio.to_thread(_run_loader, kind, entity_id)
+        if payload is None:
+            return None
+        value = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+        if self._redis:
+            await self._fill(
+                keys=[key, _gen_key(kind, entity_id)],
+                args=[generation or "0", value, settings.RESPONSE_CACHE_TTL_SECONDS]
+            )
+        elif self._local_gen.get(key, 0) == generation:
+            self._local[key] = value
+            if len(self._local) > settings.RESPONSE_CACHE_LOCAL_SIZE:
+                self._local.popitem(last=False)
+        return payload
+
+    async def invalidate(self, entries: Iterable[Tuple[str, int]]):
+        entries = list(entries)
+        if not entries:
+            return
+        self.stats["invalidations"] += len(entries)
+        if not self._redis:
+            for kind, entity_id in entries:
+                key = _cache_key(kind, entity_id)
+                self._local.pop(key, None)
+                self._local_gen[key] = self._local_gen.get(key, 0) + 1
+            return
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for kind, entity_id in entries:
+                gen_key = _gen_key(kind, entity_id)
+                pipe.incr(gen_key)
+                # Поколение нужно только пока идут загрузки, начатые до сброса
+                pipe.expire(gen_key, settings.RESPONSE_CACHE_TTL_SECONDS)
+                pipe.delete(_cache_key(kind, entity_id))
+            await pipe.execute()
+
+    async def invalidate_user(self, db: Session, user_id: int):
+        """Профиль изменился: запись пользователя и всех его чатов"""
+        chat_ids: List[int] = [
+            chat_id for (chat_id,) in
+            db.query(chat_participants.c.chat_id).filter(chat_participants.c.user_id == user_id)
+        ]
+        await self.invalidate([("user", user_id)] + [("chat", chat_id) for chat_id in chat_ids])
+
+    def respond(self, request: Request, kind: str, payload) -> Response:
+        """200 с ETag или 304, если у клиента та же версия"""
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()
+        etag = f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+        # private: ответы зависят от токена; no-cache: браузер переспрашивает с If-None-Match
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Authorization"}
+        if _matches(request.headers.get("if-none-match"), etag):
+            self.stats["not_modified"] += 1
+            RESPONSE_CACHE.labels(kind, "not_modified").inc()
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+
+response_cache = ResponseCache()
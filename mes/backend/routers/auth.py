@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, Request, status, BackgroundTasks
 from sqlalchemy.orm import Session
 from typing import Optional
 import smtplib
@@ -15,9 +15,12 @@ from auth import (
     create_refresh_token,
     generate_verification_token,
     get_current_user,
-    get_current_active_user
+    get_current_active_user,
+    get_current_profile
 )
 from config import settings
+from presence import presence
+from response_cache import response_cache
 
 router = APIRouter(prefix="/api/auth", tags=["auth"])
 
@@ -132,6 +135,7 @@ async def verify_email(token: str, db: Session = Depends(get_db)):
     user.is_email_verified = True
     user.email_verification_token = None
     db.commit()
+    await response_cache.invalidate_user(db, user.id)
     
     return {"message": "Email verified successfully"}
 
@@ -172,8 +176,9 @@ async def refresh_token(refresh_token: str, db: Session = Depends(get_db)):
         )
 
 @router.get("/me", response_model=UserResponse)
-async def get_me(current_user: User = Depends(get_current_active_user)):
-    return current_user
+async def get_me(request: Request, current_user: dict = Depends(get_current_profile)):
+    statuses = await presence.get_statuses([current_user["id"]])
+    return response_cache.respond(request, "user", {**current_user, "user_status": statuses[current_user["id"]]})
 
 @router.post("/logout")
 async def logout(current_user: User = Depends(get_current_active_user)):
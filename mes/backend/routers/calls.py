@@ -1,13 +1,17 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status, Query
+from sqlalchemy import and_
 from sqlalchemy.orm import Session
-from typing import List
-from datetime import datetime
+from typing import List, Optional
 
 from database import get_db
-from models import User, Call, Chat, CallStatus
-from schemas import CallCreate, CallResponse, WebRTCSignal
-from auth import get_current_active_user
+from replicas import get_read_db
+from models import User, Call, Chat, CallStatus, chat_participants
+from schemas import CallCreate, CallResponse, CallHistoryResponse, CallerSummary, WebRTCSignal
+from auth import get_current_active_user, get_current_profile
 from websocket_manager import manager
+from snowflake import id_generator, snowflake_to_datetime
+from call_rooms import call_rooms, CallRoom
+from call_timeouts import ringing_timeouts
 
 router = APIRouter(prefix="/api/calls", tags=["calls"])
 
@@ -26,25 +30,26 @@ async def create_call(
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
     
-    # Создать звонок
-    new_call = Call(
+    # Звонок живет в реестре комнат; в Postgres попадает только итоговая запись
+    call_id = id_generator.next_id()
+    participant_ids = [p.id for p in chat.participants]
+    room = await call_rooms.create(CallRoom(
+        call_id=call_id,
         chat_id=call_data.chat_id,
         initiator_id=current_user.id,
         call_type=call_data.call_type,
-        status=CallStatus.RINGING
-    )
-    
-    db.add(new_call)
-    db.commit()
-    db.refresh(new_call)
+        participants=participant_ids,
+        started_at=snowflake_to_datetime(call_id)
+    ))
+    # Без ответа за CALL_RINGING_TIMEOUT_SECONDS звонок станет пропущенным
+    await ringing_timeouts.schedule(call_id)
     
     # Уведомить участников чата через WebSocket
-    participant_ids = [p.id for p in chat.participants if p.id != current_user.id]
     await manager.send_to_chat(
         {
             "type": "incoming_call",
             "data": {
-                "call_id": new_call.id,
+                "call_id": call_id,
                 "chat_id": call_data.chat_id,
                 "initiator_id": current_user.id,
                 "call_type": call_data.call_type,
@@ -55,33 +60,42 @@ async def create_call(
                 }
             }
         },
-        participant_ids
+        [user_id for user_id in participant_ids if user_id != current_user.id]
     )
     
-    return new_call
+    return room.to_dict()
+
+async def _get_room_for(call_id: int, user_id: int) -> CallRoom:
+    room = await call_rooms.get(call_id)
+    if room is None:
+        raise HTTPException(status_code=404, detail="Call not found")
+    if user_id not in room.participants:
+        raise HTTPException(status_code=403, detail="Access denied")
+    return room
 
 @router.put("/{call_id}/accept")
 async def accept_call(
     call_id: int,
-    db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    call = db.query(Call).filter(Call.id == call_id).first()
-    
-    if not call:
+    room = await _get_room_for(call_id, current_user.id)
+    if room.initiator_id == current_user.id:
+        raise HTTPException(status_code=400, detail="Initiator cannot answer own call")
+    
+    # В групповом звонке присоединиться можно и к уже активному
+    room, ok = await call_rooms.transition(
+        call_id,
+        [CallStatus.RINGING, CallStatus.ACTIVE],
+        CallStatus.ACTIVE,
+        user_id=current_user.id
+    )
+    if room is None:
         raise HTTPException(status_code=404, detail="Call not found")
-    
-    # Проверить доступ к чату
-    chat = db.query(Chat).filter(
-        Chat.id == call.chat_id,
-        Chat.participants.any(User.id == current_user.id)
-    ).first()
-    
-    if not chat:
-        raise HTTPException(status_code=403, detail="Access denied")
-    
-    call.status = CallStatus.ACTIVE
-    db.commit()
+    if not ok:
+        raise HTTPException(status_code=409, detail=f"Call is already {room.status}")
+    await ringing_timeouts.cancel(call_id)
+    # Если клиенты уйдут без /end, звонок завершит проверка активных
+    await ringing_timeouts.watch_active([call_id])
     
     # Уведомить инициатора
     await manager.send_personal_message(
@@ -93,7 +107,7 @@ async def accept_call(
                 "username": current_user.username
             }
         },
-        call.initiator_id
+        room.initiator_id
     )
     
     return {"message": "Call accepted"}
@@ -101,17 +115,20 @@ async def accept_call(
 @router.put("/{call_id}/reject")
 async def reject_call(
     call_id: int,
-    db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    call = db.query(Call).filter(Call.id == call_id).first()
+    room = await _get_room_for(call_id, current_user.id)
+    if room.initiator_id == current_user.id:
+        raise HTTPException(status_code=400, detail="Initiator cannot answer own call")
     
-    if not call:
+    room, ok = await call_rooms.transition(call_id, [CallStatus.RINGING], CallStatus.REJECTED)
+    if room is None:
         raise HTTPException(status_code=404, detail="Call not found")
+    if not ok:
+        raise HTTPException(status_code=409, detail=f"Call is already {room.status}")
     
-    call.status = CallStatus.REJECTED
-    call.ended_at = datetime.utcnow()
-    db.commit()
+    # Итог пишется до снятия таймеров; при ошибке запись повторит фоновая проверка
+    await ringing_timeouts.finish(room)
     
     # Уведомить инициатора
     await manager.send_personal_message(
@@ -122,7 +139,7 @@ async def reject_call(
                 "user_id": current_user.id
             }
         },
-        call.initiator_id
+        room.initiator_id
     )
     
     return {"message": "Call rejected"}
@@ -130,22 +147,24 @@ async def reject_call(
 @router.put("/{call_id}/end")
 async def end_call(
     call_id: int,
-    db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    call = db.query(Call).filter(Call.id == call_id).first()
+    await _get_room_for(call_id, current_user.id)
     
-    if not call:
+    room, ok = await call_rooms.transition(
+        call_id,
+        [CallStatus.RINGING, CallStatus.ACTIVE],
+        CallStatus.ENDED
+    )
+    if room is None:
         raise HTTPException(status_code=404, detail="Call not found")
+    if not ok:
+        raise HTTPException(status_code=409, detail=f"Call is already {room.status}")
     
-    call.status = CallStatus.ENDED
-    call.ended_at = datetime.utcnow()
-    db.commit()
+    # Итог пишется до снятия таймеров; при ошибке запись повторит фоновая проверка
+    await ringing_timeouts.finish(room)
     
     # Уведомить всех участников
-    chat = db.query(Chat).filter(Chat.id == call.chat_id).first()
-    participant_ids = [p.id for p in chat.participants]
-    
     await manager.send_to_chat(
         {
             "type": "call_ended",
@@ -154,28 +173,49 @@ async def end_call(
                 "ended_by": current_user.id
             }
         },
-        participant_ids
+        list(room.participants)
     )
     
     return {"message": "Call ended"}
 
-@router.get("/history", response_model=List[CallResponse])
+@router.get("/history", response_model=List[CallHistoryResponse])
 async def get_call_history(
-    skip: int = 0,
-    limit: int = 50,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    before_id: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=100),
+    db: Session = Depends(get_read_db),
+    current_user: dict = Depends(get_current_profile)
 ):
-    # Получить все чаты пользователя
-    user_chat_ids = db.query(Chat.id).filter(
-        Chat.participants.any(User.id == current_user.id)
-    ).all()
-    chat_ids = [chat_id[0] for chat_id in user_chat_ids]
-    
-    # Получить историю звонков
-    calls = db.query(Call).filter(
-        Call.chat_id.in_(chat_ids)
-    ).order_by(Call.started_at.desc()).offset(skip).limit(limit).all()
-    
-    return calls
-
+    # Один запрос: звонки join членство пользователя join инициатор.
+    # id звонков упорядочены по времени, поэтому пагинация - по id (before_id
+    # из последней строки предыдущей страницы), без OFFSET
+    query = db.query(Call, User.id, User.username, User.full_name, User.avatar).join(
+        chat_participants,
+        and_(
+            chat_participants.c.chat_id == Call.chat_id,
+            chat_participants.c.user_id == current_user["id"]
+        )
+    ).join(User, User.id == Call.initiator_id)
+    
+    if before_id is not None:
+        query = query.filter(Call.id < before_id)
+    
+    rows = query.order_by(Call.id.desc()).limit(limit).all()
+    
+    history = []
+    for call, initiator_id, username, full_name, avatar in rows:
+        duration = 0
+        if call.answered_at and call.ended_at:
+            duration = max(int((call.ended_at - call.answered_at).total_seconds()), 0)
+        history.append(CallHistoryResponse(
+            id=call.id,
+            chat_id=call.chat_id,
+            initiator_id=call.initiator_id,
+            call_type=call.call_type,
+            status=call.status,
+            started_at=call.started_at,
+            answered_at=call.answered_at,
+            ended_at=call.ended_at,
+            duration_seconds=duration,
+            initiator=CallerSummary(id=initiator_id, username=username, full_name=full_name, avatar=avatar)
+        ))
+    return history
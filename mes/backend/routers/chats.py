@@ -1,12 +1,24 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from typing import List, Dict
+import asyncio
+import math
 
 from database import get_db
-from models import User, Chat, Message, chat_participants
-from schemas import ChatCreate, ChatResponse, MessageCreate, MessageResponse, MessageUpdate, UserResponse
-from auth import get_current_active_user
-from websocket_manager import manager
+from replicas import get_read_db
+from models import User, Chat, Message, MessageReaction, chat_participants
+from schemas import ChatCreate, ChatResponse, MessageCreate, MessageResponse, MessageUpdate, MessageReactionCreate, UserResponse
+from auth import get_current_active_user, get_current_profile
+from snowflake import id_generator, snowflake_to_datetime
+from rate_limit import rate_limiter
+from message_partitions import message_partitions
+from reactions import reaction_counts
+from unread import unread_counters
+from response_cache import response_cache
+from fanout import chat_fanout, contains
+from presence import presence
 
 router = APIRouter(prefix="/api/chats", tags=["chats"])
 
@@ -36,7 +48,7 @@ async def create_chat(
         ).first()
         
         if existing_chat:
-            return existing_chat
+            return await _with_status(existing_chat)
     
     # Создать новый чат
     new_chat = Chat(
@@ -50,55 +62,103 @@ async def create_chat(
     db.commit()
     db.refresh(new_chat)
     
-    return new_chat
+    return await _with_status(new_chat)
+
+async def _with_status(chat: Chat) -> ChatResponse:
+    response = ChatResponse.model_validate(chat)
+    await presence.overlay(response.participants)
+    return response
 
 @router.get("/", response_model=List[ChatResponse])
 async def get_my_chats(
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: Session = Depends(get_read_db),
+    current_user: dict = Depends(get_current_profile)
 ):
-    chats = db.query(Chat).filter(Chat.participants.any(User.id == current_user.id)).all()
+    # Участники всех чатов - одним запросом, а не ленивой загрузкой на каждый чат
+    chats = db.query(Chat).options(selectinload(Chat.participants)).filter(
+        Chat.participants.any(User.id == current_user["id"])
+    ).all()
+    chats = await unread_counters.with_counts(current_user["id"], chats)
+    await presence.overlay([user for chat in chats for user in chat.participants])
     return chats
 
+@router.get("/unread", response_model=Dict[int, int])
+async def get_unread_counts(
+    current_user: User = Depends(get_current_active_user)
+):
+    # chat_id -> непрочитано, только ненулевые; один запрос в Redis на все чаты
+    return await unread_counters.get_counts(current_user.id)
+
 @router.get("/{chat_id}", response_model=ChatResponse)
 async def get_chat(
     chat_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    request: Request,
+    current_user: dict = Depends(get_current_profile)
 ):
-    chat = db.query(Chat).filter(
-        Chat.id == chat_id,
-        Chat.participants.any(User.id == current_user.id)
-    ).first()
-    
-    if not chat:
+    # Чат из общего кэша, участие проверяется по списку участников в нем
+    chat = await response_cache.get("chat", chat_id)
+    if not chat or not any(p["id"] == current_user["id"] for p in chat["participants"]):
         raise HTTPException(status_code=404, detail="Chat not found")
     
-    return chat
+    # Кэш общий для всех участников: счетчик непрочитанных и статусы участников
+    # подставляются для этого пользователя, ETag считается уже по его ответу
+    counts = await unread_counters.get_counts(current_user["id"])
+    chat["unread_count"] = counts.get(chat_id, 0)
+    await presence.overlay(chat["participants"])
+    return response_cache.respond(request, "chat", chat)
 
 @router.get("/{chat_id}/messages", response_model=List[MessageResponse])
 async def get_chat_messages(
     chat_id: int,
     skip: int = 0,
     limit: int = 50,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: Session = Depends(get_read_db),
+    current_user: dict = Depends(get_current_profile)
 ):
     # Проверить доступ к чату
     chat = db.query(Chat).filter(
         Chat.id == chat_id,
-        Chat.participants.any(User.id == current_user.id)
+        Chat.participants.any(User.id == current_user["id"])
     ).first()
     
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
     
-    messages = db.query(Message).filter(
+    # id - snowflake: порядок id совпадает с порядком времени и идет по индексу (chat_id, id)
+    # Отправители - в том же запросе (JOIN), без SELECT на каждого
+    messages = db.query(Message).options(joinedload(Message.sender, innerjoin=True)).filter(
         Message.chat_id == chat_id,
         Message.is_deleted == False
-    ).order_by(Message.created_at.desc()).offset(skip).limit(limit).all()
+    ).order_by(Message.id.desc()).offset(skip).limit(limit).all()
+    
+    if len(messages) < limit and message_partitions.has_archives():
+        # Живые секции закончились - продолжить ленту из архива старых секций
+        if messages:
+            live_count = skip + len(messages)
+        else:
+            live_count = db.query(func.count(Message.id)).filter(
+                Message.chat_id == chat_id,
+                Message.is_deleted == False
+            ).scalar()
+        archived = await asyncio.to_thread(
+            message_partitions.archived_messages, chat_id, max(skip - live_count, 0), limit - len(messages)
+        )
+        senders = {
+            user.id: user
+            for user in db.query(User).filter(User.id.in_({row["sender_id"] for row in archived})).all()
+        }
+        messages.extend(
+            MessageResponse(**row, sender=UserResponse.model_validate(senders[row["sender_id"]]))
+            for row in archived
+            if row["sender_id"] in senders
+        )
     
     messages.reverse()  # Вернуть в хронологическом порядке
+    messages = [
+        message if isinstance(message, MessageResponse) else MessageResponse.model_validate(message)
+        for message in messages
+    ]
+    await presence.overlay([message.sender for message in messages])
     return messages
 
 @router.post("/{chat_id}/messages", response_model=MessageResponse, status_code=status.HTTP_201_CREATED)
@@ -108,51 +168,71 @@ async def create_message(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    # Проверить доступ к чату
-    chat = db.query(Chat).filter(
-        Chat.id == chat_id,
-        Chat.participants.any(User.id == current_user.id)
-    ).first()
+    # Соединение пула не держится через await (состав чата, лимиты): пользователь
+    # уже загружен, сессия снова возьмет соединение на commit
+    sender_id = current_user.id
+    db.close()
     
-    if not chat:
+    # Проверить доступ к чату: состав - id участников из кэша, без загрузки User
+    members = await chat_fanout.members(chat_id)
+    if not contains(members, sender_id):
         raise HTTPException(status_code=404, detail="Chat not found")
     
-    # Создать сообщение
+    retry_after = await rate_limiter.hit(current_user.id, "message_send")
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many messages",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+    
+    # Создать сообщение. id и created_at назначаются до вставки,
+    # поэтому refresh после commit не нужен
+    message_id = id_generator.next_id()
     new_message = Message(
+        id=message_id,
         chat_id=chat_id,
         sender_id=current_user.id,
         content=message_data.content,
         message_type=message_data.message_type,
-        reply_to=message_data.reply_to
+        file_url=None,
+        reply_to=message_data.reply_to,
+        is_edited=False,
+        is_deleted=False,
+        created_at=snowflake_to_datetime(message_id),
+        sender=current_user
     )
+    participant_ids = [user_id for user_id in members if user_id != current_user.id]
+    
+    # Ответ и WebSocket payload собираются до commit: после commit объекты
+    # сессии expired и любое обращение к ним - лишний SELECT
+    response = MessageResponse.model_validate(new_message)
+    payload = {
+        "type": "new_message",
+        "data": {
+            "id": message_id,
+            "chat_id": chat_id,
+            "sender_id": current_user.id,
+            "content": new_message.content,
+            "message_type": new_message.message_type,
+            "created_at": new_message.created_at.isoformat(),
+            "sender": {
+                "id": current_user.id,
+                "username": current_user.username,
+                "avatar": current_user.avatar
+            }
+        }
+    }
     
     db.add(new_message)
     db.commit()
-    db.refresh(new_message)
     
-    # Отправить через WebSocket
-    participant_ids = [p.id for p in chat.participants if p.id != current_user.id]
-    await manager.send_to_chat(
-        {
-            "type": "new_message",
-            "data": {
-                "id": new_message.id,
-                "chat_id": chat_id,
-                "sender_id": current_user.id,
-                "content": new_message.content,
-                "message_type": new_message.message_type,
-                "created_at": new_message.created_at.isoformat(),
-                "sender": {
-                    "id": current_user.id,
-                    "username": current_user.username,
-                    "avatar": current_user.avatar
-                }
-            }
-        },
-        participant_ids
-    )
+    # Счетчики непрочитанных получателей и отправка через WebSocket
+    await unread_counters.message_created(chat_id, participant_ids)
+    await chat_fanout.publish(chat_id, payload, exclude=sender_id, members=members)
+    await presence.overlay([response.sender])
     
-    return new_message
+    return response
 
 @router.put("/messages/{message_id}", response_model=MessageResponse)
 async def update_message(
@@ -174,7 +254,9 @@ async def update_message(
     db.commit()
     db.refresh(message)
     
-    return message
+    response = MessageResponse.model_validate(message)
+    await presence.overlay([response.sender])
+    return response
 
 @router.delete("/messages/{message_id}")
 async def delete_message(
@@ -196,3 +278,80 @@ async def delete_message(
     
     return {"message": "Message deleted"}
 
+def _get_visible_message(db: Session, message_id: int, user_id: int) -> Message:
+    """Неудаленное сообщение из чата, где пользователь - участник"""
+    message = db.query(Message).join(
+        chat_participants, chat_participants.c.chat_id == Message.chat_id
+    ).filter(
+        Message.id == message_id,
+        Message.is_deleted == False,
+        chat_participants.c.user_id == user_id
+    ).first()
+    
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
+    return message
+
+async def _publish_reaction(db: Session, event_type: str, message_id: int, chat_id: int, user_id: int, emoji: str):
+    db.close()
+    
+    # Счетчики в messages.reaction_counts пересчитаются пачкой, клиенты применяют событие сами
+    await reaction_counts.mark_dirty(message_id)
+    await chat_fanout.publish(
+        chat_id,
+        {
+            "type": event_type,
+            "data": {"message_id": message_id, "chat_id": chat_id, "user_id": user_id, "emoji": emoji}
+        },
+        exclude=user_id
+    )
+
+@router.post("/messages/{message_id}/reactions", status_code=status.HTTP_201_CREATED)
+async def add_reaction(
+    message_id: int,
+    reaction: MessageReactionCreate,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    chat_id = _get_visible_message(db, message_id, current_user.id).chat_id
+    
+    retry_after = await rate_limiter.hit(current_user.id, "reaction")
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many reactions",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+    
+    db.add(MessageReaction(message_id=message_id, user_id=current_user.id, emoji=reaction.emoji))
+    try:
+        db.commit()
+    except IntegrityError:
+        # Такая реакция уже есть (уникальный индекс) - повтор запроса
+        db.rollback()
+        return {"message": "Reaction added"}
+    
+    await _publish_reaction(db, "reaction_added", message_id, chat_id, current_user.id, reaction.emoji)
+    return {"message": "Reaction added"}
+
+@router.delete("/messages/{message_id}/reactions/{emoji}")
+async def remove_reaction(
+    message_id: int,
+    emoji: str,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    chat_id = _get_visible_message(db, message_id, current_user.id).chat_id
+    
+    deleted = db.query(MessageReaction).filter(
+        MessageReaction.message_id == message_id,
+        MessageReaction.user_id == current_user.id,
+        MessageReaction.emoji == emoji
+    ).delete(synchronize_session=False)
+    
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Reaction not found")
+    
+    db.commit()
+    await _publish_reaction(db, "reaction_removed", message_id, chat_id, current_user.id, emoji)
+    return {"message": "Reaction removed"}
@@ -1,29 +1,33 @@
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File
+from fastapi import APIRouter, Depends, HTTPException, Request, status, UploadFile, File, Query
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Dict
 import shutil
 import os
 from pathlib import Path
 
 from database import get_db
-from models import User
-from schemas import UserResponse, UserUpdate
-from auth import get_current_active_user
+from replicas import get_read_db
+from models import User, PushSubscription
+from schemas import UserResponse, UserUpdate, PushSubscriptionCreate, PushPublicKey
+from auth import get_current_active_user, get_current_profile
+from presence import presence, visible_user_ids
+from push import push_notifier
+from response_cache import response_cache
 
 router = APIRouter(prefix="/api/users", tags=["users"])
 
+# Каталог создается при старте приложения (lifespan в main.py)
 UPLOAD_DIR = Path("media/avatars")
-UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
 @router.get("/", response_model=List[UserResponse])
 async def get_users(
     skip: int = 0,
     limit: int = 100,
     search: str = None,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    db: Session = Depends(get_read_db),
+    current_user: dict = Depends(get_current_profile)
 ):
-    query = db.query(User).filter(User.id != current_user.id)
+    query = db.query(User).filter(User.id != current_user["id"])
     
     if search:
         query = query.filter(
@@ -33,18 +37,67 @@ async def get_users(
         )
     
     users = query.offset(skip).limit(limit).all()
-    return users
+    return await presence.with_status(users)
+
+@router.get("/presence", response_model=Dict[int, str])
+async def get_presence(
+    user_ids: List[int] = Query(..., max_length=500),
+    db: Session = Depends(get_read_db),
+    current_user: dict = Depends(get_current_profile)
+):
+    # Только свой статус и статусы собеседников по общим чатам; остальные id не попадают в ответ
+    visible = visible_user_ids(db, current_user["id"], user_ids)
+    db.close()
+    # Статусы пачкой: один pipeline в Redis на весь список
+    return await presence.get_statuses(visible)
+
+@router.get("/push/public-key", response_model=PushPublicKey)
+async def get_push_public_key(current_user: User = Depends(get_current_active_user)):
+    # applicationServerKey для pushManager.subscribe; null - push выключен на сервере
+    return {"public_key": push_notifier.public_key}
+
+@router.post("/me/push-subscriptions", status_code=status.HTTP_201_CREATED)
+async def add_push_subscription(
+    subscription: PushSubscriptionCreate,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    # endpoint уникален: браузер, сменивший пользователя, переходит к новому
+    existing = db.query(PushSubscription).filter(PushSubscription.endpoint == subscription.endpoint).first()
+    if existing is None:
+        existing = PushSubscription(endpoint=subscription.endpoint)
+        db.add(existing)
+    existing.user_id = current_user.id
+    existing.p256dh = subscription.keys.p256dh
+    existing.auth = subscription.keys.auth
+    db.commit()
+    return {"message": "Subscribed"}
+
+@router.delete("/me/push-subscriptions")
+async def remove_push_subscription(
+    endpoint: str,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    db.query(PushSubscription).filter(
+        PushSubscription.endpoint == endpoint,
+        PushSubscription.user_id == current_user.id
+    ).delete(synchronize_session=False)
+    db.commit()
+    return {"message": "Unsubscribed"}
 
 @router.get("/{user_id}", response_model=UserResponse)
 async def get_user(
     user_id: int,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    request: Request,
+    current_user: dict = Depends(get_current_profile)
 ):
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
+    # Профиль из общего кэша, статус - живой; ETag/304 (см. response_cache.py)
+    profile = await response_cache.get("user", user_id)
+    if profile is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return user
+    statuses = await presence.get_statuses([user_id])
+    return response_cache.respond(request, "user", {**profile, "user_status": statuses[user_id]})
 
 @router.put("/me", response_model=UserResponse)
 async def update_me(
@@ -57,7 +110,8 @@ async def update_me(
     
     db.commit()
     db.refresh(current_user)
-    return current_user
+    await response_cache.invalidate_user(db, current_user.id)
+    return (await presence.with_status([current_user]))[0]
 
 @router.post("/me/avatar")
 async def upload_avatar(
@@ -80,6 +134,7 @@ async def upload_avatar(
     # Обновление пути в БД
     current_user.avatar = f"/media/avatars/{filename}"
     db.commit()
+    await response_cache.invalidate_user(db, current_user.id)
     
     return {"avatar": current_user.avatar}
 
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, EmailStr, Field
-from typing import Optional, List
+from typing import Optional, List, Dict
 from datetime import datetime
 
 # User schemas
@@ -37,6 +37,19 @@ class UserResponse(BaseModel):
     class Config:
         from_attributes = True
 
+# Push schemas
+class PushSubscriptionKeys(BaseModel):
+    p256dh: str = Field(..., max_length=200)
+    auth: str = Field(..., max_length=100)
+
+class PushSubscriptionCreate(BaseModel):
+    # Формат PushSubscription.toJSON() в браузере
+    endpoint: str = Field(..., pattern=r"^https://", max_length=2048)
+    keys: PushSubscriptionKeys
+
+class PushPublicKey(BaseModel):
+    public_key: Optional[str]
+
 # Token schemas
 class Token(BaseModel):
     access_token: str
@@ -59,6 +72,7 @@ class ChatResponse(BaseModel):
     avatar: Optional[str]
     created_at: datetime
     participants: List[UserResponse]
+    unread_count: int = 0
     
     class Config:
         from_attributes = True
@@ -74,7 +88,7 @@ class MessageUpdate(BaseModel):
     content: str
 
 class MessageReactionCreate(BaseModel):
-    emoji: str
+    emoji: str = Field(..., min_length=1, max_length=32)
 
 class MessageResponse(BaseModel):
     id: int
@@ -86,6 +100,7 @@ class MessageResponse(BaseModel):
     reply_to: Optional[int]
     is_edited: bool
     is_deleted: bool
+    reaction_counts: Optional[Dict[str, int]] = None
     created_at: datetime
     sender: UserResponse
     
@@ -114,6 +129,17 @@ class CallResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class CallerSummary(BaseModel):
+    id: int
+    username: str
+    full_name: Optional[str]
+    avatar: Optional[str]
+
+class CallHistoryResponse(CallResponse):
+    answered_at: Optional[datetime]
+    duration_seconds: int
+    initiator: CallerSummary
+
 # WebRTC signaling
 class WebRTCSignal(BaseModel):
     type: str  # offer, answer, ice-candidate
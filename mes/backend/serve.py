@@ -0,0 +1,99 @@
+"""Продакшен-запуск: несколько воркеров uvicorn на uvloop и httptools.
+
+    python serve.py [--workers N] [--host 0.0.0.0] [--port 8000]
+
+Число воркеров по умолчанию - WEB_CONCURRENCY, а если он 0 - по числу CPU.
+По SIGTERM каждый воркер перестает принимать соединения, досылает клиентам
+WebSocket накопленные события и reconnect со случайной задержкой, закрывает
+сокеты кодом 1012 и только потом дожидается HTTP-запросов и lifespan.
+Так после деплоя клиенты переподключаются вразброс, а не в один момент.
+"""
+import argparse
+import importlib.util
+import os
+import sys
+from typing import List, Optional
+
+import uvicorn
+from uvicorn.supervisors import Multiprocess
+
+from config import settings
+
+
+def _available(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+async def drain_websockets():
+    """Досылать исходящие очереди и развести WebSocket-соединения узла"""
+    from call_rooms import call_rooms
+    from websocket_manager import manager
+
+    # ICE-кандидаты в окне склейки иначе пропадут вместе с сокетом
+    await call_rooms.flush_signals()
+    await manager.drain(settings.WS_DRAIN_RECONNECT_JITTER_MS, settings.WS_DRAIN_TIMEOUT_SECONDS)
+
+
+class DrainingServer(uvicorn.Server):
+    """uvicorn.Server, который разводит WebSocket до обычной остановки.
+
+    Штатный shutdown uvicorn сразу рвет сокеты кодом 1012 без объяснений;
+    здесь сначала закрываются слушающие сокеты, затем drain_websockets().
+    """
+
+    async def shutdown(self, sockets: Optional[List] = None) -> None:
+        for server in self.servers:
+            server.close()
+        for sock in sockets or []:
+            sock.close()
+        if not self.force_exit:
+            await drain_websockets()
+        await super().shutdown(sockets)
+
+
+def build_config(host: str, port: int, workers: int) -> uvicorn.Config:
+    return uvicorn.Config(
+        "main:app",
+        host=host,
+        port=port,
+        workers=workers,
+        # uvloop и httptools ставятся с uvicorn[standard]; без них - чистый asyncio
+        loop="uvloop" if _available("uvloop") else "asyncio",
+        http="httptools" if _available("httptools") else "h11",
+        ws="websockets",
+        ws_ping_interval=settings.WS_PING_INTERVAL_SECONDS,
+        ws_ping_timeout=settings.WS_PING_TIMEOUT_SECONDS,
+        ws_per_message_deflate=settings.WS_PER_MESSAGE_DEFLATE,
+        # После разведения WebSocket - время на незавершенные HTTP-запросы
+        timeout_graceful_shutdown=settings.WS_DRAIN_TIMEOUT_SECONDS,
+        proxy_headers=True,
+        server_header=False,
+    )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=settings.WEB_CONCURRENCY or os.cpu_count() or 1)
+    args = parser.parse_args(argv)
+
+    # Явный NODE_ID достался бы всем воркерам, и id сообщений совпадали бы
+    if settings.NODE_ID is not None and args.workers > 1:
+        print("NODE_ID is set explicitly: run a single worker or leave NODE_ID unset", file=sys.stderr)
+        return 2
+
+    # Воркеры читают число соседей из настроек (без Redis нужен явный NODE_ID)
+    os.environ["WEB_CONCURRENCY"] = str(args.workers)
+    config = build_config(args.host, args.port, args.workers)
+    server = DrainingServer(config)
+    if config.workers > 1:
+        sock = config.bind_socket()
+        Multiprocess(config, target=server.run, sockets=[sock]).run()
+    else:
+        server.run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+import asyncio
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Optional
+
+# Раскладка идентификатора (старшие биты -> младшие):
+#   41 бит - миллисекунды от EPOCH_MS
+#    6 бит - номер узла (воркера)
+#    6 бит - последовательность внутри миллисекунды
+# Итого 53 бита: id хранится в BIGINT и при этом без потерь
+# представим числом в JavaScript (Number.MAX_SAFE_INTEGER = 2**53 - 1).
+EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+
+TIMESTAMP_BITS = 41
+NODE_BITS = 6
+SEQUENCE_BITS = 6
+
+MAX_NODE_ID = (1 << NODE_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+NODE_SHIFT = SEQUENCE_BITS
+TIMESTAMP_SHIFT = SEQUENCE_BITS + NODE_BITS
+
+
+def _now_ms() -> int:
+    return time.time_ns() // 1_000_000
+
+
+class SnowflakeGenerator:
+    """Генератор упорядоченных по времени id (node id + sequence)"""
+
+    def __init__(self, node_id: int = 0):
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+        self.node_id = 0
+        self.set_node_id(node_id)
+
+    def set_node_id(self, node_id: int):
+        if not 0 <= node_id <= MAX_NODE_ID:
+            raise ValueError(f"node_id must be in [0, {MAX_NODE_ID}]")
+        self.node_id = node_id
+
+    def next_id(self) -> int:
+        with self._lock:
+            now = _now_ms()
+            # Часы ушли назад (NTP) - продолжаем от последней метки,
+            # чтобы id оставались монотонными
+            if now < self._last_ms:
+                now = self._last_ms
+
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # Последовательность исчерпана - следующая миллисекунда берется
+                    # логически, без ожидания часов: после шага часов назад ждать
+                    # пришлось бы весь шаг, держа блокировку в потоке event loop.
+                    # Метка опережает часы, пока они ее не догонят
+                    now = self._last_ms + 1
+            else:
+                self._sequence = 0
+
+            self._last_ms = now
+            return (
+                ((now - EPOCH_MS) << TIMESTAMP_SHIFT)
+                | (self.node_id << NODE_SHIFT)
+                | self._sequence
+            )
+
+
+def snowflake_to_datetime(snowflake_id: int) -> datetime:
+    timestamp_ms = (snowflake_id >> TIMESTAMP_SHIFT) + EPOCH_MS
+    return datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc)
+
+
+def snowflake_from_datetime(value: datetime) -> int:
+    """Минимальный id для момента времени (для выборок по диапазону)"""
+    timestamp_ms = int(value.timestamp() * 1000)
+    return max(timestamp_ms - EPOCH_MS, 0) << TIMESTAMP_SHIFT
+
+
+# Аренда номера узла в Redis: ключ живет, пока воркер продлевает его heartbeat'ом
+NODE_LEASE_KEY = "snowflake:node:{}"
+
+# Продлить свою аренду; ключ истек - занять снова; занят другим - 0
+RENEW_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if current == ARGV[1] then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+if not current then
+    return redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) and 1 or 0
+end
+return 0
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class NodeLease:
+    """Уникальный номер узла для генератора, арендованный в Redis.
+
+    Номер занимается SET NX с TTL и продлевается каждые ttl/3 секунды;
+    упавший воркер освобождает номер по истечении TTL. Свободного номера
+    нет (живых воркеров больше MAX_NODE_ID + 1) - старт завершается ошибкой.
+    Если аренду занял другой воркер (heartbeat не успел за TTL), берется
+    новый свободный номер.
+    """
+
+    def __init__(self, generator: SnowflakeGenerator):
+        self.generator = generator
+        self.node_id: Optional[int] = None
+        self._redis = None
+        self._renew = None
+        self._release = None
+        self._token = uuid.uuid4().hex
+        self._ttl = 30
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"node_id": None, "renewals": 0, "reclaims": 0, "errors": 0}
+
+    async def start(self, redis_client, ttl_seconds: int):
+        self._redis = redis_client
+        self._ttl = max(ttl_seconds, 3)
+        self._renew = redis_client.register_script(RENEW_SCRIPT)
+        self._release = redis_client.register_script(RELEASE_SCRIPT)
+        await self._claim()
+        self._task = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._redis and self.node_id is not None:
+            try:
+                await self._release(keys=[NODE_LEASE_KEY.format(self.node_id)], args=[self._token])
+            except Exception as e:
+                print(f"Node lease release failed: {e}")
+        self.node_id = None
+
+    async def _claim(self):
+        # Счетчик только разводит воркеров по разным стартовым номерам
+        start = await self._redis.incr("snowflake:node_counter")
+        for offset in range(MAX_NODE_ID + 1):
+            node_id = (start + offset) % (MAX_NODE_ID + 1)
+            if await self._redis.set(NODE_LEASE_KEY.format(node_id), self._token, nx=True, ex=self._ttl):
+                self.generator.set_node_id(node_id)
+                self.node_id = self.stats["node_id"] = node_id
+                return
+        raise RuntimeError(f"No free snowflake node id: {MAX_NODE_ID + 1} workers already hold leases")
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self._ttl / 3)
+            try:
+                renewed = await self._renew(keys=[NODE_LEASE_KEY.format(self.node_id)], args=[self._token, self._ttl])
+                if renewed:
+                    self.stats["renewals"] += 1
+                else:
+                    self.stats["reclaims"] += 1
+                    print(f"Node id {self.node_id} lease was taken over, claiming another")
+                    await self._claim()
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"Node lease heartbeat error: {e}")
+
+
+id_generator = SnowflakeGenerator()
+node_lease = NodeLease(id_generator)
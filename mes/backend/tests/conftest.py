@@ -0,0 +1,51 @@
+"""Общие настройки тестов.
+
+Окружение задается до первого обращения к config.settings: по умолчанию
+чистая SQLite-база во временном каталоге и процесс без Redis (локальные
+пути presence, счетчиков, кэша). DATABASE_URL из окружения позволяет
+прогнать те же тесты на PostgreSQL.
+
+    cd backend && python -m pytest -q
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp(prefix='mes-tests-')}/test.db")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/15")
+os.environ.setdefault("SECRET_KEY", "test-secret")
+
+import pytest
+
+import models
+from database import Base, get_engine, SessionLocal
+from response_cache import response_cache
+
+
+@pytest.fixture
+def db():
+    """Пустая схема на каждый тест и сессия к ней"""
+    engine = get_engine()
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    # Локальный кэш профилей и чатов помнит строки прошлой схемы
+    asyncio.run(response_cache.stop())
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def make_user(db):
+    def make_user(username: str) -> models.User:
+        user = models.User(email=f"{username}@example.com", username=username, hashed_password="-", is_active=True)
+        db.add(user)
+        db.commit()
+        return user
+    return make_user
@@ -0,0 +1,152 @@
+"""Доставка Web Push через локальную заглушку push-сервиса (httpx.MockTransport)"""
+import asyncio
+import base64
+import json
+import os
+import struct
+
+import httpx
+import pytest
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from jose import jwt
+
+import push
+from config import settings
+from models import Chat, PushSubscription
+
+PUSH_SERVICE = "https://push.example"
+
+
+def b64(value: bytes) -> str:
+    return base64.urlsafe_b64encode(value).rstrip(b"=").decode()
+
+
+def hkdf(salt: bytes, ikm: bytes, info: bytes, length: int) -> bytes:
+    return HKDF(algorithm=hashes.SHA256(), length=length, salt=salt, info=info).derive(ikm)
+
+
+class Browser:
+    """Ключи подписки браузера и расшифровка тела по RFC 8291"""
+
+    def __init__(self):
+        self.private_key = ec.generate_private_key(ec.SECP256R1())
+        self.public_key = self.private_key.public_key().public_bytes(
+            serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+        )
+        self.auth = os.urandom(16)
+
+    def decrypt(self, body: bytes) -> dict:
+        salt, (record_size, key_length) = body[:16], struct.unpack("!IB", body[16:21])
+        server_public = body[21:21 + key_length]
+        ciphertext = body[21 + key_length:]
+        assert record_size == push.RECORD_SIZE and len(ciphertext) <= record_size
+        shared_secret = self.private_key.exchange(
+            ec.ECDH(), ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256R1(), server_public)
+        )
+        ikm = hkdf(self.auth, shared_secret, b"WebPush: info\x00" + self.public_key + server_public, 32)
+        key = hkdf(salt, ikm, b"Content-Encoding: aes128gcm\x00", 16)
+        nonce = hkdf(salt, ikm, b"Content-Encoding: nonce\x00", 12)
+        plaintext = AESGCM(key).decrypt(nonce, ciphertext, None)
+        # Последняя запись заканчивается разделителем \x02 без дополнения
+        assert plaintext.endswith(b"\x02")
+        return json.loads(plaintext[:-1])
+
+
+class PushService:
+    """Заглушка push-сервиса: ответы по endpoint, по очереди"""
+
+    def __init__(self, responses):
+        self.responses = {endpoint: list(queue) for endpoint, queue in responses.items()}
+        self.requests = []
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        status, headers = self.responses[str(request.url)].pop(0)
+        return httpx.Response(status, headers=headers)
+
+
+@pytest.fixture
+def notifier(db, monkeypatch):
+    vapid_key = ec.generate_private_key(ec.SECP256R1())
+    monkeypatch.setattr(settings, "VAPID_PRIVATE_KEY", b64(vapid_key.private_numbers().private_value.to_bytes(32, "big")))
+    monkeypatch.setattr(settings, "PUSH_COLLAPSE_MS", 0)
+    monkeypatch.setattr(settings, "PUSH_RETRY_BASE_MS", 1)
+    notifier = push.PushNotifier()
+    notifier.configure()
+    yield notifier
+    asyncio.run(notifier.stop())
+
+
+def test_collapsed_delivery_retry_and_pruning(db, make_user, notifier, monkeypatch):
+    alice, bob = make_user("alice"), make_user("bob")
+    chat = Chat(name="team", is_group=True, created_by=alice.id, participants=[alice, bob])
+    db.add(chat)
+    db.commit()
+    browser = Browser()
+    live = PushSubscription(
+        user_id=bob.id, endpoint=f"{PUSH_SERVICE}/live", p256dh=b64(browser.public_key), auth=b64(browser.auth)
+    )
+    gone = PushSubscription(
+        user_id=bob.id, endpoint=f"{PUSH_SERVICE}/gone", p256dh=b64(browser.public_key), auth=b64(browser.auth)
+    )
+    db.add_all([live, gone])
+    db.commit()
+    live_id, gone_id, chat_id = live.id, gone.id, chat.id
+
+    service = PushService({
+        f"{PUSH_SERVICE}/live": [(503, {"Retry-After": "2"}), (201, {})],
+        f"{PUSH_SERVICE}/gone": [(410, {})],
+    })
+    delays = []
+    sleep = asyncio.sleep
+
+    async def fake_sleep(delay, *args, **kwargs):
+        delays.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(push.asyncio, "sleep", fake_sleep)
+
+    async def scenario():
+        notifier._http = httpx.AsyncClient(transport=httpx.MockTransport(service.handle))
+        # bob без соединений: три сообщения в чат схлопываются в одно уведомление
+        for message_id in (1, 2, 3):
+            await notifier.enqueue([alice.id, bob.id], {
+                "type": "new_message",
+                "data": {"id": message_id, "chat_id": chat_id, "sender_id": alice.id, "content": f"msg {message_id}"},
+            })
+        items = await notifier._take_due()
+        assert [(user_id, count) for user_id, count, _ in items] == [(bob.id, 3)]
+        await notifier.deliver(items)
+
+    asyncio.run(scenario())
+
+    live_requests = [r for r in service.requests if r.url.path == "/live"]
+    gone_requests = [r for r in service.requests if r.url.path == "/gone"]
+    # Один запрос на подписку, плюс один повтор после 503 не раньше Retry-After
+    assert len(live_requests) == 2 and len(gone_requests) == 1
+    assert delays == [pytest.approx(2, abs=0.01)]
+    assert notifier.stats["sent"] == 1 and notifier.stats["retried"] == 1 and notifier.stats["pruned"] == 1
+
+    request = live_requests[-1]
+    assert request.headers["Content-Encoding"] == "aes128gcm"
+    assert request.headers["Topic"] == f"newmessage{chat_id}"
+    notification = browser.decrypt(request.content)
+    assert notification["title"] == "team"
+    assert notification["body"] == "3 новых сообщения"
+    assert notification["data"] == {"kind": "new_message", "chat_id": chat_id, "message_id": 3}
+
+    # VAPID: JWT для origin push-сервиса, подписанный ключом сервера
+    token, public_key = request.headers["Authorization"].removeprefix("vapid t=").split(", k=")
+    assert public_key == notifier.public_key
+    vapid_public = ec.EllipticCurvePublicKey.from_encoded_point(
+        ec.SECP256R1(), base64.urlsafe_b64decode(public_key + "=" * (-len(public_key) % 4))
+    ).public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+    claims = jwt.decode(token, vapid_public, algorithms=["ES256"], audience=PUSH_SERVICE)
+    assert claims["sub"] == settings.VAPID_SUBJECT
+
+    db.expire_all()
+    assert db.get(PushSubscription, live_id) is not None
+    assert db.get(PushSubscription, gone_id) is None
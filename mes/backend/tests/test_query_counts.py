@@ -0,0 +1,85 @@
+"""Бюджеты SQL-запросов горячих эндпоинтов: число запросов не растет с числом
+чатов, сообщений и отправителей (query_stats.assert_max_queries).
+
+Без Redis счетчики непрочитанных считаются запросом к БД (unread.count_unread) -
+он входит в бюджет GET /api/chats/.
+"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi.testclient import TestClient
+
+import initial_sync
+import main
+from auth import create_access_token
+from models import Call, CallStatus, Chat, Message
+from query_stats import assert_max_queries
+
+CHATS = 5
+MESSAGES_PER_CHAT = 4
+
+
+@pytest.fixture
+def seeded(db, make_user):
+    """alice и по собеседнику в каждом из CHATS чатов; сообщения и звонки от обоих"""
+    alice = make_user("alice")
+    chats = []
+    for index in range(CHATS):
+        other = make_user(f"user{index}")
+        chat = Chat(name=None, is_group=False, created_by=alice.id, participants=[alice, other])
+        db.add(chat)
+        db.flush()
+        for number in range(MESSAGES_PER_CHAT):
+            sender = alice if number % 2 else other
+            db.add(Message(chat_id=chat.id, sender_id=sender.id, content=f"message {number}"))
+        started = datetime.now(timezone.utc) - timedelta(minutes=index)
+        db.add(Call(
+            chat_id=chat.id, initiator_id=other.id, status=CallStatus.ENDED.value,
+            started_at=started, answered_at=started, ended_at=started + timedelta(seconds=30)
+        ))
+        chats.append(chat)
+    db.commit()
+    client = TestClient(main.app)
+    client.headers["Authorization"] = f"Bearer {create_access_token({'sub': str(alice.id)})}"
+    # Профиль из кэша (get_current_profile): первый запрос заполняет кэш
+    assert client.get("/api/auth/me").status_code == 200
+    return client, [chat.id for chat in chats]
+
+
+def test_my_chats(seeded):
+    client, _ = seeded
+    # Чаты, участники всех чатов, счетчики непрочитанных
+    with assert_max_queries(3, "GET /api/chats/"):
+        response = client.get("/api/chats/")
+    assert response.status_code == 200
+    assert len(response.json()) == CHATS
+    assert all(len(chat["participants"]) == 2 for chat in response.json())
+
+
+def test_chat_messages(seeded):
+    client, chat_ids = seeded
+    # Проверка доступа к чату и сообщения вместе с отправителями
+    with assert_max_queries(2, "GET /api/chats/{chat_id}/messages"):
+        response = client.get(f"/api/chats/{chat_ids[0]}/messages")
+    assert response.status_code == 200
+    messages = response.json()
+    assert len(messages) == MESSAGES_PER_CHAT
+    assert len({message["sender"]["id"] for message in messages}) == 2
+
+
+def test_call_history(seeded):
+    client, _ = seeded
+    with assert_max_queries(1, "GET /api/calls/history"):
+        response = client.get("/api/calls/history")
+    assert response.status_code == 200
+    assert len(response.json()) == CHATS
+    assert all(call["duration_seconds"] == 30 for call in response.json())
+
+
+def test_sync_chunk(seeded):
+    _, chat_ids = seeded
+    # Кадр снимка: чаты с участниками и последние сообщения
+    with assert_max_queries(2, "initial_sync._load_chunk"):
+        chats = initial_sync._load_chunk(None, chat_ids, MESSAGES_PER_CHAT)
+    assert [chat["id"] for chat in chats] == chat_ids
+    assert all(len(chat["messages"]) == MESSAGES_PER_CHAT for chat in chats)
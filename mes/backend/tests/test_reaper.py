@@ -0,0 +1,57 @@
+import asyncio
+import time
+
+from config import settings
+from connections import Connection
+from websocket_manager import ConnectionManager
+from ws_protocol import JSON_CODEC
+
+
+class HalfOpenSocket:
+    """Сокет с полным буфером отправки: send и close не завершаются"""
+
+    async def send_text(self, data):
+        await asyncio.Event().wait()
+
+    async def close(self, code):
+        await asyncio.Event().wait()
+
+
+class LiveSocket:
+    """Отвечает на каждый пинг"""
+
+    def __init__(self):
+        self.sent = []
+        self.connection = None
+
+    async def send_text(self, data):
+        self.sent.append(data)
+        self.connection.last_seen = time.monotonic()
+
+    async def close(self, code):
+        pass
+
+
+def test_reaper_pings_half_open_sockets_concurrently(monkeypatch):
+    monkeypatch.setattr(settings, "WS_PING_INTERVAL_SECONDS", 0.1)
+    monkeypatch.setattr(settings, "WS_PING_TIMEOUT_SECONDS", 0.2)
+
+    async def scenario():
+        manager = ConnectionManager()
+        live = LiveSocket()
+        sockets = [HalfOpenSocket() for _ in range(50)] + [live]
+        for user_id, socket in enumerate(sockets, start=1):
+            connection = Connection(socket, user_id, JSON_CODEC)
+            connection.last_seen = time.monotonic() - 0.1
+            manager.connections.add(connection)
+        live.connection = manager.connections.get(live)
+        manager.start_reaper()
+        # Последовательно пинги и закрытия заняли бы 50 * 0.4 с, параллельно - 0.4 с
+        await asyncio.sleep(0.8)
+        await manager.stop_reaper()
+        return manager, live
+
+    manager, live = asyncio.run(scenario())
+    assert manager.stats["reaped"] == 50
+    assert live.sent and set(live.sent) == {'{"type":"ping"}'}
+    assert len(manager.connections) == 1
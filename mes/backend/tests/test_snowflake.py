@@ -0,0 +1,18 @@
+import snowflake
+from snowflake import SnowflakeGenerator, MAX_SEQUENCE, TIMESTAMP_SHIFT, EPOCH_MS
+
+
+def test_ids_stay_monotonic_without_waiting_after_clock_step_back(monkeypatch):
+    now = 1_800_000_000_000
+    monkeypatch.setattr(snowflake, "_now_ms", lambda: now)
+    generator = SnowflakeGenerator(node_id=3)
+    before = [generator.next_id() for _ in range(10)]
+
+    # Часы ушли на 5 с назад и стоят: исчерпанная последовательность
+    # переходит на следующую миллисекунду логически, а не ждет часов
+    monkeypatch.setattr(snowflake, "_now_ms", lambda: now - 5000)
+    after = [generator.next_id() for _ in range(10 * (MAX_SEQUENCE + 1))]
+
+    ids = before + after
+    assert ids == sorted(ids) and len(set(ids)) == len(ids)
+    assert (ids[-1] >> TIMESTAMP_SHIFT) + EPOCH_MS == now + 10
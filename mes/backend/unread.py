@@ -0,0 +1,213 @@
+"""Счетчики непрочитанных сообщений по (пользователь, чат).
+
+Источник правды - отметка chat_participants.last_read_message_id: все
+сообщения чата с id больше нее (не свои и не удаленные) непрочитаны. Считать
+так для всего списка чатов на каждый запрос дорого, поэтому счетчики живут в
+Redis хешем unread:{user_id} (поле - chat_id):
+
+- отправка сообщения: HINCRBY каждому получателю, один pipeline;
+- прочтение (message_read): отметка сдвигается вперед, счетчик чата
+  пересчитывается по индексу (chat_id, id) - сообщений после отметки мало;
+- раз в UNREAD_RECONCILE_SECONDS один узел пересчитывает хеши всех
+  пользователей пачками по UNREAD_RECONCILE_BATCH и исправляет расхождения
+  (гонки отправки и прочтения, удаленные сообщения, потерянный Redis);
+- список чатов получает все счетчики одним HGETALL.
+
+Без Redis счетчики считаются запросом к БД.
+"""
+import asyncio
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import and_, func, or_, select, update
+
+from config import settings
+from database import get_engine
+from models import Message, chat_participants
+from schemas import ChatResponse
+
+# Отметка прохода сверки: пока живет ключ, другие узлы проход пропускают
+RECONCILE_KEY = "unread:reconcile"
+
+# Заменить хеш сверенными значениями, только если он не менялся с момента снимка
+# (иначе пока шел подсчет в БД пришли HINCRBY - сверка в следующий проход).
+# ARGV[1] - число полей снимка, дальше пары снимка, дальше пары новых значений.
+RECONCILE_SCRIPT = """
+local n = tonumber(ARGV[1])
+if redis.call('HLEN', KEYS[1]) ~= n then
+    return 0
+end
+for i = 2, 2 * n, 2 do
+    if redis.call('HGET', KEYS[1], ARGV[i]) ~= ARGV[i + 1] then
+        return 0
+    end
+end
+redis.call('DEL', KEYS[1])
+if #ARGV > 2 * n + 1 then
+    redis.call('HSET', KEYS[1], unpack(ARGV, 2 * n + 2))
+end
+return 1
+"""
+
+
+def _unread_key(user_id: int) -> str:
+    return f"unread:{user_id}"
+
+
+def count_unread(user_ids: List[int], chat_id: Optional[int] = None) -> Dict[int, Dict[int, int]]:
+    """user_id -> {chat_id: непрочитано} по отметкам в chat_participants"""
+    member = chat_participants
+    query = (
+        select(member.c.user_id, member.c.chat_id, func.count(Message.id))
+        .join(Message, and_(
+            Message.chat_id == member.c.chat_id,
+            Message.id > func.coalesce(member.c.last_read_message_id, 0),
+            Message.sender_id != member.c.user_id,
+            Message.is_deleted == False
+        ))
+        .where(member.c.user_id.in_(user_ids))
+        .group_by(member.c.user_id, member.c.chat_id)
+    )
+    if chat_id is not None:
+        query = query.where(member.c.chat_id == chat_id)
+    counts: Dict[int, Dict[int, int]] = {user_id: {} for user_id in user_ids}
+    with get_engine().connect() as connection:
+        for user_id, member_chat_id, count in connection.execute(query):
+            counts[user_id][member_chat_id] = count
+    return counts
+
+
+def advance_read_mark(user_id: int, chat_id: int, message_id: int) -> int:
+    """Сдвинуть отметку прочтения вперед; вернуть, сколько осталось непрочитанным"""
+    with get_engine().begin() as connection:
+        connection.execute(
+            update(chat_participants)
+            .where(
+                chat_participants.c.chat_id == chat_id,
+                chat_participants.c.user_id == user_id,
+                or_(
+                    chat_participants.c.last_read_message_id.is_(None),
+                    chat_participants.c.last_read_message_id < message_id
+                )
+            )
+            .values(last_read_message_id=message_id)
+        )
+    return count_unread([user_id], chat_id)[user_id].get(chat_id, 0)
+
+
+class UnreadCounters:
+    """Счетчики непрочитанных в Redis и их сверка с БД"""
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._redis = None
+        self._reconcile_script = None
+        self.stats = {"reconciled_users": 0, "corrected": 0, "passes": 0}
+
+    async def start(self, manager):
+        self._redis = manager.redis_client
+        if self._redis:
+            self._reconcile_script = self._redis.register_script(RECONCILE_SCRIPT)
+            if settings.UNREAD_RECONCILE_SECONDS > 0:
+                self._task = asyncio.create_task(self._reconcile_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def message_created(self, chat_id: int, recipient_ids: Iterable[int]):
+        if not self._redis:
+            return
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for user_id in recipient_ids:
+                pipe.hincrby(_unread_key(user_id), chat_id, 1)
+            await pipe.execute()
+
+    async def mark_read(self, user_id: int, chat_id: int, message_id: int):
+        remaining = await asyncio.to_thread(advance_read_mark, user_id, chat_id, message_id)
+        if not self._redis:
+            return
+        if remaining:
+            await self._redis.hset(_unread_key(user_id), chat_id, remaining)
+        else:
+            await self._redis.hdel(_unread_key(user_id), chat_id)
+
+    async def get_counts(self, user_id: int) -> Dict[int, int]:
+        if not self._redis:
+            return (await asyncio.to_thread(count_unread, [user_id]))[user_id]
+        counts = await self._redis.hgetall(_unread_key(user_id))
+        return {int(chat_id): int(count) for chat_id, count in counts.items() if int(count) > 0}
+
+    async def with_counts(self, user_id: int, chats) -> List[ChatResponse]:
+        """Сериализовать список чатов со счетчиками непрочитанных (один HGETALL)"""
+        counts = await self.get_counts(user_id)
+        return [
+            ChatResponse.model_validate(chat).model_copy(update={"unread_count": counts.get(chat.id, 0)})
+            for chat in chats
+        ]
+
+    # --- сверка с БД ---
+
+    async def _reconcile_loop(self):
+        while True:
+            await asyncio.sleep(settings.UNREAD_RECONCILE_SECONDS)
+            try:
+                ttl = max(int(settings.UNREAD_RECONCILE_SECONDS), 1)
+                if await self._redis.set(RECONCILE_KEY, "1", nx=True, ex=ttl):
+                    await self.reconcile()
+            except Exception as e:
+                print(f"Unread counters reconcile failed: {e}")
+
+    async def reconcile(self):
+        """Пересчитать хеши всех участников чатов пачками пользователей"""
+        after = 0
+        while True:
+            user_ids = await asyncio.to_thread(self._next_users, after)
+            if not user_ids:
+                break
+            # Снимок Redis до подсчета: изменения после него не затираются
+            snapshot = await self._snapshot(user_ids)
+            counts = await asyncio.to_thread(count_unread, user_ids)
+            await self._store(snapshot, counts)
+            after = user_ids[-1]
+            await asyncio.sleep(settings.UNREAD_RECONCILE_PAUSE_SECONDS)
+        self.stats["passes"] += 1
+
+    @staticmethod
+    def _next_users(after: int) -> List[int]:
+        query = (
+            select(chat_participants.c.user_id)
+            .where(chat_participants.c.user_id > after)
+            .group_by(chat_participants.c.user_id)
+            .order_by(chat_participants.c.user_id)
+            .limit(settings.UNREAD_RECONCILE_BATCH)
+        )
+        with get_engine().connect() as connection:
+            return list(connection.execute(query).scalars())
+
+    async def _snapshot(self, user_ids: List[int]) -> Dict[int, Dict[str, str]]:
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.hgetall(_unread_key(user_id))
+            return dict(zip(user_ids, await pipe.execute()))
+
+    async def _store(self, snapshot: Dict[int, Dict[str, str]], counts: Dict[int, Dict[int, int]]):
+        corrections = 0
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for user_id, stored in snapshot.items():
+                expected = {str(chat_id): str(count) for chat_id, count in counts[user_id].items() if count}
+                if {chat_id: count for chat_id, count in stored.items() if count != "0"} == expected:
+                    continue
+                args = [len(stored)]
+                for pairs in (stored, expected):
+                    for field, value in pairs.items():
+                        args.extend((field, value))
+                await self._reconcile_script(keys=[_unread_key(user_id)], args=args, client=pipe)
+                corrections += 1
+            if corrections:
+                self.stats["corrected"] += sum(await pipe.execute())
+        self.stats["reconciled_users"] += len(snapshot)
+
+
+unread_counters = UnreadCounters()
@@ -1,58 +1,281 @@
 from typing import Dict, List
-from fastapi import WebSocket
-import json
+from fastapi import WebSocket, WebSocketDisconnect, status
+import asyncio
+import random
+import time
 import redis.asyncio as redis
 from config import settings
+from connections import Connection, ConnectionRegistry
+from metrics import InstrumentedRedis, WS_FANOUT, WS_FANOUT_RECIPIENTS, WS_FRAMES_RECEIVED, WS_FRAMES_SENT, WS_SEND_ERRORS
+from presence import presence
+from push import PUSH_EVENTS, push_notifier
+from ws_protocol import negotiate_codec, receive_message, EventBatcher
 
 class ConnectionManager:
     def __init__(self):
-        # user_id -> List[WebSocket]
-        self.active_connections: Dict[int, List[WebSocket]] = {}
+        # Соединения узла: записи с кодеком, батчером и last_seen (connections.py)
+        self.connections = ConnectionRegistry(settings.WS_REGISTRY_SHARDS)
         self.redis_client: redis.Redis = None
+        # Счетчики для подбора таймаутов и окна батчинга
+        self.stats = {
+            "pings_sent": 0,
+            "reaped": 0,
+            "batch_frames": 0,
+            "batched_events": 0,
+            "coalesced_events": 0,
+            "drained": 0,
+            "rejected": 0,
+        }
+        self._reaper_task: asyncio.Task = None
+        # Идущие пинги и закрытия reaper'а по соединениям
+        self._reaper_checks: Dict[Connection, asyncio.Task] = {}
+        # Узел останавливается: новые соединения не принимаются, текущие разводятся
+        self.draining = False
     
     async def init_redis(self):
-        self.redis_client = await redis.from_url(settings.REDIS_URL, decode_responses=True)
+        self.redis_client = await InstrumentedRedis.from_url(settings.REDIS_URL, decode_responses=True)
     
-    async def connect(self, websocket: WebSocket, user_id: int):
-        await websocket.accept()
-        if user_id not in self.active_connections:
-            self.active_connections[user_id] = []
-        self.active_connections[user_id].append(websocket)
+    def start_reaper(self):
+        self._reaper_task = asyncio.create_task(self._reaper_loop())
+    
+    async def stop_reaper(self):
+        if self._reaper_task:
+            self._reaper_task.cancel()
+            await asyncio.gather(self._reaper_task, return_exceptions=True)
+            self._reaper_task = None
+        checks = list(self._reaper_checks.values())
+        for task in checks:
+            task.cancel()
+        await asyncio.gather(*checks, return_exceptions=True)
+    
+    async def connect(self, websocket: WebSocket, user_id: int) -> bool:
+        """Принять соединение; False - превышен лимит сокетов пользователя, сокет закрыт"""
+        codec, subprotocol = negotiate_codec(websocket)
+        await websocket.accept(subprotocol=subprotocol)
+        # Проверка лимита и регистрация без await между ними
+        if self.connections.count(user_id) >= settings.WS_MAX_CONNECTIONS_PER_USER:
+            self.stats["rejected"] += 1
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+            return False
+        connection = Connection(websocket, user_id, codec, websocket.query_params.get("device"))
+        if websocket.query_params.get("batch") in ("1", "true"):
+            connection.batcher = EventBatcher(
+                lambda message: self._send_now(connection, message),
+                settings.WS_BATCH_WINDOW_MS,
+                settings.WS_BATCH_MAX_EVENTS,
+                self.stats
+            )
         
-        # Установить статус онлайн в Redis
-        if self.redis_client:
-            await self.redis_client.set(f"user_status:{user_id}", "online")
-            await self.redis_client.publish("user_status", json.dumps({"user_id": user_id, "status": "online"}))
+        # Первое соединение пользователя на узле - отметить онлайн
+        if self.connections.add(connection):
+            await presence.user_connected(user_id)
+        return True
+    
+    def touch(self, websocket: WebSocket):
+        """Отметить входящий кадр от клиента"""
+        connection = self.connections.get(websocket)
+        if connection is not None:
+            connection.last_seen = time.monotonic()
     
     async def disconnect(self, websocket: WebSocket, user_id: int):
-        if user_id in self.active_connections:
-            self.active_connections[user_id].remove(websocket)
-            if not self.active_connections[user_id]:
-                del self.active_connections[user_id]
-                # Установить статус оффлайн в Redis
-                if self.redis_client:
-                    await self.redis_client.set(f"user_status:{user_id}", "offline")
-                    await self.redis_client.publish("user_status", json.dumps({"user_id": user_id, "status": "offline"}))
-    
-    async def send_personal_message(self, message: dict, user_id: int):
-        if user_id in self.active_connections:
-            for connection in self.active_connections[user_id]:
-                try:
-                    await connection.send_json(message)
-                except:
-                    pass
+        # Соединение может быть уже снято reaper'ом
+        connection = self.connections.remove(websocket)
+        if connection is None:
+            return
+        connection.close()
+        if user_id not in self.connections:
+            # При остановке узла клиент вернется через секунды - без рассылки offline
+            await presence.user_disconnected(user_id, publish=not self.draining)
+    
+    async def _reaper_loop(self):
+        """Пинговать молчащие соединения и закрывать те, что не ответили"""
+        interval = settings.WS_PING_INTERVAL_SECONDS
+        deadline = interval + settings.WS_PING_TIMEOUT_SECONDS
+        # Пинги и закрытия - отдельные задачи: полуоткрытый сокет с полным буфером
+        # ждет до таймаута, но не задерживает ни остальных, ни следующий обход
+        semaphore = asyncio.Semaphore(settings.WS_REAPER_CONCURRENCY)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for connection in self.connections.snapshot():
+                if connection.closed or connection in self._reaper_checks:
+                    continue
+                idle = now - connection.last_seen
+                if idle >= deadline:
+                    check = self._reap(connection)
+                elif idle >= interval:
+                    check = self._ping(connection)
+                else:
+                    continue
+                self._reaper_checks[connection] = asyncio.create_task(self._limited(semaphore, connection, check))
+    
+    async def _limited(self, semaphore: asyncio.Semaphore, connection: Connection, check):
+        try:
+            async with semaphore:
+                await check
+        except Exception as e:
+            print(f"Reaper check failed: {e}")
+        finally:
+            self._reaper_checks.pop(connection, None)
+    
+    async def _ping(self, connection: Connection):
+        self.stats["pings_sent"] += 1
+        try:
+            await asyncio.wait_for(
+                self._send_now(connection, {"type": "ping"}),
+                settings.WS_PING_TIMEOUT_SECONDS
+            )
+        except Exception:
+            await self._reap(connection)
+    
+    async def _reap(self, connection: Connection):
+        self.stats["reaped"] += 1
+        await self.disconnect(connection.websocket, connection.user_id)
+        try:
+            # close на полуоткрытом TCP может зависнуть - не ждем дольше таймаута
+            await asyncio.wait_for(
+                connection.websocket.close(code=status.WS_1001_GOING_AWAY),
+                settings.WS_PING_TIMEOUT_SECONDS
+            )
+        except Exception:
+            pass
+    
+    async def drain(self, reconnect_jitter_ms: int, timeout: float):
+        """Развести соединения перед остановкой узла.
+        
+        Каждому клиенту досылаются события из окна батчинга, затем уходит
+        {"type": "reconnect", "data": {"delay_ms": ...}} со случайной задержкой
+        в пределах reconnect_jitter_ms, и сокет закрывается кодом 1012.
+        Клиенты переподключаются к другим воркерам вразброс, а не все разом.
+        """
+        self.draining = True
+        connections = list(self.connections.snapshot())
+        if not connections:
+            return
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(self._drain_one(connection, reconnect_jitter_ms) for connection in connections)),
+                timeout
+            )
+        except asyncio.TimeoutError:
+            pass
+    
+    async def _drain_one(self, connection: Connection, reconnect_jitter_ms: int):
+        try:
+            if connection.batcher is not None:
+                await connection.batcher.flush()
+            await self._send_now(connection, {
+                "type": "reconnect",
+                "data": {"delay_ms": random.randint(0, reconnect_jitter_ms)}
+            })
+            await connection.websocket.close(code=status.WS_1012_SERVICE_RESTART)
+            self.stats["drained"] += 1
+        except Exception:
+            WS_SEND_ERRORS.inc()
+    
+    def queued_events(self) -> int:
+        """События, ждущие окна батчинга"""
+        return sum(
+            connection.batcher.pending
+            for connection in self.connections.snapshot()
+            if connection.batcher is not None
+        )
+    
+    def get_stats(self) -> dict:
+        return {
+            "users": len(self.connections),
+            "connections": self.connections.connection_count(),
+            **self.stats,
+        }
+    
+    async def receive(self, websocket: WebSocket) -> dict:
+        """Принять и декодировать кадр в кодеке соединения"""
+        connection = self.connections.get(websocket)
+        if connection is None:
+            # Соединение уже снято reaper'ом
+            raise WebSocketDisconnect(status.WS_1001_GOING_AWAY)
+        message = await receive_message(websocket, connection.codec)
+        WS_FRAMES_RECEIVED.inc()
+        connection.last_seen = time.monotonic()
+        return message
+    
+    async def send(self, websocket: WebSocket, message: dict, encoded: Dict[str, object] = None):
+        """Отправить событие в кодеке соединения.
+        
+        encoded - кэш уже закодированных кадров по имени кодека, чтобы при
+        рассылке одного события многим соединениям кодировать его один раз.
+        Для соединений с батчингом событие ставится в окно и уходит позже.
+        """
+        connection = self.connections.get(websocket)
+        if connection is not None:
+            await self._send(connection, message, encoded)
+    
+    async def send_frame(self, websocket: WebSocket, message: dict):
+        """Отправить кадр сразу, минуя батчер (большие кадры, например снимок initial_sync)"""
+        connection = self.connections.get(websocket)
+        if connection is not None:
+            await self._send_now(connection, message)
+    
+    async def _send(self, connection: Connection, message: dict, encoded: Dict[str, object] = None):
+        if connection.batcher is not None:
+            connection.batcher.add(message)
+            return
+        await self._send_now(connection, message, encoded)
+    
+    async def _send_now(self, connection: Connection, message: dict, encoded: Dict[str, object] = None):
+        codec = connection.codec
+        # Снятое соединение может еще оставаться в снимке шарда
+        if codec is None:
+            return
+        if encoded is None:
+            encoded = {}
+        data = encoded.get(codec.name)
+        if data is None:
+            data = encoded[codec.name] = codec.encode(message)
+        if codec.binary:
+            await connection.websocket.send_bytes(data)
+        else:
+            await connection.websocket.send_text(data)
+        WS_FRAMES_SENT.inc()
+    
+    async def send_personal_message(self, message: dict, user_id: int, encoded: Dict[str, object] = None):
+        connection = self.connections.first(user_id)
+        if connection is None:
+            return
+        if encoded is None:
+            encoded = {}
+        # Обход по next без генератора: вызывается на каждого получателя рассылки
+        while connection is not None:
+            try:
+                await self._send(connection, message, encoded)
+            except:
+                WS_SEND_ERRORS.inc()
+            connection = connection.next
     
     async def send_to_chat(self, message: dict, user_ids: List[int]):
+        start = time.perf_counter()
+        encoded = {}
         for user_id in user_ids:
-            await self.send_personal_message(message, user_id)
+            await self.send_personal_message(message, user_id, encoded)
+        WS_FANOUT.observe(time.perf_counter() - start)
+        WS_FANOUT_RECIPIENTS.observe(len(user_ids))
+        # Без соединения на этом узле - в очередь Web Push (push.py)
+        if push_notifier.enabled and message.get("type") in PUSH_EVENTS:
+            offline = [user_id for user_id in user_ids if user_id not in self.connections]
+            if offline:
+                try:
+                    await push_notifier.enqueue(offline, message)
+                except Exception as e:
+                    print(f"Push enqueue failed: {e}")
     
     async def broadcast(self, message: dict):
-        for user_connections in self.active_connections.values():
-            for connection in user_connections:
-                try:
-                    await connection.send_json(message)
-                except:
-                    pass
+        encoded = {}
+        # Снимки шардов не меняются во время await - без копии всего реестра
+        for connection in self.connections.snapshot():
+            try:
+                await self._send(connection, message, encoded)
+            except:
+                WS_SEND_ERRORS.inc()
     
     async def set_typing(self, chat_id: int, user_id: int, is_typing: bool):
         if self.redis_client:
@@ -74,10 +297,11 @@ class ConnectionManager:
         return []
     
     async def get_user_status(self, user_id: int) -> str:
-        if self.redis_client:
-            status = await self.redis_client.get(f"user_status:{user_id}")
-            return status or "offline"
-        return "offline"
+        statuses = await presence.get_statuses([user_id])
+        return statuses[user_id]
+    
+    async def get_statuses(self, user_ids: List[int]) -> Dict[int, str]:
+        return await presence.get_statuses(user_ids)
 
 manager = ConnectionManager()
 
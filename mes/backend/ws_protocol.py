@@ -0,0 +1,152 @@
+import asyncio
+import json
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+from metrics import WS_SEND_ERRORS
+
+try:
+    import msgpack
+except ImportError:  # msgpack - опциональная зависимость
+    msgpack = None
+
+
+class JsonCodec:
+    """Текстовые JSON-кадры (протокол по умолчанию)"""
+
+    name = "json"
+    binary = False
+
+    def encode(self, message: dict) -> str:
+        return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+    def decode(self, data: Union[str, bytes]) -> dict:
+        return json.loads(data)
+
+
+class MsgPackCodec:
+    """Бинарные кадры MessagePack с той же схемой событий"""
+
+    name = "msgpack"
+    binary = True
+
+    def encode(self, message: dict) -> bytes:
+        return msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, data: Union[str, bytes]) -> dict:
+        if isinstance(data, str):
+            # Текстовый кадр от клиента на msgpack-соединении - это JSON
+            return json.loads(data)
+        return msgpack.unpackb(data, raw=False)
+
+
+JSON_CODEC = JsonCodec()
+CODECS: Dict[str, object] = {JSON_CODEC.name: JSON_CODEC}
+if msgpack is not None:
+    CODECS[MsgPackCodec.name] = MsgPackCodec()
+
+
+def negotiate_codec(websocket: WebSocket) -> Tuple[object, Optional[str]]:
+    """Выбрать кодек по Sec-WebSocket-Protocol из рукопожатия.
+
+    Клиент перечисляет поддерживаемые подпротоколы ("msgpack", "json")
+    в порядке предпочтения, берется первый известный серверу. Возвращает
+    кодек и подпротокол для ответа; без подпротокола - JSON.
+    """
+    requested: List[str] = websocket.scope.get("subprotocols") or []
+    for subprotocol in requested:
+        codec = CODECS.get(subprotocol)
+        if codec is not None:
+            return codec, subprotocol
+    return JSON_CODEC, None
+
+
+async def receive_message(websocket: WebSocket, codec) -> dict:
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    data = message.get("bytes")
+    if data is None:
+        data = message.get("text")
+    return codec.decode(data)
+
+
+def coalesce_key(message: dict) -> Optional[tuple]:
+    """Ключ события, которое заменяется более поздним таким же.
+
+    Повторный user_typing от того же пользователя в том же чате отменяет
+    предыдущий - клиенту важно только последнее состояние.
+    """
+    if message.get("type") == "user_typing":
+        data = message.get("data") or {}
+        return ("user_typing", data.get("chat_id"), data.get("user_id"))
+    return None
+
+
+class EventBatcher:
+    """Микробатчинг исходящих событий одного соединения.
+
+    События, пришедшие в течение окна, уходят одним кадром
+    {"type": "batch", "data": {"events": [...]}}; вытесненные события
+    (см. coalesce_key) схлопываются. Одно событие в окне отправляется как есть.
+    """
+
+    def __init__(self, flush: Callable[[dict], Awaitable[None]], window_ms: int, max_events: int, stats: dict):
+        self._flush_cb = flush
+        self._stats = stats
+        self._window = window_ms / 1000
+        self._max_events = max_events
+        self._events: List[dict] = []
+        self._positions: Dict[tuple, int] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._events)
+
+    def add(self, message: dict):
+        key = coalesce_key(message)
+        if key is not None and key in self._positions:
+            self._events[self._positions[key]] = message
+            self._stats["coalesced_events"] += 1
+            return
+        if key is not None:
+            self._positions[key] = len(self._events)
+        self._events.append(message)
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_later())
+        elif len(self._events) >= self._max_events:
+            self._task.cancel()
+            self._task = asyncio.create_task(self._flush_later(0))
+
+    async def _flush_later(self, delay: Optional[float] = None):
+        await asyncio.sleep(self._window if delay is None else delay)
+        events, self._events, self._positions = self._events, [], {}
+        self._task = None
+        if not events:
+            return
+        # Задача без ожидающего: ошибку отправки (сокет уже закрыт) учесть здесь,
+        # как при прямой отправке
+        try:
+            if len(events) == 1:
+                await self._flush_cb(events[0])
+            else:
+                self._stats["batch_frames"] += 1
+                self._stats["batched_events"] += len(events)
+                await self._flush_cb({"type": "batch", "data": {"events": events}})
+        except Exception:
+            WS_SEND_ERRORS.inc()
+
+    async def flush(self):
+        """Отправить накопленное сразу, не дожидаясь конца окна"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self._flush_later(0)
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._events, self._positions = [], {}
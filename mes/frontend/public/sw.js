@@ -54,6 +54,9 @@ self.addEventListener('push', (event) => {
     icon: '/pwa-192x192.png',
     badge: '/pwa-192x192.png',
     data: data.data || {},
+    // Одно уведомление на чат: новое заменяет предыдущее
+    tag: data.tag,
+    renotify: Boolean(data.tag),
   };
 
   event.waitUntil(self.registration.showNotification(title, options));
@@ -10,6 +10,8 @@ export class WebSocketService {
   private reconnectAttempts = 0;
   private maxReconnectAttempts = 5;
   private reconnectDelay = 3000;
+  // Задержка из события reconnect: сервер перезапускается и разносит клиентов во времени
+  private reconnectHintMs: number | null = null;
 
   private constructor() {}
 
@@ -56,13 +58,17 @@ export class WebSocketService {
       useWSStore.getState().setIsConnected(false);
       useWSStore.getState().setWs(null);
       
-      // Попытка переподключения
-      if (this.reconnectAttempts < this.maxReconnectAttempts) {
-        this.reconnectAttempts++;
+      // Попытка переподключения (плановый перезапуск сервера не тратит попытки)
+      const hintedDelay = this.reconnectHintMs;
+      this.reconnectHintMs = null;
+      if (hintedDelay !== null || this.reconnectAttempts < this.maxReconnectAttempts) {
+        if (hintedDelay === null) {
+          this.reconnectAttempts++;
+        }
         setTimeout(() => {
           console.log(`Reconnecting... Attempt ${this.reconnectAttempts}`);
           this.connect(token);
-        }, this.reconnectDelay);
+        }, hintedDelay ?? this.reconnectDelay);
       }
     };
   }
@@ -71,6 +77,11 @@ export class WebSocketService {
     const { type, data } = message;
 
     switch (type) {
+      case 'batch':
+        // Пачка событий за окно батчинга (подключение с ?batch=1)
+        data.events.forEach((event: any) => this.handleMessage(event));
+        break;
+
       case 'new_message':
         // Добавить новое сообщение
         useChatStore.getState().addMessage(data.chat_id, data);
@@ -92,6 +103,11 @@ export class WebSocketService {
         }
         break;
 
+      case 'reaction_added':
+      case 'reaction_removed':
+        // Обновить счетчики реакций сообщения
+        break;
+
       case 'message_read':
         // Обновить статус прочитанности
         break;
@@ -140,10 +156,29 @@ export class WebSocketService {
         useCallStore.getState().endCall();
         break;
 
+      case 'call_missed':
+        // Никто не ответил за отведённое время
+        notifications.show({
+          title: 'Пропущенный звонок',
+          message: 'Никто не ответил на звонок',
+        });
+        useCallStore.getState().endCall();
+        break;
+
       case 'webrtc_signal':
         // WebRTC сигналинг - обработка в WebRTC service
         break;
 
+      case 'reconnect':
+        // Сервер закроет соединение; переподключиться через указанную задержку
+        this.reconnectHintMs = data.delay_ms;
+        break;
+
+      case 'ping':
+        // Серверная проверка liveness
+        this.send({ type: 'pong' });
+        break;
+
       case 'pong':
         // Heartbeat response
         break;
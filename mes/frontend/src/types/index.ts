@@ -36,6 +36,7 @@ export interface Message {
   created_at: string;
   sender: User;
   reactions?: MessageReaction[];
+  reaction_counts?: Record<string, number>;
   read_by?: MessageRead[];
 }
 
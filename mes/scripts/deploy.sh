@@ -41,9 +41,17 @@ docker-compose -f docker-compose.prod.yml down
 echo "📥 Получение последних изменений..."
 git pull
 
-# Сборка и запуск
-echo "🔨 Сборка и запуск контейнеров..."
-docker-compose -f docker-compose.prod.yml up -d --build
+# Сборка
+echo "🔨 Сборка контейнеров..."
+docker-compose -f docker-compose.prod.yml build
+
+# Миграции схемы БД - один раз, до запуска воркеров
+echo "🗄️  Применение миграций..."
+docker-compose -f docker-compose.prod.yml run --rm backend alembic upgrade head
+
+# Запуск
+echo "🚀 Запуск контейнеров..."
+docker-compose -f docker-compose.prod.yml up -d
 
 # Ожидание запуска
 echo "⏳ Ожидание запуска сервисов..."